@@ -50,6 +50,8 @@ static const uint8_t opspecs[] = {
     [REM_U] = SPEC(1, 2),
     [LONG_MUL] = SPEC(2, 2),
     [LONG_MUL_U] = SPEC(2, 2),
+    [ST_M] = SPEC(1, OPD_VAR),
+    [LD_M] = SPEC(OPD_VAR, 2),
     [AND2] = SPEC(1, 2),
     [OR2] = SPEC(1, 2),
     [AND] = SPEC(1, OPD_VAR),
@@ -113,6 +115,10 @@ static const uint8_t opspecs[] = {
     [NOT] = SPEC(1, 1),
     [BOOL] = SPEC(1, 1),
     [NOP] = SPEC(0, 0),
+// superinstructions: target of the first op, sources of both but the slot
+#define FUSED(_op, _first, _second, _slot, _nsrcs) [_op] = SPEC(1, _nsrcs),
+    FUSED_OPS
+#undef FUSED
 };
 
 static int decode_varint_size(uint32_t head)
@@ -227,13 +233,45 @@ static int read_dst(bajo_t *me, uint32_t *addr)
     return val;
 }
 
+static void dispatch(bajo_t *me, opcode_t opcode, int32_t *t, unsigned int nt, const int32_t *s, unsigned int ns);
+
+// first op, then the branch with the result of first inserted as the source at slot
+static void dispatch_fused(bajo_t *me, opcode_t first, opcode_t second, unsigned int slot, int32_t *t, const int32_t *s, unsigned int ns)
+{
+    const unsigned int nfirst = opspecs[first] & 0x0F;
+    dispatch(me, first, t, 1, s, nfirst);
+    if (me->err)
+        return;
+
+    int32_t s2[MAX_SRCS];
+    int32_t t2[MAX_TGTS];
+    unsigned int n = 0;
+    for (unsigned int i = nfirst; i < ns; i += 1)
+    {
+        if (n == slot)
+            s2[n++] = t[0];
+        s2[n++] = s[i];
+    }
+    if (n == slot)
+        s2[n++] = t[0];
+
+    dispatch(me, second, t2, 0, s2, n);
+}
+
 // NOTE: opcode_t is typedeffed here to catch 'case not handled in switch'.
 // The opcodes are mostly monotonic, so compiler is expected to
 // generate the jumptable instead of the iffs chain.
-static void dispatch(bajo_t *me, opcode_t opcode, int32_t *t, const int32_t *s, unsigned int ns)
+static void dispatch(bajo_t *me, opcode_t opcode, int32_t *t, unsigned int nt, const int32_t *s, unsigned int ns)
 {
     switch (opcode)
     {
+#define FUSED(_op, _first, _second, _slot, _nsrcs) \
+    case _op:                                      \
+        dispatch_fused(me, _first, _second, _slot, t, s, ns); \
+        return;
+        FUSED_OPS
+#undef FUSED
+
     case ADD:
         t[0] = s[0] + s[1];
         return;
@@ -316,6 +354,29 @@ static void dispatch(bajo_t *me, opcode_t opcode, int32_t *t, const int32_t *s,
         return;
     }
 
+    // block moves of the words, e.g. the stack frames
+    case ST_M:
+        if (ns < 1)
+        {
+            me->err = BAJO_BAD_OPERAND;
+            return;
+        }
+        t[0] = s[0] - 4 * (ns - 1);
+        for (unsigned int i = 1; i < ns && !me->err; i += 1)
+            me->write(me, t[0] + 4 * (i - 1), s[i], 4);
+        return;
+
+    case LD_M:
+        if (nt < 1)
+        {
+            me->err = BAJO_BAD_OPERAND;
+            return;
+        }
+        for (unsigned int i = 1; i < nt && !me->err; i += 1)
+            t[i] = me->read(me, s[0] + 4 * (i - 1), 4);
+        t[0] = s[0] + s[1];
+        return;
+
     case AND2:
         t[0] = !s[0] ? s[0] : s[1];
         return;
@@ -700,7 +761,7 @@ int bajo_step(bajo_t *me)
         return me->err;
 
     int32_t results[MAX_TGTS];
-    dispatch(me, opcode, results, srcs, nsrcs);
+    dispatch(me, opcode, results, ntgts, srcs, nsrcs);
 
     if (me->err)
         return me->err;
@@ -2,7 +2,7 @@
 #ifndef _OPCODES_H_
 #define _OPCODES_H_
 
-#define _MAX_OPCODE 71
+#define _MAX_OPCODE 77
 
 typedef enum
 {
@@ -78,7 +78,19 @@ typedef enum
     BOOL = 69,
     LONG_MUL = 70,
     LONG_MUL_U = 71,
+    ST_M = 72,
+    LD_M = 73,
+    ADD_BR_GT = 74,
+    ADD_BR_LT = 75,
+    SUB_BR_NE = 76,
+    TST_EQ_BR_NE = 77,
 } opcode_t;
 
+#define FUSED_OPS \
+    FUSED(ADD_BR_GT, ADD, BR_GT, 0, 4) \
+    FUSED(ADD_BR_LT, ADD, BR_GT, 1, 4) \
+    FUSED(SUB_BR_NE, SUB, BR_NE, 0, 4) \
+    FUSED(TST_EQ_BR_NE, TST_EQ, BR_NE, 0, 4)
+
 #endif
     
\ No newline at end of file
@@ -80,6 +80,15 @@ def create_h(instrs: list[Instr]):
         line = f"    {camel_to_snake(instr.__name__).upper()} = { instr.opcode },"
         lines.append(line)
 
+    # superinstructions: opcode, first, second, slot, number of sources
+    fused: list[str] = []
+    for instr in instrs:
+        if issubclass(instr, core._Fused):
+            nsrcs = (1 if issubclass(instr.first, core._TA) else 2) + 2
+            names = [camel_to_snake(cls.__name__).upper() for cls in (instr, instr.first, instr.second)]
+            fused.append(f"    FUSED({ ', '.join(names) }, { instr.slot }, { nsrcs })")
+    fused_ops = " \\\n".join(fused)
+
     return f"""
 #ifndef _OPCODES_H_
 #define _OPCODES_H_
@@ -91,6 +100,9 @@ typedef enum
 { "\n".join(lines) }
 }} opcode_t;
 
+#define FUSED_OPS \\
+{ fused_ops }
+
 #endif
     """
 
@@ -0,0 +1,82 @@
+# generate the superinstruction classes in core.py.
+# Arguments are the First:Second:slot specs, e.g. printed by the bajo.fuse.propose_superinstructions.
+# Existing superinstructions are kept. Run renumerate_opcodes.py and build_opcodes.py next
+
+import re
+import sys
+
+from bajo import core
+
+# names of branches with the operands swapped
+SWAPPED = {"BrGt": "BrLt", "BrGe": "BrLe", "BrGtU": "BrLtU", "BrGeU": "BrLeU"}
+
+
+def parse_doc(instr: type[core.Op]):
+    doc = instr.__doc__
+    assert doc is not None
+    operands, *actions = [line.strip() for line in doc.splitlines() if line.strip()]
+    return operands.split(", "), actions
+
+
+def create_class(first: type[core.Op], second: type[core.Op], slot: int):
+    name = first.__name__ + (SWAPPED.get(second.__name__, second.__name__) if slot else second.__name__)
+
+    first_opds, first_actions = parse_doc(first)
+    second_opds, second_actions = parse_doc(second)
+
+    # second's operands are renamed to follow the first's ones, the slot is the first's target
+    letters = iter("cdefgh")
+    renames = {opd: first_opds[0] if i == slot else next(letters) for i, opd in enumerate(second_opds[:-1])}
+    pattern = re.compile(r"\b(" + "|".join(renames) + r")\b")
+    actions = [*first_actions, *(pattern.sub(lambda m: renames[m[1]], line) for line in second_actions)]
+    operands = [*first_opds, *(renames[opd] for i, opd in enumerate(second_opds[:-1]) if i != slot), second_opds[-1]]
+
+    lines = "\n".join(f"    {line}" for line in actions)
+    return f'''\
+class { name }(_Fused):
+    """
+    { ", ".join(operands) }
+
+{ lines }
+    """
+
+    first = { first.__name__ }
+    second = { second.__name__ }
+    slot = { slot }
+'''
+
+
+def main():
+    specs = [(cls.first, cls.second, cls.slot) for cls in core._Fused.__subclasses__()]
+    for arg in sys.argv[1:]:
+        first, second, slot = arg.split(":")
+        spec = (getattr(core, first), getattr(core, second), int(slot))
+        if spec not in specs:
+            specs.append(spec)
+
+    classes = "\n\n".join(create_class(*spec) for spec in specs)
+    res = f"""\
+# <superinstructions>
+{ classes }
+
+# </superinstructions>"""
+
+    fn = "../src/bajo/core.py"
+
+    with open(fn) as f:
+        was = f.read()
+
+    repl = re.sub(
+        "(# <superinstructions>)$(.*)(# </superinstructions>)",
+        lambda m: res,
+        was,
+        count=1,
+        flags=re.DOTALL | re.MULTILINE,
+    )
+
+    with open(fn, "w") as f:
+        f.write(repl)
+
+
+if __name__ == "__main__":
+    main()
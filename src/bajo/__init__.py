@@ -6,10 +6,12 @@ __version__ = "0.1.0"
 
 
 from . import macro
-from .asm import Align, Bytes, Code, DataExpr, DataFactory, Label, MemFactory, Reg, RegFactory
+from .asm import Align, Bytes, Call, Code, DataExpr, DataFactory, Goto, Label, MemFactory, Reg, RegFactory, VReg
 from .core import (
     Abs,
     Add,
+    AddBrGt,
+    AddBrLt,
     And,
     And2,
     BitAnd,
@@ -40,6 +42,7 @@ from .core import (
     LdBU,
     LdH,
     LdHU,
+    LdM,
     LongMul,
     LongMulU,
     LShift,
@@ -69,7 +72,9 @@ from .core import (
     RShiftU,
     StB,
     StH,
+    StM,
     Sub,
+    SubBrNe,
     Sys,
     Sys00,
     Sys01,
@@ -87,6 +92,7 @@ from .core import (
     Sys23,
     Sys24,
     TstEq,
+    TstEqBrNe,
     TstGe,
     TstGeU,
     TstGt,
@@ -97,6 +103,7 @@ from .core import (
     TstLtU,
     TstNe,
     cast_s32,
+    deferred_checks,
 )
 from .env import Env
 from .script import Script
@@ -104,10 +111,13 @@ from .script import Script
 R = RegFactory()
 M = MemFactory()
 D = DataFactory()
+V = VReg
 
 __all__ = [
     "Abs",
     "Add",
+    "AddBrGt",
+    "AddBrLt",
     "Align",
     "And",
     "And2",
@@ -128,6 +138,7 @@ __all__ = [
     "BrLtU",
     "BrNe",
     "Bytes",
+    "Call",
     "Code",
     "DataExpr",
     "DataFactory",
@@ -135,6 +146,7 @@ __all__ = [
     "DivU",
     "Env",
     "Exit",
+    "Goto",
     "Imm",
     "ImmExpr",
     "Inv",
@@ -146,6 +158,7 @@ __all__ = [
     "LdBU",
     "LdH",
     "LdHU",
+    "LdM",
     "LongMul",
     "LongMulU",
     "Max",
@@ -178,7 +191,9 @@ __all__ = [
     "Script",
     "StB",
     "StH",
+    "StM",
     "Sub",
+    "SubBrNe",
     "Sys",
     "Sys00",
     "Sys01",
@@ -196,6 +211,7 @@ __all__ = [
     "Sys23",
     "Sys24",
     "TstEq",
+    "TstEqBrNe",
     "TstGe",
     "TstGeU",
     "TstGt",
@@ -205,6 +221,8 @@ __all__ = [
     "TstLt",
     "TstLtU",
     "TstNe",
+    "VReg",
     "cast_s32",
+    "deferred_checks",
     "macro",
 ]
@@ -1,26 +1,46 @@
 from __future__ import annotations
 
-from typing import Final, Iterable, Mapping, Protocol, Union, overload
+from typing import Final, Iterable, Iterator, Mapping, Protocol, Union, overload
 
 from .core import (
+    _MAX_VARINT_SIZE,
     Add,
+    Br,
+    BrLnk,
     IMem,
+    Imm,
+    ImmAdd,
     ImmExpr,
+    ImmOffset,
     ImmSub,
     Inst,
+    Jmp,
+    JmpLnk,
     Mem,
+    Nop,
     ProvidesLayout,
+    RhA,
     RhAB,
+    RhLoad,
     Src,
     Sub,
+    Tgt,
     fail_on_cycles,
     repr_or_fallback,
 )
-from .exc import AddrError
+from .exc import AddrError, BuildError
 
 Code = Union[Inst, "Label", "Directive", None, bool, Iterable[Union[Inst, "Label", "Directive", "Code", None, bool]]]
 
 
+def flat_code(code: Code) -> Iterator[Inst | Label | Directive | None | bool]:
+    if code is None or code is False or code is True or isinstance(code, (Inst, Label, Directive)):
+        yield code
+    else:
+        for item in code:
+            yield from flat_code(item)
+
+
 class ProvidesLayoutAndNamedRegisters(ProvidesLayout, Protocol):
     @property
     def named_registers(self) -> Mapping[str, int]: ...
@@ -130,6 +150,33 @@ class NamedReg(Mem):
         return f"r{ lay.named_registers[self.name] }"
 
 
+class VReg(Mem):
+    """Virtual register. The concrete number is assigned by the register allocator before the build."""
+
+    _created = 0
+
+    def __init__(self, name: str | None = None):
+        VReg._created += 1
+        # creation order, for the stable allocation
+        self.serial: Final = VReg._created
+        self.name = name or f"v{ self.serial }"
+
+    def __repr__(self) -> str:
+        return f"V('{ self.name }')"
+
+    def __hash__(self):
+        return id(self)
+
+    def _eq(self, other: Src):
+        return other is self
+
+    def addr_from(self, lay: ProvidesLayout) -> int:
+        raise BuildError("Virtual register is not allocated", self)
+
+    def repr_for(self, lay: ProvidesLayout):
+        return self.name
+
+
 class CodeAt(Mem):
     """Memory at instruction address, e.g. `M[label]` or `M[label + a]`"""
 
@@ -195,6 +242,36 @@ class Bytes(Inst):
         return cls(s)
 
 
+class Pad(Inst):
+    """Filler of the alignment gap. The gap of 2+ bytes starts with the `Br` over the rest,
+    so the vm skips it in a single step
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __repr__(self):
+        return f"Pad({ self.size })"
+
+    def encode_for(self, lay: ProvidesLayout, **kwargs) -> bytes:
+        return _padding(self.size)
+
+    def max_size(self) -> int:
+        return self.size
+
+
+def _padding(n: int) -> bytes:
+    nop = Nop.opcode.to_bytes(1, "little")
+    if n < 2:
+        return nop * n
+    for size in range(2, min(n, 1 + _MAX_VARINT_SIZE) + 1):
+        offset = Imm.encode(n - size)
+        if 1 + len(offset) == size:
+            return Br.opcode.to_bytes(1, "little") + offset + nop * (n - size)
+    # the offset is too short for the 2 bytes and too long for 3
+    return nop + _padding(n - 1)
+
+
 class DataExpr(Inst):
     """Expression to be placed in code as byte string,
     e.g. DataExpr(lab + 2) places into the code address of label + 2
@@ -227,6 +304,8 @@ class Label(ImmExpr):
     _seq = 0
 
     def __init__(self, name: str | None = None):
+        # auto-named labels are not the entry points
+        self.is_auto = not name
         if name:
             self.name = name
         else:
@@ -243,6 +322,36 @@ class Label(ImmExpr):
         return lay.addrof(self)
 
 
+def _absolute(offset: Src) -> ImmExpr:
+    """Address targeted by the branch offset as the immediate"""
+    assert isinstance(offset, ImmOffset)
+    tgt = offset.tgt
+    return tgt if isinstance(tgt, ImmExpr) else ImmAdd(tgt, 0)
+
+
+# The size of relative and absolute forms depends on the layout, so the shorter one
+# is chosen on every relaxation pass. The relative form is preferred on ties: it's position-independent
+class Goto(Br):
+    """Branch to the address. Encoded as the `Jmp` if it's shorter"""
+
+    def encode_for(self, lay: ProvidesLayout) -> bytes:
+        rel = super().encode_for(lay)
+        absolute = Jmp(_absolute(self.srcs[0])).encode_for(lay)
+        return absolute if len(absolute) < len(rel) else rel
+
+
+class Call(BrLnk):
+    """Branch-and-link to the address. Encoded as the `JmpLnk` if it's shorter"""
+
+    def __init__(self, addr: Inst | Mem | ImmExpr, lr: Tgt | None = None):
+        super().__init__(NamedReg("lr") if lr is None else lr, addr)
+
+    def encode_for(self, lay: ProvidesLayout) -> bytes:
+        rel = super().encode_for(lay)
+        absolute = JmpLnk(self.tgts[0], _absolute(self.srcs[0])).encode_for(lay)
+        return absolute if len(absolute) < len(rel) else rel
+
+
 class RegFactory:
     @overload
     def __getitem__(self, arg: int) -> Reg: ...
@@ -259,13 +368,15 @@ class MemFactory:
     @overload
     def __getitem__(self, obj: int) -> MemAddr: ...
     @overload
-    def __getitem__(self, obj: Mem | RhAB) -> IMem: ...
+    def __getitem__(self, obj: Mem) -> IMem: ...
+    @overload
+    def __getitem__(self, obj: RhAB | RhA) -> IMem | RhLoad: ...
     @overload
     def __getitem__(self, obj: Inst | ImmExpr) -> CodeAt: ...
 
     # TODO: write the correct generics for RhAB type.
     # Accepting the wide type with runtime checks for now.
-    def __getitem__(self, obj: Mem | RhAB | Inst | ImmExpr | int):
+    def __getitem__(self, obj: Mem | RhAB | RhA | Inst | ImmExpr | int):
         if isinstance(obj, int):
             return MemAddr(obj)
         if isinstance(obj, Mem):
@@ -280,6 +391,9 @@ class MemFactory:
                 return IMem(obj.a, -obj.b)
             if isinstance(obj.b, ImmExpr):
                 return IMem(obj.a, ImmSub(0, obj.b))
+        if isinstance(obj, (RhAB, RhA)):
+            # address is computed by the expression code, see `expr`
+            return RhLoad(obj)
         raise TypeError("Unsupported subscription type", obj)
 
 
@@ -1,10 +1,12 @@
 import random
+from array import array
 from typing import Final, Iterable, Iterator, Mapping, overload
 
-from .asm import Align, Directive, Label, NoPad
-from .core import Inst, Nop
+from .asm import Align, Directive, Label, NoPad, Pad
+from .core import Inst, Op
 from .env import Env
 from .exc import AddrError, BuildError, DetachedLabelError, DuplicateDefError, MissingDefError
+from .ir import Block
 
 # Monkeypatched by tests
 _FIX_OSCILLATIONS = True
@@ -20,12 +22,18 @@ class BuildCtx:
         self.env: Final = env
         # populated pre-build
         self.labels_by_inst: dict[Label, Inst] = {}
+        # labels inside the compound instructions (ir.Block): label -> (inst, row)
+        self.labels_in_rows: dict[Label, tuple[Inst, int]] = {}
         self.insts: list[Inst] = []
         # dynamic mappings Inst->int populated during the build
         self.addrs: dict[Inst, int] = {}
         self.sizes: dict[Inst, int] = {}
         self.aligns: dict[Inst, int] = {}
         self.nopads: set[Inst] = set()
+        # row offsets of the compound instructions
+        self.offsets: dict[Inst, array[int]] = {}
+        # bytes saved by the Env.optimize_layout against the default build
+        self.size_savings = 0
 
     def __iter__(self) -> Iterator[Inst]:
         yield from self.insts
@@ -48,16 +56,20 @@ class BuildCtx:
             except KeyError as e:
                 raise MissingDefError("No instruction", obj) from e
         if isinstance(obj, Label):
+            inst = self.labels_by_inst.get(obj)
+            if inst is not None:
+                return self.addrs[inst]
             try:
-                return self.addrs[self.labels_by_inst[obj]]
+                inst, row = self.labels_in_rows[obj]
+                return self.addrs[inst] + self.offsets[inst][row]
             except KeyError as e:
                 raise MissingDefError("No label", obj) from e
         # this one is slow !
         if isinstance(obj, str):
-            try:
-                return self.addrs[self.labels_by_name[obj]]
-            except KeyError as e:
-                raise MissingDefError("No label", obj) from e
+            for lab in self.labels:
+                if lab.name == obj:
+                    return self.addrof(lab)
+            raise MissingDefError("No label", obj)
 
         # check if address is valid: operands may use it
         if isinstance(obj, int):
@@ -75,16 +87,20 @@ class BuildCtx:
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, BuildCtx):
             return NotImplemented
-        return self.addrs == other.addrs
+        return self.addrs == other.addrs and self.offsets == other.offsets
 
     def clone(self):
         clone = BuildCtx(self.env)
         clone.labels_by_inst = self.labels_by_inst.copy()  # won't be changed in fact
+        clone.labels_in_rows = self.labels_in_rows.copy()  # won't be changed too
         clone.insts = self.insts.copy()
         clone.addrs = self.addrs.copy()
         clone.sizes = self.sizes.copy()
         clone.aligns = self.aligns.copy()
         clone.nopads = self.nopads.copy()
+        # arrays are replaced, not mutated by the next pass
+        clone.offsets = self.offsets.copy()
+        clone.size_savings = self.size_savings
 
         return clone
 
@@ -117,6 +133,11 @@ class BuildCtx:
         region = self.code_range
         return region[1] - region[0]
 
+    @property
+    def labels(self) -> list[Label]:
+        """All placed labels"""
+        return [*self.labels_by_inst, *self.labels_in_rows]
+
     @property
     def labels_by_name(self) -> dict[str, Inst]:
         """
@@ -150,10 +171,124 @@ def check(code: Iterable[Inst | Label | Directive]):
         if obj in dupeset:
             raise DuplicateDefError("Object is placed twice", obj)
         dupeset.add(obj)
+        # ops created under the deferred_checks
+        if isinstance(obj, Op):
+            obj.validate()
+        if isinstance(obj, Block):
+            for lab in obj.labels:
+                if lab in dupeset:
+                    raise DuplicateDefError("Object is placed twice", lab)
+                dupeset.add(lab)
     if insts_and_labels and isinstance(last_label := insts_and_labels[-1], Label):
         raise DetachedLabelError("Label must be followed by instruction", last_label)
 
 
+def _pass(lay: BuildCtx, start: int) -> None:
+    """Assign the addresses and sizes of instructions resolved by the previous layout"""
+    p = start
+    for inst in lay.insts:
+        p += -p % lay.aligns.get(inst, 1)
+        lay.addrs[inst] = p
+        size = inst.size_from(lay)
+        lay.sizes[inst] = size
+        p += size
+
+
+def _settle(lay: BuildCtx, start: int) -> BuildCtx | None:
+    """Stable layout reached from the `lay` with no oscillation fixes. None if not converged"""
+    passes: list[BuildCtx] = []
+    while len(passes) < lay.env.max_passes:
+        lay = lay.clone()
+        _pass(lay, start)
+        passes.append(lay)
+        if len(passes) >= 3 and passes[-1] == passes[-2] == passes[-3]:
+            return lay
+    return None
+
+
+def _placed(lay: BuildCtx, sizes: Mapping[Inst, int], start: int) -> BuildCtx:
+    """Copy of the layout with the instructions of assumed sizes"""
+    lay = lay.clone()
+    p = start
+    for inst in lay.insts:
+        p += -p % lay.aligns.get(inst, 1)
+        lay.addrs[inst] = p
+        lay.sizes[inst] = sizes[inst]
+        p += sizes[inst]
+    return lay
+
+
+def _grow(lay: BuildCtx, start: int) -> bool:
+    """Pass growing the sizes only. Returns True if anything is changed"""
+    changed = False
+    p = start
+    for inst in lay.insts:
+        p += -p % lay.aligns.get(inst, 1)
+        lay.addrs[inst] = p
+        size = inst.size_from(lay)
+        if size > lay.sizes[inst]:
+            lay.sizes[inst] = size
+            changed = True
+        p += lay.sizes[inst]
+    return changed
+
+
+# Combinations of the span-dependent sizes searched exhaustively
+_EXACT_LIMIT = 1024
+
+
+def _optimize(base: BuildCtx, aligns: Mapping[Inst, int], start: int) -> BuildCtx:
+    """The smallest layout found. The fixpoint iteration is starting from the largest sizes and may
+    stop at the larger solution than needed, e.g. the address immediate is long since the code is long.
+
+    The greedy growth is starting from the smallest sizes instead. Then, if the combinations of
+    span-dependent sizes (between the smallest and the default ones) are few, all of them are tried.
+    """
+    best = base
+    lay = base.clone()
+    lay.aligns = dict(aligns)
+
+    # greedy
+    lay = _placed(lay, dict.fromkeys(lay.insts, 1), start)
+    _grow(lay, start)
+    lows = dict(lay.sizes)
+    for _ in range(lay.env.max_passes):
+        if not _grow(lay, start):
+            greedy = _settle(lay, start)
+            if greedy is not None and greedy.size < best.size:
+                best = greedy
+            break
+
+    # exact. The padding is not counted by the bound
+    highs = {inst: max(base.sizes[inst], lay.sizes[inst]) for inst in lay.insts}
+    lows = {inst: min(lows[inst], highs[inst]) for inst in lay.insts}
+    spans = [inst for inst in lay.insts if lows[inst] < highs[inst]]
+    combinations = 1
+    for inst in spans:
+        combinations *= highs[inst] - lows[inst] + 1
+    if not spans or combinations > _EXACT_LIMIT:
+        return best
+    sizes = dict(lows)
+    fixed = sum(size for inst, size in lows.items() if inst not in spans)
+
+    def search(i: int, total: int):
+        nonlocal best
+        if total + sum(lows[inst] for inst in spans[i:]) >= best.size:
+            return
+        if i == len(spans):
+            found = _settle(_placed(lay, sizes, start), start)
+            if found is not None and found.size < best.size:
+                best = found
+            return
+        inst = spans[i]
+        for size in range(lows[inst], highs[inst] + 1):
+            sizes[inst] = size
+            search(i + 1, total + size)
+
+    search(0, fixed)
+    return best
+
+
 # it's the simple algo better implemented as a big function.
 # the flow is:
 # - 1) associate labels
@@ -163,7 +298,8 @@ def check(code: Iterable[Inst | Label | Directive]):
 #   three last passes must result in same layout.
 # - 5) if failed to find the solution due to oscillations, align(4) some randomly choosen instruction
 #   and try again.
-# - 6) fill the gaps left by aligns with 1-byte nops
+# - 5a) if requested by env, search for the smaller layout (see _optimize)
+# - 6) fill the gaps left by aligns with the pads skipped in one step
 def build(code: Iterable[Inst | Label | Directive], env: Env):
     lay = BuildCtx(env)
 
@@ -197,10 +333,15 @@ def build(code: Iterable[Inst | Label | Directive], env: Env):
             for lab in pending_labels:
                 lay.labels_by_inst[lab] = obj
             pending_labels.clear()
+            if isinstance(obj, Block):
+                lay.offsets[obj] = obj.max_offsets()
+                for lab, row in obj.labels.items():
+                    lay.labels_in_rows[lab] = (obj, row)
 
     # set it here once
     lay.insts = [item for item in code if isinstance(item, Inst)]
     passes: list[BuildCtx] = []
+    aligns = dict(lay.aligns)
 
     rnd: random.Random | None = None
 
@@ -210,13 +351,7 @@ def build(code: Iterable[Inst | Label | Directive], env: Env):
     # 3)
     # The loop logic is kinda hard to follow. Need to refactor it.
     while True:
-        p = start
-        for inst in lay.insts:
-            p += -p % lay.aligns.get(inst, 1)
-            lay.addrs[inst] = p
-            size = inst.size_from(lay)
-            lay.sizes[inst] = size
-            p += size
+        _pass(lay, start)
         passes.append(lay)
 
         if len(passes) >= 3 and passes[-1] == passes[-2] == passes[-3]:
@@ -241,6 +376,11 @@ def build(code: Iterable[Inst | Label | Directive], env: Env):
                     continue
             raise BuildError("Failed to converge", [it.size for it in passes])
 
+    if env.optimize_layout and lay.insts:
+        best = _optimize(lay, aligns, start)
+        best.size_savings = lay.size - best.size
+        lay = best
+
     # 5)
     if lay.aligns:
         # NOTE: the addresses dict is not in instruction (insertion) order no longer
@@ -248,14 +388,12 @@ def build(code: Iterable[Inst | Label | Directive], env: Env):
         p = start
         for inst in lay.insts:
             assigned_addr = lay.addrs[inst]
-            while p < assigned_addr:
-                nop = Nop()
-                patched.append(nop)
-                lay.addrs[nop] = p
-                size = nop.size_from(lay)
-                assert size == 1
-                lay.sizes[nop] = size
-                p += size
+            if p < assigned_addr:
+                pad = Pad(assigned_addr - p)
+                patched.append(pad)
+                lay.addrs[pad] = p
+                lay.sizes[pad] = pad.size_from(lay)
+                assert lay.sizes[pad] == pad.size
             patched.append(inst)
             p = assigned_addr + inst.size_from(lay)
         # rough patch !
@@ -0,0 +1,423 @@
+"""Control-flow graph of the flattened code.
+
+The code is split into the basic blocks. The block starts at the first instruction, at the
+labeled instruction (unless the label is auto-named and unused), at the referenced instruction
+and after the control transfer.
+Labels and directives preceding the instruction belong to its block.
+
+The indirect jumps (e.g. `Jmp(lr)`, `Jmp(M[R[0] + table])`) may lead to any block with the
+address taken and to any return point. The call (`BrLnk`, `JmpLnk`) has the edges to the callee
+and to the return point.
+
+The liveness analysis is tracking the registers only: the `R[...]` operands and the plain ram words
+(`M[8]` is `R[2]`, the unaligned `M[9]` is a part of `R[2]` and `R[3]`). The memory read via the pointer
+(the indirect operands, `LdM`) may be any of the registers referenced by the code, but the virtual ones.
+The stores via the pointer are not assumed to write anything. The stack (accessed via `sp`) never aliases
+the registers.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Iterable, Iterator, Sequence
+
+from .asm import Directive, Label, MemAddr, NamedReg, VReg
+from .core import Br, BrLnk, Exit, IMem, ImmOffset, Inst, Jmp, JmpLnk, LdM, Op, StB, StH, StM, _BranchIf, _Fused
+from .env import Env
+from .ir import MEM, OBJ, Block
+
+Item = Inst | Label | Directive
+Target = Inst | Label
+
+
+def _walk(obj: Any, root: Inst, out: list[Target], seen: set[int]):
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, Label):
+        out.append(obj)
+    elif isinstance(obj, Inst) and obj is not root:
+        out.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _walk(item, root, out, seen)
+    elif hasattr(obj, "__dict__"):
+        for item in vars(obj).values():
+            _walk(item, root, out, seen)
+
+
+def refs_of(inst: Inst, *, skip_target=False) -> list[Target]:
+    """Labels and instructions referenced by the operands of the instruction.
+    With `skip_target` the direct branch/jump target is not included
+    """
+    out: list[Target] = []
+    seen: set[int] = set()
+    if skip_target and isinstance(inst, Op):
+        target = branch_target(inst)
+        if target is not None:
+            seen.add(id(target))
+    _walk(inst, inst, out, seen)
+    return out
+
+
+def branch_target(op: Inst) -> Target | None:
+    """Direct target of the branch/jump/call. None if there is no target or it's not known statically"""
+    if isinstance(op, (_BranchIf, _Fused, Br, BrLnk)):
+        offset = op.srcs[-1]
+        if isinstance(offset, ImmOffset) and isinstance(offset.tgt, (Inst, Label)):
+            return offset.tgt
+        return None
+    if isinstance(op, (Jmp, JmpLnk)):
+        addr = op.srcs[0]
+        if isinstance(addr, (Inst, Label)):
+            return addr
+    return None
+
+
+def is_transfer(inst: Inst) -> bool:
+    """Instruction is ending the basic block"""
+    return not isinstance(inst, Op) or isinstance(inst, (_BranchIf, _Fused, Br, BrLnk, Jmp, JmpLnk, Exit, Block))
+
+
+def falls_through(inst: Inst) -> bool:
+    """Execution may continue with the next instruction"""
+    if isinstance(inst, (Br, Jmp, Exit)):
+        return False
+    # data
+    return isinstance(inst, Op) or isinstance(inst, Block)
+
+
+def is_indirect(inst: Inst) -> bool:
+    """Control is transferred to the unknown address"""
+    if isinstance(inst, Block):
+        return True
+    return isinstance(inst, (_BranchIf, _Fused, Br, BrLnk, Jmp, JmpLnk)) and branch_target(inst) is None
+
+
+class BasicBlock:
+    def __init__(self, index: int):
+        self.index = index
+        # leading labels and directives, instructions and trailing labels/directives if any
+        self.items: list[Item] = []
+        self.succs: list[BasicBlock] = []
+        self.preds: list[BasicBlock] = []
+        # has an edge to the unknown address
+        self.is_indirect = False
+
+    def __repr__(self):
+        return f"BasicBlock({ self.index }, { self.insts })"
+
+    @property
+    def insts(self) -> list[Inst]:
+        return [item for item in self.items if isinstance(item, Inst)]
+
+    @property
+    def labels(self) -> list[Label]:
+        return [item for item in self.items if isinstance(item, Label)]
+
+    @property
+    def first(self) -> Inst | None:
+        return next((item for item in self.items if isinstance(item, Inst)), None)
+
+    @property
+    def last(self) -> Inst | None:
+        return next((item for item in reversed(self.items) if isinstance(item, Inst)), None)
+
+
+class CFG:
+    def __init__(self, code: Sequence[Item]):
+        self.blocks: list[BasicBlock] = []
+        self.block_of: dict[Target, BasicBlock] = {}
+        # blocks which address is used as a value: may be reached by the indirect jumps
+        self.address_taken: set[BasicBlock] = set()
+        # blocks following the calls. Reached by the indirect jumps (returns) too
+        self.return_points: set[BasicBlock] = set()
+
+        self._split(code)
+        self._link()
+
+    def __iter__(self) -> Iterator[BasicBlock]:
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _split(self, code: Sequence[Item]):
+        insts = [item for item in code if isinstance(item, Inst)]
+        referenced: set[Inst] = set()
+        # ids of the referenced labels
+        used: set[int] = set()
+        for inst in insts:
+            for ref in refs_of(inst):
+                if isinstance(ref, Inst):
+                    referenced.add(ref)
+                else:
+                    used.add(id(ref))
+
+        block: BasicBlock | None = None
+        pending: list[Item] = []
+        is_leader = True
+        was_data = False
+        for item in code:
+            if not isinstance(item, Inst):
+                # the unused auto label is not an entry
+                if isinstance(item, Label) and (not item.is_auto or id(item) in used):
+                    is_leader = True
+                pending.append(item)
+                continue
+            # data is never a part of the code block. The consecutive data is kept together (e.g. tables)
+            is_data = not isinstance(item, (Op, Block))
+            if is_data and was_data:
+                is_leader = False
+            was_data = is_data
+            if is_leader or block is None or item in referenced:
+                block = BasicBlock(len(self.blocks))
+                self.blocks.append(block)
+            block.items.extend(pending)
+            block.items.append(item)
+            for obj in pending:
+                if isinstance(obj, Label):
+                    self.block_of[obj] = block
+            pending.clear()
+            self.block_of[item] = block
+            if isinstance(item, Block):
+                for lab in item.labels:
+                    self.block_of[lab] = block
+            is_leader = is_transfer(item)
+
+        if pending:
+            if block is None:
+                block = BasicBlock(0)
+                self.blocks.append(block)
+            block.items.extend(pending)
+            for obj in pending:
+                if isinstance(obj, Label):
+                    self.block_of[obj] = block
+
+    def _link(self):
+        blocks = self.blocks
+        for block in blocks:
+            last = block.last
+            for inst in block.insts:
+                for ref in refs_of(inst, skip_target=True):
+                    target = self.block_of.get(ref)
+                    if target is not None:
+                        self.address_taken.add(target)
+
+            if last is None:
+                continue
+            target = branch_target(last)
+            if target is not None and target in self.block_of:
+                block.succs.append(self.block_of[target])
+            block.is_indirect = is_indirect(last)
+            if falls_through(last) and block.index + 1 < len(blocks):
+                nxt = blocks[block.index + 1]
+                if nxt not in block.succs:
+                    block.succs.append(nxt)
+                if isinstance(last, (BrLnk, JmpLnk)):
+                    self.return_points.add(nxt)
+
+        indirect_targets = sorted(self.address_taken | self.return_points, key=lambda b: b.index)
+        for block in blocks:
+            if block.is_indirect:
+                block.succs.extend(b for b in indirect_targets if b not in block.succs)
+            for succ in block.succs:
+                succ.preds.append(block)
+
+    @property
+    def entries(self) -> list[BasicBlock]:
+        """Blocks reachable from the outside: the first one, the named labels and the address-taken"""
+        out: list[BasicBlock] = []
+        if self.blocks:
+            out.append(self.blocks[0])
+        for block in self.blocks:
+            if any(not lab.is_auto for lab in block.labels):
+                out.append(block)
+            elif block in self.address_taken:
+                out.append(block)
+        return out
+
+    def reachable(self) -> set[BasicBlock]:
+        seen: set[BasicBlock] = set()
+        stack = list(self.entries)
+        while stack:
+            block = stack.pop()
+            if block in seen:
+                continue
+            seen.add(block)
+            stack.extend(block.succs)
+        return seen
+
+    def code(self, blocks: Iterable[BasicBlock] | None = None) -> list[Item]:
+        """Flattened code of the blocks"""
+        return [item for block in (self.blocks if blocks is None else blocks) for item in block.items]
+
+
+# Register key: the address or the virtual register itself
+RegKey = int | VReg
+
+
+def reg_key(opd: Any, env: Env) -> RegKey | None:
+    """Key of the register operand"""
+    if isinstance(opd, MemAddr):
+        if type(opd) is not MemAddr:
+            return opd._addr
+        # ram word is the register
+        keys = reg_keys(opd, env)
+        return keys[0] if keys == [opd._addr] else None
+    if isinstance(opd, VReg):
+        return opd
+    if isinstance(opd, NamedReg):
+        n = env.named_registers.get(opd.name)
+        return None if n is None else n * 4
+    return None
+
+
+def reg_keys(opd: Any, env: Env) -> list[RegKey]:
+    """Keys of the registers covered by the operand. The unaligned plain memory (e.g. `M[9]`) covers two of them"""
+    if type(opd) is not MemAddr:
+        key = reg_key(opd, env)
+        return [] if key is None else [key]
+    lo, hi = env.ram_region
+    addr = opd._addr
+    first = addr - addr % 4
+    return [word for word in (first, first + 4) if word < addr + 4 and lo <= word < hi]
+
+
+def _regs_in(obj: Any, env: Env, out: set[RegKey], seen: set[int]):
+    if id(obj) in seen or isinstance(obj, (Inst, Label)):
+        return
+    seen.add(id(obj))
+    keys = reg_keys(obj, env)
+    if keys:
+        out.update(keys)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _regs_in(item, env, out, seen)
+    elif hasattr(obj, "__dict__"):
+        for item in vars(obj).values():
+            _regs_in(item, env, out, seen)
+
+
+def _is_stack(ref: Any, env: Env) -> bool:
+    sp = env.named_registers.get("sp")
+    return sp is not None and reg_key(ref, env) == sp * 4
+
+
+def _pointed(opd: Any, env: Env) -> bool:
+    """Operand is reading the memory via the pointer, but the stack"""
+    if not isinstance(opd, IMem):
+        return False
+    return not _is_stack(opd.ref, env) or _pointed(opd.offset, env)
+
+
+def via_pointer(inst: Inst, env: Env) -> tuple[bool, bool]:
+    """Instruction is reading, writing the memory via the pointer (the indirect operands, `LdM`, `StM`),
+    but the stack
+    """
+    if isinstance(inst, Block):
+        found = any(isinstance(ref, IMem) for ref in inst.refs) or any(
+            issubclass(cls, (LdM, StM)) for cls in inst.classes.values()
+        )
+        return found, found
+    if not isinstance(inst, Op):
+        return False, False
+    reads = isinstance(inst, LdM) and not _is_stack(inst.srcs[0], env)
+    reads = reads or any(_pointed(src, env) for src in inst.srcs)
+    # doubly indirect target reads the offset
+    reads = reads or any(isinstance(tgt, IMem) and _pointed(tgt.offset, env) for tgt in inst.tgts)
+    writes = isinstance(inst, StM) and not _is_stack(inst.srcs[0], env)
+    writes = writes or any(isinstance(tgt, IMem) and not _is_stack(tgt.ref, env) for tgt in inst.tgts)
+    return reads, writes
+
+
+def uses_defs(inst: Inst, env: Env, aliased: Iterable[RegKey] = ()) -> tuple[set[RegKey], set[RegKey]]:
+    """Registers read and written by the instruction.
+    The memory read via the pointer is assumed to be any of the `aliased` registers
+    """
+    uses: set[RegKey] = set()
+    defs: set[RegKey] = set()
+    if via_pointer(inst, env)[0]:
+        uses.update(aliased)
+    if isinstance(inst, Op):
+        seen: set[int] = set()
+        for tgt in inst.tgts:
+            keys = reg_keys(tgt, env)
+            if keys:
+                defs.update(keys)
+                # partial store keeps the rest of register
+                if isinstance(inst, (StB, StH)) or reg_key(tgt, env) is None:
+                    uses.update(keys)
+            elif isinstance(tgt, IMem):
+                _regs_in(tgt, env, uses, seen)
+        _regs_in(inst.srcs, env, uses, seen)
+    elif isinstance(inst, Block):
+        # conservative: everything is used, nothing is surely written
+        uses.update(v for kind, v in zip(inst.kinds, inst.values, strict=True) if kind == MEM)
+        for ref in inst.refs:
+            _regs_in(ref, env, uses, set())
+    return uses, defs
+
+
+def writes(inst: Inst, env: Env) -> set[RegKey]:
+    """Registers possibly written by the instruction"""
+    if isinstance(inst, Block):
+        out: set[RegKey] = set()
+        for row in range(len(inst)):
+            first = inst.starts[row]
+            for i in range(first, first + inst.ntgts[row]):
+                kind = inst.kinds[i]
+                if kind == MEM:
+                    out.add(inst.values[i])
+                elif kind == OBJ and (key := reg_key(inst.refs[inst.values[i]], env)) is not None:
+                    out.add(key)
+        return out
+    return uses_defs(inst, env)[1]
+
+
+def host_registers(cfg: CFG, env: Env) -> set[RegKey]:
+    """Registers referenced by the code, but the virtual ones. These may be accessed via the pointer"""
+    out: set[RegKey] = set()
+    for block in cfg:
+        for inst in block.insts:
+            uses, defs = uses_defs(inst, env)
+            out |= {key for key in uses | defs if not isinstance(key, VReg)}
+    return out
+
+
+def liveness(cfg: CFG, env: Env) -> tuple[dict[BasicBlock, set[RegKey]], dict[BasicBlock, set[RegKey]]]:
+    """Registers live at the entry and the exit of each block.
+    All registers (but the virtual ones) are live at `Exit` and at the end of code since the host may inspect them
+    """
+    host_regs = host_registers(cfg, env)
+    gen: dict[BasicBlock, set[RegKey]] = {}
+    kill: dict[BasicBlock, set[RegKey]] = {}
+    exits: set[BasicBlock] = set()
+    for block in cfg:
+        g: set[RegKey] = set()
+        k: set[RegKey] = set()
+        for inst in reversed(block.insts):
+            uses, defs = uses_defs(inst, env, host_regs)
+            g -= defs
+            k |= defs
+            g |= uses
+        gen[block] = g
+        kill[block] = k
+        last = block.last
+        if isinstance(last, Exit) or (block is cfg.blocks[-1] and last is not None and falls_through(last)):
+            exits.add(block)
+
+    live_in: dict[BasicBlock, set[RegKey]] = {block: set() for block in cfg}
+    live_out: dict[BasicBlock, set[RegKey]] = {block: set() for block in cfg}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(cfg.blocks):
+            out: set[RegKey] = set(host_regs) if block in exits else set()
+            for succ in block.succs:
+                out |= live_in[succ]
+            in_ = gen[block] | (out - kill[block])
+            if in_ != live_in[block] or out != live_out[block]:
+                live_in[block] = in_
+                live_out[block] = out
+                changed = True
+    return live_in, live_out
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import contextlib
+import copy
 import functools
 from _thread import get_ident
+from contextvars import ContextVar
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     ClassVar,
     Final,
+    Iterator,
     Literal,
     Protocol,
     Sequence,
@@ -20,6 +24,8 @@ from .exc import CycleError
 CmpKind = Literal["==", "!=", "<", ">", "<=", ">="]
 Tgt = Union["Mem", "IMem"]
 Src = Union["Mem", "IMem", "ImmExpr", int]
+# nodes of the expression trees
+Rh = Union["RhAB", "RhA", "RhLoad"]
 
 # The typecheckers are good at ABC checks: no need them in runtime
 if TYPE_CHECKING:
@@ -43,6 +49,9 @@ _IMM_RANGE = [_S32_MIN, _S32_MAX + 1]
 
 _MAX_VARINT_SIZE = 5
 
+# Set by the deferred_checks. Per thread (and task), so the other builds are still checked
+_DEFER_CHECKS: ContextVar[bool] = ContextVar("_DEFER_CHECKS", default=False)
+
 
 # This Layout protocol really should require
 # addrof/sizeof only. Other fields are unused by the core
@@ -119,6 +128,31 @@ def _ensure_not_bool(obj: Any):
         raise TypeError("Bool operand is not allowed. Use int(val) if it's the intent")
 
 
+@contextlib.contextmanager
+def deferred_checks() -> Iterator[None]:
+    """Skip the operand checks while constructing ops inside the block.
+
+    Ops are validated (and int sources promoted to Imm) just once, by the builder.
+    Useful for generating huge amounts of code. Affects the current thread only.
+    """
+    token = _DEFER_CHECKS.set(True)
+    try:
+        yield
+    finally:
+        _DEFER_CHECKS.reset(token)
+
+
+def _promote_srcs(srcs: Sequence[Src]) -> list[Mem | IMem | ImmExpr | Imm]:
+    srcs_: list[Mem | IMem | ImmExpr | Imm] = []
+    for src in srcs:
+        _ensure_not_bool(src)
+        if isinstance(src, int):
+            check_range(src, _IMM_RANGE)
+            src = Imm(src)
+        srcs_.append(src)
+    return srcs_
+
+
 def encode_varint(val: int):
     assert val >= 0
     nbytes = ((val.bit_length() + 6) // 7) or 1
@@ -290,8 +324,65 @@ class ImmOffset(ImmExpr):
         self.tgt.check_against(lay)
 
 
+class _TreeOps:
+    """Arithmetic operators of the operands and the right-hands. The right-hands nest into the expression trees,
+    e.g. `(R[1] + R[2]) * R[3]`
+    """
+
+    def __add__(self: Any, other: Src | Rh):
+        return RhAB(Add, self, other)
+
+    def __radd__(self: Any, other: Src | Rh):
+        return RhAB(Add, other, self)
+
+    def __sub__(self: Any, other: Src | Rh):
+        return RhAB(Sub, self, other)
+
+    def __rsub__(self: Any, other: Src | Rh):
+        return RhAB(Sub, other, self)
+
+    def __mul__(self: Any, other: Src | Rh):
+        return RhAB(Mul, self, other)
+
+    def __rmul__(self: Any, other: Src | Rh):
+        return RhAB(Mul, other, self)
+
+    def __floordiv__(self: Any, other: Src | Rh):
+        return RhAB(Div, self, other)
+
+    def __truediv__(self: Any, other: Src | Rh):
+        return RhAB(Div, self, other)
+
+    def __mod__(self: Any, other: Src | Rh):
+        return RhAB(Rem, self, other)
+
+    def __lshift__(self: Any, other: Src | Rh):
+        return RhAB(LShift, self, other)
+
+    def __rshift__(self: Any, other: Src | Rh):
+        return RhAB(RShift, self, other)
+
+    def __and__(self: Any, other: Src | Rh):
+        return RhAB(BitAnd, self, other)
+
+    def __xor__(self: Any, other: Src | Rh):
+        return RhAB(BitXor, self, other)
+
+    def __or__(self: Any, other: Src | Rh):
+        return RhAB(BitOr, self, other)
+
+    def __neg__(self: Any):
+        return RhA(Neg, self)
+
+    def __abs__(self: Any):
+        return RhA(Abs, self)
+
+    def __invert__(self: Any):
+        return RhA(Inv, self)
+
+
 # NOTE: There is no way I know of typing such a mixin without resorting to self: Any
-class RichOpsMixin:
+class RichOpsMixin(_TreeOps):
     # to be defined in concrete class for the boolean __eq__ testing
     def _eq(self, other: Src) -> bool:
         return False
@@ -336,51 +427,14 @@ class RichOpsMixin:
     def __ge__(self: Any, other: Src) -> Comparison:
         return Comparison(">=", self, other)
 
-    def __add__(self: Any, other: Src):
-        return RhAB(Add, self, other)
-
-    def __sub__(self: Any, other: Src):
-        return RhAB(Sub, self, other)
-
-    def __mul__(self: Any, other: Src):
-        return RhAB(Mul, self, other)
-
-    def __floordiv__(self: Any, other: Src):
-        return RhAB(Div, self, other)
-
-    def __truediv__(self: Any, other: Src):
-        return RhAB(Div, self, other)
-
-    def __mod__(self: Any, other: Src):
-        return RhAB(Rem, self, other)
-
-    def __lshift__(self: Any, other: Src):
-        return RhAB(RShiftU, self, other)
-
-    def __rshift__(self: Any, other: Src):
-        return RhAB(RShift, self, other)
-
-    def __and__(self: Any, other: Src):
-        return RhAB(BitAnd, self, other)
-
-    def __xor__(self: Any, other: Src):
-        return RhAB(BitXor, self, other)
-
-    def __or__(self: Any, other: Src):
-        return RhAB(BitOr, self, other)
-
-    def __neg__(self: Any):
-        return RhA(Neg, self)
-
-    def __abs__(self: Any):
-        return RhA(Abs, self)
-
-    def __invert__(self: Any):
-        return RhA(Inv, self)
-
-    def set(self: Any, rh: int | Mem | IMem | RhA | RhAB | Comparison | ImmExpr):
+    def set(self: Any, rh: int | Mem | IMem | RhA | RhAB | RhLoad | Comparison | ImmExpr):
         if isinstance(rh, (int, Mem, IMem, ImmExpr)):
             return Mov(self, rh)
+        if isinstance(rh, (RhA, RhAB, RhLoad)) and rh.is_nested:
+            # expression trees need the temporaries (virtual registers) defined on top of the core
+            from .expr import compile_expr
+
+            return compile_expr(self, rh)
         if isinstance(rh, RhA):
             return rh.as_assign_to(self)
         if isinstance(rh, (RhAB, Comparison)):
@@ -415,6 +469,18 @@ class Comparison:
         }
         return map[self.kind](t, self.a, self.b)
 
+    def as_move_to(self, t: Tgt, x: Src, y: Src) -> _MoveIf:
+        """t = x if a op b else y"""
+        map = {
+            "==": MovEq,
+            "!=": MovNe,
+            "<": MovLt,
+            "<=": MovLe,
+            ">": MovGt,
+            ">=": MovGe,
+        }
+        return map[self.kind](t, self.a, self.b, x, y)
+
     def as_if_branch_to(self, addr: Inst | Mem | ImmExpr) -> _BranchIf:
         map = {
             "==": BrEq,
@@ -438,14 +504,18 @@ class Comparison:
         return map[self.kind](self.a, self.b, addr)
 
 
-class RhAB:
+class RhAB(_TreeOps):
     """Represents right-hand of `t = a op b` operation"""
 
-    def __init__(self, op: type[_TAB], a: Src, b: Src):
+    def __init__(self, op: type[_TAB], a: Src | Rh, b: Src | Rh):
         self.op: Final = op
         self.a: Final = a
         self.b: Final = b
 
+    @property
+    def is_nested(self) -> bool:
+        return isinstance(self.a, (RhAB, RhA, RhLoad)) or isinstance(self.b, (RhAB, RhA, RhLoad))
+
     def __eq__(self, other: object):
         if not isinstance(other, RhAB):
             return NotImplemented
@@ -459,13 +529,17 @@ class RhAB:
         return self.op(t, self.a, self.b)
 
 
-class RhA:
+class RhA(_TreeOps):
     """Represents right-hand of `t = a` operation"""
 
-    def __init__(self, op: type[_TA], a: Src):
+    def __init__(self, op: type[_TA], a: Src | Rh):
         self.op: Final = op
         self.a: Final = a
 
+    @property
+    def is_nested(self) -> bool:
+        return isinstance(self.a, (RhAB, RhA, RhLoad))
+
     @repr_or_fallback
     def __repr__(self):
         return f"= { self.op !r}({ self.a !r})"
@@ -479,6 +553,24 @@ class RhA:
         return self.op(t, self.a)
 
 
+class RhLoad(_TreeOps):
+    """Represents the word at the computed address, e.g. `M[(R[0] + R[1]) * 4]`"""
+
+    is_nested = True
+
+    def __init__(self, addr: RhAB | RhA):
+        self.addr: Final = addr
+
+    @repr_or_fallback
+    def __repr__(self):
+        return f"Mem[{ self.addr !r}]"
+
+    def set(self, rh: Src | Rh):
+        from .expr import compile_expr
+
+        return compile_expr(self, rh)
+
+
 class Mem(RichOpsMixin, TypecheckedABC):
     @typechecked_abstractmethod
     def addr_from(self, lay: ProvidesLayout) -> int:
@@ -590,20 +682,41 @@ class Op(Inst):
     opcode: ClassVar[int]  # provided by concrete classes
     is_vartgt: ClassVar[int] = False
     is_varsrc: ClassVar[int] = False
+    # sources may be reordered
+    is_commutative: ClassVar[bool] = False
+    # sources are not checked yet (constructed under the deferred_checks)
+    is_raw = False
 
     def __init__(self, tgts: tuple[Tgt, ...], srcs: tuple[Src, ...]):
-        # promoting ints of sources to the Imms
-        srcs_: list[Mem | IMem | ImmExpr | Imm] = []
-        for src in srcs:
-            _ensure_not_bool(src)
-            if isinstance(src, int):
-                check_range(src, _IMM_RANGE)
-                src = Imm(src)
-            srcs_.append(src)
+        srcs_: list[Any]
+        if _DEFER_CHECKS.get():
+            srcs_ = list(srcs)
+            self.is_raw = True
+        else:
+            # promoting ints of sources to the Imms
+            srcs_ = _promote_srcs(srcs)
 
         self.tgts: Final = tgts
         self.srcs: Final = srcs_
 
+    def copy_with(self, *, tgts: Sequence[Tgt] | None = None, srcs: Sequence[Src] | None = None):
+        """Copy of the op with the operands replaced.
+        Offsets relative to this op (branch targets) are rebased to the copy
+        """
+        new = copy.copy(self)
+        srcs_ = [
+            ImmOffset(new, src.tgt) if isinstance(src, ImmOffset) and src.base is self else src
+            for src in (self.srcs if srcs is None else srcs)
+        ]
+        Op.__init__(new, tuple(self.tgts if tgts is None else tgts), tuple(srcs_))
+        return new
+
+    def validate(self):
+        """Run the checks skipped under the deferred_checks"""
+        if self.is_raw:
+            self.srcs[:] = _promote_srcs(self.srcs)
+            self.is_raw = False
+
     @repr_or_fallback
     def __repr__(self):
         ops = ", ".join(repr(op) for op in [*self.tgts, *self.srcs])
@@ -626,11 +739,17 @@ class Op(Inst):
         # Trying to apply rmw optimization.
         # Comparison of operand objects may fail if they are not implementing
         # __eq__ correclty. The robust way is to compare the resulting encoding.
-        is_rmw = (
-            self.srcs
-            and self.tgts
-            and self.srcs[0].encode_for(lay, as_src=True) == self.tgts[0].encode_for(lay, as_src=True)
-        )
+        srcs = self.srcs
+        is_rmw = False
+        if srcs and self.tgts:
+            tgt = self.tgts[0].encode_for(lay, as_src=True)
+            candidates = srcs if self.is_commutative else srcs[:1]
+            encoded = [src.encode_for(lay, as_src=True) for src in candidates]
+            if tgt in encoded:
+                # commutative op is reading the target first
+                i = encoded.index(tgt)
+                srcs = [srcs[i], *srcs[:i], *srcs[i + 1 :]]
+                is_rmw = True
 
         mop = self.opcode
         assert not (mop & 0x80)
@@ -645,7 +764,7 @@ class Op(Inst):
         if self.is_varsrc:
             parts.append(Imm.encode(len(self.srcs)))
 
-        include_srcs = self.srcs[1:] if is_rmw else self.srcs
+        include_srcs = srcs[1:] if is_rmw else srcs
         parts.extend([opd.encode_for(lay, as_src=True) for opd in include_srcs])
 
         return b"".join(parts)
@@ -729,6 +848,31 @@ class _MoveIf(Op):
         return cls(t, a, b, y, x)
 
 
+# Superinstruction is the `first` op followed by the `second` conditional branch, with the result of first
+# being the `slot` source of the branch. The operands are the first's ones followed by the remaining
+# branch ones. Concrete classes are generated by the scripts/build_superinsts.py
+class _Fused(Op):
+    first: ClassVar[type[_TA] | type[_TAB]]
+    second: ClassVar[type[_BranchIf]]
+    slot: ClassVar[int]
+
+    def __init__(self, t: Tgt, *args: Any):
+        *srcs, addr = args
+        super().__init__((t,), (*srcs, ImmOffset(self, addr)))
+        # replaced pair, to keep the profiles
+        self.origin: tuple[Op, Op] | None = None
+
+    @classmethod
+    def from_pair(cls, a: Op, b: Op, slot: int) -> _Fused:
+        """Superinstruction replacing the op `a` and the branch `b` reading the result as the source `slot`"""
+        offset = b.srcs[-1]
+        assert isinstance(offset, ImmOffset)
+        rest = [src for i, src in enumerate(b.srcs[:-1]) if i != slot]
+        new = cls(a.tgts[0], *a.srcs, *rest, offset.tgt)
+        new.origin = (a, b)
+        return new
+
+
 # base command set
 
 
@@ -750,7 +894,7 @@ class Add(_TAB):
     t = a + b
     """
 
-    pass
+    is_commutative = True
 
 
 class Sub(_TAB):
@@ -770,7 +914,7 @@ class Mul(_TAB):
     t = a * b
     """
 
-    pass
+    is_commutative = True
 
 
 class Div(_TAB):
@@ -856,6 +1000,8 @@ class BitAnd(_TAB):
     t = a & b
     """
 
+    is_commutative = True
+
 
 class BitOr(_TAB):
     """
@@ -864,7 +1010,7 @@ class BitOr(_TAB):
     t = a | b
     """
 
-    pass
+    is_commutative = True
 
 
 class BitXor(_TAB):
@@ -874,7 +1020,7 @@ class BitXor(_TAB):
     t = a ^ b
     """
 
-    pass
+    is_commutative = True
 
 
 class Inv(_TA):
@@ -932,7 +1078,7 @@ class TstEq(_TAB):
     t = a == b
     """
 
-    pass
+    is_commutative = True
 
 
 class TstNe(_TAB):
@@ -942,7 +1088,7 @@ class TstNe(_TAB):
     t = a != b
     """
 
-    pass
+    is_commutative = True
 
 
 class TstGt(_TAB):
@@ -1509,7 +1655,7 @@ class Max(_TVarSrc):
     t = max(s[0], ..., s[n-1])
     """
 
-    pass
+    is_commutative = True
 
 
 class Min(_TVarSrc):
@@ -1519,7 +1665,7 @@ class Min(_TVarSrc):
     t = min(s[0], ..., s[n-1])
     """
 
-    pass
+    is_commutative = True
 
 
 class Not(_TA):
@@ -1570,6 +1716,94 @@ class LongMulU(Op):
         super().__init__((tl, th), (a, b))
 
 
+class StM(Op):
+    """
+    t, n+1, a, s[0], ..., s[n-1]
+
+    t = a - 4 * n
+    mem[t + 4 * i] = s[i]
+
+    store multiple words below the address, e.g. push to the stack
+    """
+
+    is_varsrc = True
+
+    def __init__(self, t: Tgt, a: Src, *s: Src):
+        super().__init__((t,), (a, *s))
+
+
+class LdM(Op):
+    """
+    m+1, t, t[0], ..., t[m-1], a, b
+
+    t[i] = mem[a + 4 * i]
+    t = a + b
+
+    load multiple words from the address, e.g. pop from the stack
+    """
+
+    is_vartgt = True
+
+    def __init__(self, t: Tgt, tgts: Sequence[Tgt], a: Src, b: Src):
+        super().__init__((t, *tgts), (a, b))
+
+
+# <superinstructions>
+class AddBrGt(_Fused):
+    """
+    t, a, b, c, offset
+
+    t = a + b
+    if t > c then pc += offset
+    """
+
+    first = Add
+    second = BrGt
+    slot = 0
+
+
+class AddBrLt(_Fused):
+    """
+    t, a, b, c, offset
+
+    t = a + b
+    if c > t then pc += offset
+    """
+
+    first = Add
+    second = BrGt
+    slot = 1
+
+
+class SubBrNe(_Fused):
+    """
+    t, a, b, c, offset
+
+    t = a - b
+    if t != c then pc += offset
+    """
+
+    first = Sub
+    second = BrNe
+    slot = 0
+
+
+class TstEqBrNe(_Fused):
+    """
+    t, a, b, c, offset
+
+    t = a == b
+    if t != c then pc += offset
+    """
+
+    first = TstEq
+    second = BrNe
+    slot = 0
+
+
+# </superinstructions>
+
+
 # some conditional ops may be formulated via another with the arguments swapped
 TstLt = TstGt.from_ab_swap
 TstLe = TstGe.from_ab_swap
@@ -1663,4 +1897,10 @@ Not.opcode = 68
 Bool.opcode = 69
 LongMul.opcode = 70
 LongMulU.opcode = 71
+StM.opcode = 72
+LdM.opcode = 73
+AddBrGt.opcode = 74
+AddBrLt.opcode = 75
+SubBrNe.opcode = 76
+TstEqBrNe.opcode = 77
 # </opcodes>
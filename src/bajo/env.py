@@ -1,4 +1,4 @@
-from typing import Mapping
+from typing import Iterable, Mapping
 
 
 class Env:
@@ -9,6 +9,9 @@ class Env:
         code_region: tuple[int, int],
         named_registers: Mapping[str, int],
         max_passes: int = 16,
+        scratch_registers: Iterable[int] = (),
+        superinstructions: bool = False,
+        optimize_layout: bool = False,
     ):
         c = code_region
         r = ram_region
@@ -31,3 +34,9 @@ class Env:
         self.code_region = c
         self.max_passes = max_passes
         self.named_registers = named_registers
+        # register numbers available for the virtual registers
+        self.scratch_registers = tuple(scratch_registers)
+        # vm supports the superinstructions (core._Fused)
+        self.superinstructions = superinstructions
+        # search for the smaller layout than the default build
+        self.optimize_layout = optimize_layout
@@ -28,3 +28,7 @@ class CycleError(BajoError):
 
 class DirectiveError(BajoError):
     pass
+
+
+class ImageError(BajoError):
+    pass
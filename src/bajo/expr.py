@@ -0,0 +1,171 @@
+"""Expression trees.
+
+The nested right-hands, e.g. `R[0].set((R[1] + R[2]) * M[R[3] + R[4] * 4])`, are compiled to the plain ops.
+The constant subtrees are folded to the immediates. The subtrees are evaluated in Sethi-Ullman order
+(the one needing more temporaries first). The target holds the intermediate results if it's not read later,
+so the ops are mostly the read-modify-write forms. The other intermediates are kept in the temporaries:
+the fresh virtual registers (allocated from the `Env.scratch_registers`) or the explicit `tmps`.
+The words at the `a + b` and `a - n` addresses are read via the indirect operands, with no address computation.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Sequence
+
+from .asm import MemFactory, NamedReg, Reg, VReg
+from .core import Add, IMem, Imm, ImmExpr, ImmSub, Mem, Mov, Op, RhA, RhAB, RhLoad, Sub, Tgt
+from .exc import BuildError
+from .opt import fold
+
+_TREES = (RhAB, RhA, RhLoad)
+
+_M = MemFactory()
+
+
+def _is_reg(opd: Any) -> bool:
+    return isinstance(opd, Mem)
+
+
+def _may_alias(a: Mem, b: Mem) -> bool:
+    if bool(a._eq(b)):
+        return True
+    # named register number is unknown until the build
+    named = (NamedReg, Reg)
+    return isinstance(a, NamedReg) and isinstance(b, named) or isinstance(b, NamedReg) and isinstance(a, named)
+
+
+def _reads(node: Any, m: Mem) -> bool:
+    """Node reads the memory `m`"""
+    if isinstance(node, RhAB):
+        return _reads(node.a, m) or _reads(node.b, m)
+    if isinstance(node, RhA):
+        return _reads(node.a, m)
+    if isinstance(node, RhLoad):
+        return _reads(node.addr, m)
+    if isinstance(node, IMem):
+        return _reads(node.ref, m) or _reads(node.offset, m)
+    return isinstance(node, Mem) and _may_alias(node, m)
+
+
+def _need(node: Any) -> int:
+    """Number of the registers to evaluate the node (Sethi-Ullman number). Leaves are the operands as is"""
+    if isinstance(node, RhAB):
+        a, b = _need(node.a), _need(node.b)
+        return max(1, a + 1 if a == b else max(a, b))
+    if isinstance(node, RhA):
+        return max(1, _need(node.a))
+    if isinstance(node, RhLoad):
+        return max(1, _need(node.addr))
+    return 0
+
+
+def folded(node: Any) -> Any:
+    """Node with the constant subtrees replaced by the immediates"""
+    if isinstance(node, RhAB):
+        a, b = folded(node.a), folded(node.b)
+        if isinstance(a, int) and isinstance(b, int):
+            res = fold(node.op(Reg(0), Imm(a), Imm(b)))
+            if res is not None:
+                return res
+        return RhAB(node.op, a, b)
+    if isinstance(node, RhA):
+        a = folded(node.a)
+        if isinstance(a, int):
+            res = fold(node.op(Reg(0), Imm(a)))
+            if res is not None:
+                return res
+        return RhA(node.op, a)
+    if isinstance(node, RhLoad):
+        # the folded address may fit the plain operand
+        addr = folded(node.addr)
+        return addr if isinstance(addr, RhLoad) else _M[addr]
+    return node
+
+
+class _Gen:
+    def __init__(self, tmps: Sequence[Mem] | None):
+        self.ops: list[Op] = []
+        self.explicit = tmps is not None
+        self.free: list[Mem] = list(tmps or [])
+        self.temps: set[int] = {id(tmp) for tmp in self.free}
+
+    def take(self) -> Mem:
+        if self.free:
+            return self.free.pop()
+        if self.explicit:
+            raise BuildError("Out of temporaries for the expression")
+        tmp = VReg()
+        self.temps.add(id(tmp))
+        return tmp
+
+    def give(self, *opds: Any, keep: Any):
+        """Temporaries are free again, but the `keep` holding the result"""
+        for opd in opds:
+            if isinstance(opd, IMem):
+                self.give(opd.ref, opd.offset, keep=keep)
+            elif opd is not keep and id(opd) in self.temps and not any(tmp is opd for tmp in self.free):
+                self.free.append(opd)
+
+    def operands(self, kids: list[Any], place: Mem | None, regs: Sequence[int] = ()) -> list[Any]:
+        """Operands for the kids. The subtrees (and the leaves at `regs`) are evaluated to the registers,
+        the `place` is used for one of them if given
+        """
+        todo = [i for i, kid in enumerate(kids) if isinstance(kid, _TREES) or i in regs and not _is_reg(kid)]
+        # stable sort keeps the left-to-right order of the equal ones
+        todo.sort(key=lambda i: -_need(kids[i]))
+        out = list(kids)
+        for n, i in enumerate(todo):
+            later = [kid for j, kid in enumerate(kids) if j not in todo[: n + 1]]
+            if place is not None and not any(_reads(kid, place) for kid in later):
+                dest, place = place, None
+            else:
+                dest = self.take()
+            self.emit(kids[i], dest, spare=True)
+            out[i] = dest
+        return out
+
+    def address(self, addr: Any, place: Mem | None) -> IMem:
+        """Indirect operand for the word at the address"""
+        if isinstance(addr, RhAB) and addr.op is Add:
+            x, y = addr.a, addr.b
+            if not _is_reg(x) and _is_reg(y):
+                x, y = y, x
+            x, y = self.operands([x, y], place, regs=[0])
+            return IMem(x, y)
+        if isinstance(addr, RhAB) and addr.op is Sub and isinstance(addr.b, (int, ImmExpr)):
+            (x,) = self.operands([addr.a], place, regs=[0])
+            return IMem(x, -addr.b if isinstance(addr.b, int) else ImmSub(0, addr.b))
+        (x,) = self.operands([addr], place, regs=[0])
+        return IMem(x)
+
+    def emit(self, node: Any, place: Tgt, spare: bool):
+        """Evaluate the node to the `place`. The `spare` place may hold the intermediate results too"""
+        scratch = place if spare and isinstance(place, Mem) else None
+        if isinstance(node, RhAB):
+            a, b = self.operands([node.a, node.b], scratch)
+            self.ops.append(node.op(place, a, b))
+            self.give(a, b, keep=place)
+        elif isinstance(node, RhA):
+            (a,) = self.operands([node.a], scratch)
+            self.ops.append(node.op(place, a))
+            self.give(a, keep=place)
+        elif isinstance(node, RhLoad):
+            mem = self.address(node.addr, scratch)
+            self.ops.append(Mov(place, mem))
+            self.give(mem, keep=place)
+        else:
+            self.ops.append(Mov(place, node))
+
+
+def compile_expr(t: Tgt | RhLoad, rh: Any, *, tmps: Sequence[Mem] | None = None) -> list[Op]:
+    """Ops assigning the expression tree `rh` to the target `t`.
+    Temporaries are the fresh virtual registers, or the `tmps` if given.
+    The `tmps` must not be read by the expression
+    """
+    gen = _Gen(tmps)
+    if isinstance(t, RhLoad):
+        t = folded(t)
+        if isinstance(t, RhLoad):
+            t = gen.address(t.addr, None)
+    gen.emit(folded(rh), t, spare=isinstance(t, Mem))
+    return gen.ops
@@ -0,0 +1,96 @@
+"""Superinstructions.
+
+The superinstruction (see `core._Fused`) is the op followed by the conditional branch testing
+the op result. Script is replacing such pairs by the superinstructions known to the vm if enabled
+by `Env.superinstructions`. The pair is replaced by the new instruction, so the original ones are
+not in the layout.
+
+The new superinstructions are proposed from the execution profile of the real workload:
+the most executed pairs are the candidates. The classes are generated by the scripts/build_superinsts.py
+"""
+
+from __future__ import annotations
+
+from typing import Any, Sequence
+
+from .cfg import RegKey, reg_key, reg_keys
+from .core import BrEq, BrNe, IMem, Inst, LdB, LdBU, LdH, LdHU, Op, StB, StH, _BranchIf, _Fused, _TA, _TAB
+from .env import Env
+from .opt import Item, referenced
+from .profile import Profile
+
+Shape = tuple[type[Op], type[Op], int]
+
+SUPERINSTRUCTIONS: dict[Shape, type[_Fused]] = {
+    (cls.first, cls.second, cls.slot): cls for cls in _Fused.__subclasses__()
+}
+
+# byte and halfword operands
+_SIZED = (LdB, LdBU, LdH, LdHU, StB, StH)
+# result may be any of the operands
+_SYMMETRIC = (BrEq, BrNe)
+
+
+def _reads(opd: Any, key: RegKey, env: Env) -> bool:
+    if isinstance(opd, IMem):
+        return _reads(opd.ref, key, env) or _reads(opd.offset, key, env)
+    # plain memory may be the register too, e.g. `M[4]` or the unaligned `M[5]` for `R[1]`
+    return key in reg_keys(opd, env)
+
+
+def _slot(a: Inst, b: Inst, env: Env) -> int | None:
+    """Source of the branch `b` reading the result of the op `a` if they may be fused"""
+    if not isinstance(a, (_TA, _TAB)) or isinstance(a, _SIZED) or not isinstance(b, _BranchIf):
+        return None
+    key = reg_key(a.tgts[0], env)
+    if key is None:
+        return None
+    slots = [i for i, src in enumerate(b.srcs[:-1]) if reg_key(src, env) == key]
+    if len(slots) != 1:
+        return None
+    # others are read before the first is executed
+    if any(_reads(src, key, env) for i, src in enumerate(b.srcs) if i != slots[0]):
+        return None
+    return slots[0]
+
+
+def _shape(a: Inst, b: Inst, slot: int | None) -> Shape | None:
+    if slot is None:
+        return None
+    return type(a), type(b), 0 if isinstance(b, _SYMMETRIC) else slot
+
+
+def shape_of(a: Inst, b: Inst, env: Env) -> Shape | None:
+    """(first, second, slot) if the op `a` and the branch `b` following it may be fused"""
+    return _shape(a, b, _slot(a, b, env))
+
+
+def fuse_superinstructions(code: Sequence[Item], env: Env) -> list[Item]:
+    """Code with the adjacent op and branch pairs replaced by the superinstructions"""
+    fixed = referenced(code)
+    out: list[Item] = []
+    i = 0
+    while i < len(code):
+        a = code[i]
+        b = code[i + 1] if i + 1 < len(code) else None
+        if isinstance(a, Op) and isinstance(b, Op) and a not in fixed and b not in fixed:
+            slot = _slot(a, b, env)
+            shape = _shape(a, b, slot)
+            cls = SUPERINSTRUCTIONS.get(shape) if shape is not None else None
+            if cls is not None and slot is not None:
+                out.append(cls.from_pair(a, b, slot))
+                i += 2
+                continue
+        out.append(a)
+        i += 1
+    return out
+
+
+def propose_superinstructions(profile: Profile, env: Env, limit: int = 8) -> list[tuple[Shape, int]]:
+    """The most executed pairs not covered by the superinstructions yet, with the execution counts"""
+    counts: dict[Shape, int] = {}
+    for (a, b), n in profile.pairs.items():
+        shape = shape_of(a, b, env)
+        if shape is not None and shape not in SUPERINSTRUCTIONS:
+            counts[shape] = counts.get(shape, 0) + n
+    return sorted(counts.items(), key=lambda item: -item[1])[:limit]
@@ -0,0 +1,210 @@
+"""Image container: the bytecode with the header and the symbol table.
+
+The layout is designed to be used in place (e.g. mmapped or placed in flash).
+All integers are little-endian u32 unless noted.
+
+    header       | see `HEADER`
+    sections     | `nsects` x (tag: 4 bytes, offset, size)
+    symbols      | `nsyms` x (name offset, name size, addr), sorted by name
+    strings      | symbol names, not terminated
+    section data | 4-byte aligned
+    code         | `align`-aligned
+
+Offsets are from the image start.
+"""
+
+import struct
+from typing import Iterator, Mapping
+
+from .exc import ImageError
+from .script import Script, WritableBuffer
+
+MAGIC = b"BAJO"
+VERSION = 1
+
+# magic, version (u16), header size (u16),
+# code start, code end, ram start, ram end,
+# code offset, code size,
+# sections offset, nsects, symbols offset, nsyms, strings offset, strings size
+HEADER = struct.Struct("<4sHH12I")
+SECTION = struct.Struct("<4sII")
+SYMBOL = struct.Struct("<III")
+
+# section tags
+DEBUG_LISTING = b"LIST"
+
+ReadableBuffer = bytes | WritableBuffer
+
+
+def _align(v: int, n: int):
+    return v + (-v % n)
+
+
+def build_image(
+    script: Script,
+    *,
+    debug=False,
+    sections: Mapping[bytes, bytes] | None = None,
+    align=16,
+) -> bytearray:
+    """Pack the script into the image.
+
+    All labels of the script are included in the symbol table.
+    With `debug` the listing is included as the `LIST` section.
+    Custom `sections` are mapping of 4-byte tag -> data.
+    """
+    lay = script.layout
+    env = script.env
+
+    sects = dict(sections or {})
+    if debug:
+        sects[DEBUG_LISTING] = script.listing().encode("utf8")
+    for tag in sects:
+        if len(tag) != 4:
+            raise ValueError("Section tag must be 4 bytes", tag)
+
+    syms = sorted((lab.name.encode("utf8"), lay.addrof(lab)) for lab in lay.labels)
+    names = {name for name, _ in syms}
+    if len(names) != len(syms):
+        raise ImageError("Duplicate symbol names")
+
+    p = HEADER.size
+    sects_off = p
+    p += SECTION.size * len(sects)
+    syms_off = p
+    p += SYMBOL.size * len(syms)
+    strs_off = p
+    strs_size = sum(len(name) for name, _ in syms)
+    p = _align(p + strs_size, 4)
+    sects_at: list[tuple[bytes, int, bytes]] = []
+    for tag, data in sects.items():
+        sects_at.append((tag, p, data))
+        p = _align(p + len(data), 4)
+    code_off = _align(p, align)
+    code_size = lay.size
+
+    buf = bytearray(code_off + code_size)
+
+    code_range = lay.code_range
+    HEADER.pack_into(
+        buf,
+        0,
+        MAGIC,
+        VERSION,
+        HEADER.size,
+        code_range[0],
+        code_range[1],
+        env.ram_region[0],
+        env.ram_region[1],
+        code_off,
+        code_size,
+        sects_off,
+        len(sects),
+        syms_off,
+        len(syms),
+        strs_off,
+        strs_size,
+    )
+
+    for i, (tag, off, data) in enumerate(sects_at):
+        SECTION.pack_into(buf, sects_off + i * SECTION.size, tag, off, len(data))
+        buf[off : off + len(data)] = data
+
+    p = strs_off
+    for i, (name, addr) in enumerate(syms):
+        SYMBOL.pack_into(buf, syms_off + i * SYMBOL.size, p, len(name), addr)
+        buf[p : p + len(name)] = name
+        p += len(name)
+
+    script.encode_into(buf, code_off)
+    return buf
+
+
+class ImageView:
+    """Zero-copy reader of the image. The `buf` may be a bytes, bytearray, mmap etc."""
+
+    def __init__(self, buf: ReadableBuffer):
+        self.buf = memoryview(buf).cast("B")
+        if len(self.buf) < HEADER.size:
+            raise ImageError("Image is too short")
+        (
+            magic,
+            version,
+            hdr_size,
+            code_start,
+            code_end,
+            ram_start,
+            ram_end,
+            self._code_off,
+            self._code_size,
+            self._sects_off,
+            self._nsects,
+            self._syms_off,
+            self._nsyms,
+            self._strs_off,
+            self._strs_size,
+        ) = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ImageError("Bad magic", magic)
+        if version != VERSION or hdr_size != HEADER.size:
+            raise ImageError("Unsupported version", version)
+        if self._code_off + self._code_size > len(self.buf):
+            raise ImageError("Image is truncated")
+        self.code_range = (code_start, code_end)
+        self.ram_region = (ram_start, ram_end)
+
+    @property
+    def code(self) -> memoryview:
+        return self.buf[self._code_off : self._code_off + self._code_size]
+
+    def _symbol(self, i: int) -> tuple[memoryview, int]:
+        name_off, name_size, addr = SYMBOL.unpack_from(self.buf, self._syms_off + i * SYMBOL.size)
+        return self.buf[name_off : name_off + name_size], addr
+
+    @property
+    def symbols(self) -> Iterator[tuple[str, int]]:
+        """Name, address pairs in the name order"""
+        for i in range(self._nsyms):
+            name, addr = self._symbol(i)
+            yield bytes(name).decode("utf8"), addr
+
+    def lookup(self, name: str) -> int:
+        """Symbol address by name. Binary search over the sorted table"""
+        key = name.encode("utf8")
+        lo = 0
+        hi = self._nsyms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sym, addr = self._symbol(mid)
+            if sym == key:
+                return addr
+            if bytes(sym) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        raise KeyError(name)
+
+    def __getitem__(self, name: str) -> int:
+        return self.lookup(name)
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self.lookup(name)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def sections(self) -> dict[bytes, memoryview]:
+        out: dict[bytes, memoryview] = {}
+        for i in range(self._nsects):
+            tag, off, size = SECTION.unpack_from(self.buf, self._sects_off + i * SECTION.size)
+            out[tag] = self.buf[off : off + size]
+        return out
+
+    def section(self, tag: bytes) -> memoryview | None:
+        return self.sections.get(tag)
+
+    def release(self):
+        """Release the underlying buffer (required before closing the mmap)"""
+        self.buf.release()
@@ -0,0 +1,285 @@
+"""Compact instruction storage for the generated code.
+
+The `Block` keeps the ops in the parallel typed arrays instead of the `Op` objects.
+For the builder the block is a single (compound) instruction. The per-row offsets are
+resolved during the build like the sizes of ordinary instructions.
+`Op` objects are materialized only for the listing.
+"""
+
+from __future__ import annotations
+
+from array import array
+from typing import Any, Iterator, Protocol, Sequence
+
+from .asm import Label, MemAddr, Reg
+from .core import (
+    _MAX_VARINT_SIZE,
+    _IMM_RANGE,
+    Br,
+    BrLnk,
+    Imm,
+    ImmExpr,
+    ImmOffset,
+    Inst,
+    Mem,
+    Op,
+    ProvidesLayout,
+    Src,
+    Tgt,
+    _BranchIf,
+    _ensure_not_bool,
+    check_range,
+)
+
+# operand kinds
+IMM = 0  # value is the immediate
+MEM = 1  # value is the direct address
+OBJ = 2  # value is the index of operand object in refs
+OFFSET = 3  # value is the index of the branch target in refs. encoded as offset from the end of row
+
+# ops with the last source being the branch target
+_RELATIVE = (Br, BrLnk, _BranchIf)
+
+
+def _addr_of(obj: Inst | Mem | ImmExpr, lay: ProvidesLayout) -> int:
+    if isinstance(obj, Inst):
+        return lay.addrof(obj)
+    if isinstance(obj, ImmExpr):
+        return obj.result_for(lay)
+    return obj.addr_from(lay)
+
+
+class ProvidesRowLayout(ProvidesLayout, Protocol):
+    offsets: dict[Inst, array[int]]
+
+
+class Block(Inst):
+    """Instructions stored as arrays. Append ops with `op`, place labels with `label`"""
+
+    def __init__(self):
+        # per row
+        self.opcodes = array("B")
+        self.starts = array("L", [0])  # first operand of row. n + 1 items
+        self.ntgts = array("B")
+        # per operand
+        self.kinds = array("B")
+        self.values = array("q")
+        # operand objects
+        self.refs: list[Any] = []
+        self.classes: dict[int, type[Op]] = {}
+        # label -> row
+        self.labels: dict[Label, int] = {}
+
+    def __repr__(self):
+        return f"Block({ len(self) } ops)"
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def label(self, lab: Label | None = None) -> Label:
+        """Place the label at the next op"""
+        lab = lab or Label()
+        self.labels[lab] = len(self)
+        return lab
+
+    def op(self, cls: type[Op], tgts: Sequence[Tgt] = (), srcs: Sequence[Src | Inst] = ()):
+        """Append op. For branches, the last source is the target address (as for the branch constructors)"""
+        kinds = self.kinds
+        values = self.values
+        refs = self.refs
+        for opd in tgts:
+            if type(opd) is Reg or type(opd) is MemAddr:
+                kinds.append(MEM)
+                values.append(opd._addr)
+            else:
+                kinds.append(OBJ)
+                values.append(len(refs))
+                refs.append(opd)
+        is_relative = issubclass(cls, _RELATIVE)
+        last = len(srcs) - 1
+        for i, opd in enumerate(srcs):
+            if is_relative and i == last:
+                kinds.append(OFFSET)
+                values.append(len(refs))
+                refs.append(opd)
+            elif isinstance(opd, int):
+                _ensure_not_bool(opd)
+                check_range(opd, _IMM_RANGE)
+                kinds.append(IMM)
+                values.append(opd)
+            elif type(opd) is Reg or type(opd) is MemAddr:
+                kinds.append(MEM)
+                values.append(opd._addr)
+            else:
+                kinds.append(OBJ)
+                values.append(len(refs))
+                refs.append(opd)
+        self.opcodes.append(cls.opcode)
+        self.classes.setdefault(cls.opcode, cls)
+        self.ntgts.append(len(tgts))
+        self.starts.append(len(kinds))
+        return self
+
+    def _encode_opd(self, i: int, lay: ProvidesLayout, as_src: bool, end: int) -> bytes:
+        kind = self.kinds[i]
+        v = self.values[i]
+        if kind == MEM:
+            return Mem.encode(v, as_src=as_src)
+        if kind == IMM:
+            return Imm.encode(v)
+        if kind == OBJ:
+            return self.refs[v].encode_for(lay, as_src=as_src)
+        return Imm.encode(_addr_of(self.refs[v], lay) - end)
+
+    def _max_opd_size(self, i: int, as_src: bool) -> int:
+        kind = self.kinds[i]
+        v = self.values[i]
+        if kind == MEM:
+            return len(Mem.encode(v, as_src=as_src))
+        if kind == IMM:
+            return len(Imm.encode(v))
+        if kind == OBJ:
+            return self.refs[v].max_size()
+        return _MAX_VARINT_SIZE
+
+    def _encode_row(self, row: int, lay: ProvidesLayout, end: int) -> bytes:
+        """Encode the row. `end` is the (assumed) address of the row end"""
+        cls = self.classes[self.opcodes[row]]
+        first = self.starts[row]
+        last = self.starts[row + 1]
+        ntgts = self.ntgts[row]
+        nsrcs = last - first - ntgts
+
+        tgts = [self._encode_opd(i, lay, False, end) for i in range(first, first + ntgts)]
+        srcs = [self._encode_opd(i, lay, True, end) for i in range(first + ntgts, last)]
+
+        mop = cls.opcode
+        # same rmw rule as for the Op
+        if srcs and tgts:
+            tgt = self._encode_opd(first, lay, True, end)
+            if tgt in (srcs if cls.is_commutative else srcs[:1]):
+                mop |= 0x80
+                i = srcs.index(tgt)
+                srcs = [*srcs[:i], *srcs[i + 1 :]]
+
+        parts = [mop.to_bytes(1, "little", signed=False)]
+        if cls.is_vartgt:
+            parts.append(Imm.encode(ntgts))
+        parts.extend(tgts)
+        if cls.is_varsrc:
+            parts.append(Imm.encode(nsrcs))
+        parts.extend(srcs)
+        return b"".join(parts)
+
+    def max_offsets(self):
+        offsets = array("L", [0])
+        p = 0
+        for row in range(len(self)):
+            cls = self.classes[self.opcodes[row]]
+            first = self.starts[row]
+            last = self.starts[row + 1]
+            ntgts = self.ntgts[row]
+            size = 1
+            if cls.is_vartgt:
+                size += _MAX_VARINT_SIZE
+            if cls.is_varsrc:
+                size += _MAX_VARINT_SIZE
+            size += sum(self._max_opd_size(i, i >= first + ntgts) for i in range(first, last))
+            p += size
+            offsets.append(p)
+        return offsets
+
+    def max_size(self) -> int:
+        return self.max_offsets()[-1]
+
+    def size_from(self, lay: ProvidesRowLayout) -> int:  # type: ignore[override]
+        prev = lay.offsets.get(self) or self.max_offsets()
+        # The new offsets are published immediately: the labels of already processed rows
+        # are resolved with the fresh values, the rest with the previous ones.
+        offsets = array("L", prev)
+        lay.offsets[self] = offsets
+        base = lay.addrof(self)
+        p = 0
+        for row in range(len(self)):
+            offsets[row] = p
+            # size of the row is assumed to be the same as on previous pass
+            end = base + p + prev[row + 1] - prev[row]
+            p += len(self._encode_row(row, lay, end))
+        offsets[-1] = p
+        return p
+
+    def encode_for(self, lay: ProvidesRowLayout) -> bytes:  # type: ignore[override]
+        return b"".join(bytecode for _, bytecode in self._rows_for(lay))
+
+    def _rows_for(self, lay: ProvidesRowLayout) -> Iterator[tuple[int, bytes]]:
+        offsets = lay.offsets[self]
+        base = lay.addrof(self)
+        for row in range(len(self)):
+            yield base + offsets[row], self._encode_row(row, lay, base + offsets[row + 1])
+
+    def check_against(self, lay: ProvidesLayout) -> None:
+        for i, kind in enumerate(self.kinds):
+            if kind == OBJ or kind == OFFSET:
+                self.refs[self.values[i]].check_against(lay)
+
+    def materialize(self, row: int) -> Op:
+        """Op object for the row. Branch offsets are relative to the returned op"""
+        cls = self.classes[self.opcodes[row]]
+        first = self.starts[row]
+        last = self.starts[row + 1]
+        ntgts = self.ntgts[row]
+        op = cls.__new__(cls)
+        opds: list[Any] = []
+        for i in range(first, last):
+            kind = self.kinds[i]
+            v = self.values[i]
+            if kind == MEM:
+                opds.append(Reg(v // 4) if v % 4 == 0 else MemAddr(v))
+            elif kind == IMM:
+                opds.append(v)
+            elif kind == OBJ:
+                opds.append(self.refs[v])
+            else:
+                opds.append(ImmOffset(op, self.refs[v]))
+        Op.__init__(op, tuple(opds[:ntgts]), tuple(opds[ntgts:]))
+        return op
+
+    def ops_for(self, lay: ProvidesRowLayout) -> Iterator[tuple[Op, _RowLayout]]:
+        """Materialized ops with the layout resolving them. For the listing"""
+        offsets = lay.offsets[self]
+        base = lay.addrof(self)
+        for row in range(len(self)):
+            op = self.materialize(row)
+            yield op, _RowLayout(lay, op, base + offsets[row], offsets[row + 1] - offsets[row])
+
+    def labels_at(self, row: int) -> list[Label]:
+        return [lab for lab, at in self.labels.items() if at == row]
+
+
+class _RowLayout:
+    """Layout of the materialized op, delegating the rest to the build layout"""
+
+    def __init__(self, lay: ProvidesLayout, op: Op, addr: int, size: int):
+        self._lay = lay
+        self._op = op
+        self._addr = addr
+        self._size = size
+
+    def __getattr__(self, name: str):
+        return getattr(self._lay, name)
+
+    def addrof(self, obj: Any, /) -> int:
+        if obj is self._op:
+            return self._addr
+        return self._lay.addrof(obj)
+
+    def sizeof(self, obj: Inst, /) -> int:
+        if obj is self._op:
+            return self._size
+        return self._lay.sizeof(obj)
+
+    def is_code(self, addr: int) -> bool:
+        return self._lay.is_code(addr)
+
+    def is_ram(self, addr: int) -> bool:
+        return self._lay.is_ram(addr)
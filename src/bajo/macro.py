@@ -1,17 +1,81 @@
 from __future__ import annotations
 
-from typing import Iterable, Iterator, Mapping, Sequence
+import copy
+from typing import Iterable, Iterator, Literal, Mapping, Sequence
 
-from .asm import Code, Label, NamedReg, NoPad, Reg
-from .core import Br, BrLnk, Comparison, IMem, Inst, Jmp, Mem
+from .asm import Code, DataExpr, Directive, Label, NamedReg, NoPad, Reg, VReg, flat_code
+from .cfg import CFG, BasicBlock, RegKey, branch_target, liveness, reg_key, uses_defs, writes
+from .core import (
+    _S32_MAX,
+    _S32_MIN,
+    _U32_MAX,
+    Br,
+    BrEq,
+    BrGe,
+    BrGeU,
+    BrLnk,
+    Comparison,
+    IMem,
+    Inst,
+    Jmp,
+    JmpLnk,
+    LdM,
+    LShift,
+    Mem,
+    Mov,
+    Src,
+    StM,
+    Tgt,
+    cast_s32,
+)
+from .env import Env
 from .exc import DuplicateDefError, MissingDefError
-from .script import flat_code
+
+
+def _materialized(code: Code) -> Code:
+    """Code with the generators replaced by the lists. The generator may be iterated once only"""
+    if isinstance(code, Iterator):
+        return [_materialized(item) for item in code]
+    if isinstance(code, (list, tuple)):
+        return [_materialized(item) for item in code]
+    return code
+
+
+def _single_mov(code: Code) -> Mov | None:
+    """The only instruction of the code if it's a plain `Mov` with no memory reads via pointer"""
+    items = [item for item in flat_code(code) if not (item is None or item is False or item is True)]
+    if len(items) != 1 or type(items[0]) is not Mov:
+        return None
+    mov = items[0]
+    # unconditional evaluation of the pointer may fault
+    if any(isinstance(opd, IMem) for opd in mov.srcs):
+        return None
+    return mov
+
+
+def _same_tgt(a: Tgt, b: Tgt) -> bool:
+    return a is b or (isinstance(a, Mem) and bool(a._eq(b)))
 
 
 def when(condition: Comparison, then: Code, otherwise: Code | None = None) -> Code:
-    """Generate if/else code"""
+    """Generate if/else code.
+    The single assignments of the same target in both arms (or in `then` alone) become the conditional move
+    """
     code: Code
 
+    then = _materialized(then)
+    otherwise = _materialized(otherwise)
+    then_mov = _single_mov(then)
+    if then_mov is not None:
+        t = then_mov.tgts[0]
+        if not otherwise:
+            if not isinstance(t, IMem):
+                return condition.as_move_to(t, then_mov.srcs[0], t)
+        else:
+            else_mov = _single_mov(otherwise)
+            if else_mov is not None and _same_tgt(t, else_mov.tgts[0]):
+                return condition.as_move_to(t, then_mov.srcs[0], else_mov.srcs[0])
+
     if not otherwise:
         end_lab = Label()
         code = [
@@ -33,16 +97,83 @@ def when(condition: Comparison, then: Code, otherwise: Code | None = None) -> Co
     return code
 
 
-def case(cases: Mapping[Comparison, Code], *, default: Code = None):
-    """Generate switch-case-like code. Each case is a comparison. Only one case (or default) would be executed"""
+def _switch_values(cases: Sequence[tuple[Comparison, Code, Label]]) -> tuple[Src, list[tuple[int, Label]]] | None:
+    """Operand and (value, label) pairs sorted by value if all cases are `operand == constant`.
+    The first case of the duplicated values wins
+    """
+    if not cases:
+        return None
+    first = cases[0][0].a
+    by_value: dict[int, Label] = {}
+    for cond, _, label in cases:
+        if cond.kind != "==" or not isinstance(cond.b, int) or isinstance(cond.b, bool):
+            return None
+        if not (cond.a is first or (isinstance(cond.a, (Mem, IMem)) and cond.a._eq(first))):
+            return None
+        by_value.setdefault(cast_s32(cond.b & _U32_MAX), label)
+    return first, sorted(by_value.items())
+
+
+def _search_tree(a: Src, values: Sequence[tuple[int, Label]], default: Label) -> list[Code]:
+    """Binary search over the sorted values"""
+    if len(values) <= CASE_LINEAR_MAX:
+        return [*[BrEq(a, v, label) for v, label in values], Br(default)]
+    mid = len(values) // 2
+    upper = Label()
+    return [
+        BrGe(a, values[mid][0], upper),
+        _search_tree(a, values[:mid], default),
+        upper,
+        _search_tree(a, values[mid:], default),
+    ]
+
+
+def _jump_table(a: Src, values: Sequence[tuple[int, Label]], default: Label, tmp: Mem) -> list[Code]:
+    """Bounds check and the jump via table of addresses"""
+    lo = values[0][0]
+    hi = values[-1][0]
+    labels = dict(values)
+    table = Label()
+    return [
+        tmp.set(a - lo) if lo else tmp.set(a),
+        BrGeU(tmp, hi - lo + 1, default),
+        LShift(tmp, tmp, 2),
+        Jmp(IMem(tmp, table)),
+        table,
+        [DataExpr(labels.get(v, default)) for v in range(lo, hi + 1)],
+    ]
+
+
+# cases compared one by one
+CASE_LINEAR_MAX = 3
+
+
+def case(cases: Mapping[Comparison, Code], *, default: Code = None, tmp: Mem | None = None):
+    """Generate switch-case-like code. Each case is a comparison. Only one case (or default) would be executed.
+
+    If all cases are comparing the same operand to the constants, the dispatch is the binary search.
+    The dense values are dispatched via the jump table, the index is kept in the `tmp` register (virtual if not given)
+    """
     res: list[Code] = []
     end_label = Label()
+    default_label = Label()
 
     blocks = [(cond, code, Label()) for cond, code in cases.items()]
 
-    # compares and branches block
-    for cond, _, label in blocks:
-        res.extend([cond.as_if_branch_to(label)])
+    switch = _switch_values(blocks) if len(blocks) > CASE_LINEAR_MAX else None
+    if switch:
+        a, values = switch
+        span = values[-1][0] - values[0][0] + 1
+        # at least half of the table is used
+        if span <= 2 * len(values):
+            res.append(_jump_table(a, values, default_label, VReg("index") if tmp is None else tmp))
+        else:
+            res.append(_search_tree(a, values, default_label))
+        res.append(default_label)
+    else:
+        # compares and branches block
+        for cond, _, label in blocks:
+            res.extend([cond.as_if_branch_to(label)])
 
     # cases blocks
     if default:
@@ -59,6 +190,253 @@ def case(cases: Mapping[Comparison, Code], *, default: Code = None):
     return res
 
 
+def _copies(body: Code, n: int) -> list[list[Inst | Label | Directive]]:
+    """`n` copies of the flattened code with the fresh labels. The first one is the code itself"""
+    flat: list[Inst | Label | Directive] = [
+        item for item in flat_code(body) if not (item is None or item is False or item is True)
+    ]
+    return [flat, *(_clone(flat) for _ in range(n - 1))]
+
+
+def loop_while(condition: Comparison, body: Code) -> Code:
+    """Generate while loop. The condition is tested before the first iteration and after each one"""
+    top = Label()
+    end = Label()
+    return [
+        condition.as_else_branch_to(end),
+        top,
+        body,
+        condition.as_if_branch_to(top),
+        end,
+    ]
+
+
+def repeat(n: int, body: Code, *, counter: Mem | None = None, unroll=1) -> Code:
+    """Generate loop executing the body `n` times. The `counter` register is virtual if not given.
+
+    With `unroll` the loop body is `unroll` copies of the body, the remaining iterations are straight code
+    """
+    if n <= 0:
+        return []
+    unroll = min(max(unroll, 1), n)
+    times, rest = divmod(n, unroll)
+    copies = _copies(body, unroll + rest)
+    if times == 1:
+        return copies
+    counter = VReg("counter") if counter is None else counter
+    top = Label()
+    return [
+        copies[unroll:],
+        counter.set(times),
+        top,
+        copies[:unroll],
+        counter.set(counter - 1),
+        (counter != 0).as_if_branch_to(top),
+    ]
+
+
+def for_range(reg: Mem, start: Src, stop: Src, step: int, body: Code, *, unroll=1, tmp: Mem | None = None) -> Code:
+    """Generate loop like `for reg in range(start, stop, step)`. The values are signed.
+
+    With `unroll` the loop body is `unroll` copies of the body, followed by the remainder loop.
+    The limit of unrolled loop is kept in the `tmp` register (virtual if not given) unless the `stop` is constant
+    """
+    if step == 0:
+        raise ValueError("Step must be non-zero", step)
+
+    def cmp(limit: Src) -> Comparison:
+        return reg < limit if step > 0 else reg > limit
+
+    if unroll <= 1:
+        return [reg.set(start), loop_while(cmp(stop), [body, reg.set(reg + step)])]
+
+    # all copies are executed if the first is below the limit
+    limit: Src
+    if isinstance(stop, int):
+        limit = min(max(stop - (unroll - 1) * step, _S32_MIN), _S32_MAX)
+        init: list[Code] = []
+    else:
+        limit = VReg("limit") if tmp is None else tmp
+        span = (unroll - 1) * step
+        # limit past the s32 range is clamped: no room for the unrolled copies
+        if step > 0:
+            bound, never = _S32_MIN + span, _S32_MIN
+        else:
+            bound, never = _S32_MAX + span, _S32_MAX
+        if not _S32_MIN <= bound <= _S32_MAX:
+            init = [limit.set(never)]
+        else:
+            init = [limit.set(stop - span), when(Comparison("<" if step > 0 else ">", stop, bound), limit.set(never))]
+    copies = _copies(body, unroll + 1)
+    return [
+        init,
+        reg.set(start),
+        loop_while(cmp(limit), [[copy, reg.set(reg + step)] for copy in copies[:unroll]]),
+        loop_while(cmp(stop), [copies[unroll], reg.set(reg + step)]),
+    ]
+
+
+# registers moved by the single StM/LdM, limited by the vm operands count
+_MAX_BLOCK = 7
+
+
+def _frame(save_regs: Sequence[Reg | NamedReg], is_leaf: bool) -> tuple[list[Code], list[Code]]:
+    """Prologue and epilogue of the subroutine"""
+    lr = NamedReg("lr")
+    sp = NamedReg("sp")
+
+    push: Sequence[Reg | NamedReg] = []
+    pop: Sequence[Reg | NamedReg] = []
+
+    if is_leaf:
+        push = save_regs
+        pop = save_regs
+    else:
+        push = [*save_regs, lr]
+        pop = save_regs
+
+    if not push:
+        return [], []
+
+    # the frame is pushed by the blocks of up to _MAX_BLOCK registers, the last ones first
+    nregs = len(push)
+    starts = range(0, nregs, _MAX_BLOCK)
+    prologue: list[Code] = [StM(sp, sp, *push[i : i + _MAX_BLOCK]) for i in reversed(starts)]
+    epilogue: list[Code] = [sp.set(sp + nregs * 4)] if not pop else []
+    for i in range(0, len(pop), _MAX_BLOCK):
+        regs = pop[i : i + _MAX_BLOCK]
+        # the last block drops the rest of frame
+        size = len(regs) * 4 if i + _MAX_BLOCK < len(pop) else (nregs - i) * 4
+        epilogue.append(LdM(sp, regs, sp, size))
+    return prologue, epilogue
+
+
+class _AutoFrame(Directive):
+    """Placeholder of the prologue/epilogue with the registers to be saved computed by the `lower_frames`"""
+
+    def __init__(self, sub: Subroutine, is_prologue: bool):
+        self.sub = sub
+        self.is_prologue = is_prologue
+
+    def __repr__(self) -> str:
+        return f"_AutoFrame({ self.sub !r}, { self.is_prologue })"
+
+
+class _TailCall(Directive):
+    """Marks the call ending the body of automatic frame subroutine. The call, the epilogue and the return
+    may be replaced by the jump to the callee
+    """
+
+    def __init__(self, sub: Subroutine, call: BrLnk, epilogue: Code, ret: Jmp):
+        self.sub = sub
+        self.call = call
+        self.epilogue = epilogue
+        self.ret = ret
+
+    def __repr__(self) -> str:
+        return f"_TailCall({ self.sub !r})"
+
+
+def _split_tail_call(body: Code) -> tuple[list[Code], BrLnk | None]:
+    """Body without the last call and the call itself, if the body ends with a call"""
+    items: list[Code] = [item for item in flat_code(body) if not (item is None or item is False or item is True)]
+    last = items[-1] if items else None
+    if (
+        isinstance(last, BrLnk)
+        and isinstance(last.tgts[0], NamedReg)
+        and last.tgts[0].name == "lr"
+        and branch_target(last) is not None
+    ):
+        return items[:-1], last
+    return items, None
+
+
+def _tail_jump(call: BrLnk, is_leaf: bool) -> list[Code]:
+    """Jump to the callee returning to our caller. Placed after the epilogue"""
+    lr = NamedReg("lr")
+    target = branch_target(call)
+    assert target is not None
+    if is_leaf:
+        return [Br(target)]
+    return [lr.set(IMem(NamedReg("sp"), -4)), Br(target)]
+
+
+class _InlineFrame(Directive):
+    """Placeholder of the registers save/restore around the inlined body of automatic frame subroutine.
+    Computed by the `lower_frames`
+    """
+
+    def __init__(self, sub: Subroutine, is_prologue: bool):
+        self.sub = sub
+        self.is_prologue = is_prologue
+
+    def __repr__(self) -> str:
+        return f"_InlineFrame({ self.sub !r}, { self.is_prologue })"
+
+
+def _clone(items: list[Inst | Label | Directive]) -> list[Inst | Label | Directive]:
+    """Copy of the flattened code with the fresh labels.
+    Labels and instructions defined elsewhere, virtual registers and subroutines are shared
+    """
+    own = {id(item) for item in items}
+    memo: dict[int, object] = {}
+    seen: set[int] = set()
+    stack: list[object] = list(items)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, Label):
+            # explicit names would clash, so the copies are auto-named
+            memo[id(obj)] = Label() if id(obj) in own else obj
+        elif isinstance(obj, (VReg, Subroutine)) or (isinstance(obj, Inst) and id(obj) not in own):
+            memo[id(obj)] = obj
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif hasattr(obj, "__dict__"):
+            stack.extend(vars(obj).values())
+    return copy.deepcopy(items, memo)
+
+
+# instructions in body of the subroutine inlined with inline="auto"
+INLINE_MAX_SIZE = 4
+
+# subroutines being inlined now. The call of one of them is the recursion
+_inlining: list[Subroutine] = []
+
+
+class _Call:
+    """Call of the subroutine. Flattens to the branch-and-link or to the copy of the body if
+    the subroutine is inlined
+    """
+
+    def __init__(self, sub: Subroutine):
+        self.sub = sub
+
+    def __repr__(self) -> str:
+        return f"_Call({ self.sub !r})"
+
+    def __iter__(self) -> Iterator[Code]:
+        sub = self.sub
+        if sub in _inlining:
+            sub.is_recursive = True
+        elif sub.body is not None and sub.inline and not sub.is_recursive:
+            _inlining.append(sub)
+            try:
+                body = [item for item in flat_code(sub.body) if not (item is None or item is False or item is True)]
+            finally:
+                _inlining.pop()
+            size = sum(isinstance(item, Inst) for item in body)
+            if not sub.is_recursive and (sub.inline is True or size <= INLINE_MAX_SIZE):
+                yield from sub.inlined(body)
+                return
+        yield BrLnk(NamedReg("lr"), sub.label)
+
+
 class Subroutine:
     """Subroutine macro"""
 
@@ -66,6 +444,9 @@ class Subroutine:
         """Declare the Subroutine"""
         self.label = Label(name)
         self.body: Code | None = None
+        self.inline: bool | Literal["auto"] = False
+        # found while inlining
+        self.is_recursive = False
 
     def __repr__(self):
         return f"{ self.__class__.__name__ }('{ self.label.name }')"
@@ -77,13 +458,32 @@ class Subroutine:
     def __call__(self):
         return self.call()
 
-    def define(self, body: Code, *, save_regs: Iterable[Reg] | None = None, is_leaf=False):
-        """Define the Subroutine code"""
+    def define(
+        self,
+        body: Code,
+        *,
+        save_regs: Iterable[Reg] | Literal["auto"] | None = None,
+        is_leaf=False,
+        results: Iterable[Reg] = (),
+        inline: bool | Literal["auto"] = False,
+    ):
+        """Define the Subroutine code.
+
+        With `save_regs="auto"` the registers written by the subroutine (and its callees) and
+        live after the calls are saved. The `results` registers are never saved.
+
+        With `inline=True` the calls are replaced by the copies of body, with `inline="auto"` only if
+        the body is up to `INLINE_MAX_SIZE` instructions. Recursive subroutines are never inlined
+        """
         if self.body is not None:
             raise DuplicateDefError("Code already defined")
-        self.body = body
+        # body is flattened by the code and by each inlined call
+        self.body = _materialized(body)
         self.is_leaf = is_leaf
-        self.save_regs = sorted(set(save_regs or []), key=lambda x: x.n)
+        self.is_auto = save_regs == "auto"
+        self.save_regs = [] if save_regs == "auto" else sorted(set(save_regs or []), key=lambda x: x.n)
+        self.results = list(results)
+        self.inline = inline
         return self
 
     @property
@@ -93,37 +493,24 @@ class Subroutine:
         lr = NamedReg("lr")
         sp = NamedReg("sp")
 
-        save_regs = self.save_regs
+        jmp: Mem | IMem = lr if self.is_leaf else IMem(sp, -4)
 
-        prologue: list[Code] = []
-        epilogue: list[Code] = []
-        push: Sequence[Reg | NamedReg] = []
-        pop: Sequence[Reg | NamedReg] = []
-
-        jmp: Mem | IMem
+        if self.is_auto:
+            prologue: list[Code] = [_AutoFrame(self, True)]
+            epilogue: list[Code] = [_AutoFrame(self, False)]
+        else:
+            prologue, epilogue = _frame(self.save_regs, self.is_leaf)
 
-        if self.is_leaf:
-            if self.save_regs:
-                push = save_regs
-                pop = save_regs
-            jmp = lr
+        body, tail = _split_tail_call(self.body)
+        code: list[Code]
+        if tail is None or (self.save_regs and not self.is_auto):
+            code = [self.label, *prologue, self.body, *epilogue, Jmp(jmp)]
+        elif self.is_auto:
+            # decided by the lower_frames
+            ret = Jmp(jmp)
+            code = [self.label, *prologue, body, _TailCall(self, tail, epilogue[0], ret), tail, *epilogue, ret]
         else:
-            push = [*save_regs, lr]
-            pop = save_regs
-            jmp = IMem(sp, -4)
-
-        if push:
-            nregs = len(push)
-            prologue = [
-                sp.set(sp - nregs * 4),
-                [IMem(sp, i * 4).set(reg) for i, reg in enumerate(push)],
-            ]
-            epilogue = [
-                sp.set(sp + nregs * 4),
-                [reg.set(IMem(sp, -(nregs - i) * 4)) for i, reg in enumerate(pop)],
-            ]
-
-        code: list[Code] = [self.label, *prologue, self.body, *epilogue, Jmp(jmp)]
+            code = [self.label, *prologue, body, *epilogue, _tail_jump(tail, self.is_leaf)]
         yield from code
 
     @property
@@ -131,7 +518,213 @@ class Subroutine:
         return self.label.name
 
     def call(self) -> Code:
-        return [BrLnk(NamedReg("lr"), self.label)]
+        return _Call(self)
+
+    def inlined(self, body: list[Inst | Label | Directive]) -> Code:
+        """Copy of the flattened body to be placed at the call site. The link register is not saved"""
+        if self.is_auto:
+            return [_InlineFrame(self, True), _clone(body), _InlineFrame(self, False)]
+        prologue, epilogue = _frame(self.save_regs, True)
+        return [*prologue, _clone(body), *epilogue]
+
+
+def _key_order(key: RegKey) -> tuple[int, int]:
+    return (1, key.serial) if isinstance(key, VReg) else (0, key)
+
+
+def lower_frames(code: Sequence[Inst | Label | Directive], env: Env) -> list[Inst | Label | Directive]:
+    """Replace the automatic frames of subroutines by the prologues/epilogues.
+
+    The registers saved are the ones written by the subroutine or its callees and live at
+    any of the subroutine return points. The inlined bodies save the registers written and live
+    after the body. Script is calling it before the build.
+    """
+    subs = {item.sub for item in code if isinstance(item, _AutoFrame)}
+    inlines = [i for i, item in enumerate(code) if isinstance(item, _InlineFrame)]
+    if not subs and not inlines:
+        return list(code)
+
+    cfg = CFG(code)
+    live_in, live_out = liveness(cfg, env)
+    all_regs: set[RegKey] = set()
+    for block in cfg:
+        for inst in block.insts:
+            uses, defs = uses_defs(inst, env)
+            all_regs |= uses | defs
+    host_regs = {key for key in all_regs if not isinstance(key, VReg)}
+
+    fixed = {reg_key(NamedReg("sp"), env), reg_key(NamedReg("lr"), env)}
+
+    # registers written and read by the code starting at block, ignoring the callees. Callees are collected
+    def region(entry: BasicBlock) -> tuple[set[RegKey], set[BasicBlock], bool, set[RegKey]]:
+        written: set[RegKey] = set()
+        read: set[RegKey] = set()
+        callees: set[BasicBlock] = set()
+        is_unknown = False
+        seen: set[BasicBlock] = set()
+        stack = [entry]
+        while stack:
+            block = stack.pop()
+            if block in seen:
+                continue
+            seen.add(block)
+            for inst in block.insts:
+                written |= writes(inst, env)
+                read |= uses_defs(inst, env, host_regs)[0]
+            last = block.last
+            succs = block.succs
+            if isinstance(last, (BrLnk, JmpLnk)):
+                target = branch_target(last)
+                if target is None or target not in cfg.block_of:
+                    is_unknown = True
+                else:
+                    callees.add(cfg.block_of[target])
+                succs = [cfg.blocks[block.index + 1]] if block.index + 1 < len(cfg) else []
+            elif block.is_indirect:
+                # return or the jump via table
+                succs = [succ for succ in succs if succ in cfg.address_taken]
+            stack.extend(succs)
+        return written, callees, is_unknown, read
+
+    regions: dict[BasicBlock, tuple[set[RegKey], set[BasicBlock], bool, set[RegKey]]] = {}
+    pending = [cfg.block_of[sub.label] for sub in subs]
+    # callees of the inlined bodies
+    if inlines:
+        for item in code[inlines[0] : inlines[-1]]:
+            target = branch_target(item) if isinstance(item, (BrLnk, JmpLnk)) else None
+            if target is not None and target in cfg.block_of:
+                pending.append(cfg.block_of[target])
+    while pending:
+        entry = pending.pop()
+        if entry not in regions:
+            regions[entry] = region(entry)
+            pending.extend(regions[entry][1])
+
+    # registers live after the call of the subroutine
+    live_after: dict[BasicBlock, set[RegKey]] = {entry: set() for entry in regions}
+    for block in cfg:
+        last = block.last
+        if isinstance(last, (BrLnk, JmpLnk)) and block.index + 1 < len(cfg):
+            after = live_in[cfg.blocks[block.index + 1]]
+            target = branch_target(last)
+            for entry in [cfg.block_of[target]] if target in cfg.block_of else regions:  # type: ignore[index]
+                if entry in live_after:
+                    live_after[entry] |= after
+    # may be called indirectly
+    for entry in regions:
+        if entry in cfg.address_taken:
+            live_after[entry] = set(all_regs)
+
+    sub_of = {cfg.block_of[sub.label]: sub for sub in subs}
+
+    def saves_of(entry: BasicBlock, clobbers: set[RegKey]) -> set[RegKey]:
+        sub = sub_of.get(entry)
+        if sub is None:
+            return set()
+        results = {reg_key(reg, env) for reg in sub.results}
+        return (clobbers & live_after[entry]) - results - fixed
+
+    # the saved registers are not clobbered from the caller point of view.
+    # Starting from the raw clobbers and removing the saved ones until the fixpoint
+    clobbers: dict[BasicBlock, set[RegKey]] = {}
+    for entry, (written, _, is_unknown, _) in regions.items():
+        clobbers[entry] = set(all_regs) if is_unknown else set(written)
+    changed = True
+    while changed:
+        changed = False
+        effective = {entry: clobbers[entry] - saves_of(entry, clobbers[entry]) for entry in regions}
+        for entry, (written, callees, is_unknown, _) in regions.items():
+            if is_unknown:
+                continue
+            new = set(written)
+            for callee in callees:
+                new |= effective[callee]
+            if new != clobbers[entry]:
+                clobbers[entry] = new
+                changed = True
+
+    frames: dict[Subroutine, tuple[list[Code], list[Code]]] = {}
+    for entry, sub in sub_of.items():
+        saves = sorted(saves_of(entry, clobbers[entry]), key=_key_order)
+        frames[sub] = _frame([key if isinstance(key, VReg) else Reg(key // 4) for key in saves], sub.is_leaf)
+
+    # registers read by the subroutine or its callees
+    reads: dict[BasicBlock, set[RegKey]] = {}
+    for entry in regions:
+        read: set[RegKey] = set()
+        seen: set[BasicBlock] = set()
+        pending = [entry]
+        while pending:
+            block = pending.pop()
+            if block not in seen:
+                seen.add(block)
+                read |= set(all_regs) if regions[block][2] else regions[block][3]
+                pending.extend(regions[block][1])
+        reads[entry] = read
+
+    # The tail call is possible if the callee doesn't read and keeps the registers restored by the caller epilogue
+    effective = {entry: clobbers[entry] - saves_of(entry, clobbers[entry]) for entry in regions}
+    skip: set[int] = set()
+    tails: dict[_TailCall, list[Code]] = {}
+    for item in code:
+        if isinstance(item, _TailCall):
+            callee = cfg.block_of.get(branch_target(item.call))  # type: ignore[arg-type]
+            sub = item.sub
+            saves = saves_of(cfg.block_of[sub.label], clobbers[cfg.block_of[sub.label]])
+            if callee in effective and not (effective[callee] | reads[callee]) & saves:
+                tails[item] = [frames[sub][1], _tail_jump(item.call, sub.is_leaf)]
+                skip |= {id(item.call), id(item.epilogue), id(item.ret)}
+
+    # registers live before the instruction
+    def live_at(inst: Inst) -> set[RegKey]:
+        block = cfg.block_of[inst]
+        live = set(live_out[block])
+        for other in reversed(block.insts):
+            uses, defs = uses_defs(other, env, host_regs)
+            live = (live - defs) | uses
+            if other is inst:
+                break
+        return live
+
+    inline_frames: dict[int, list[Code]] = {}
+    starts: list[int] = []
+    for i in inlines:
+        item = code[i]
+        assert isinstance(item, _InlineFrame)
+        if item.is_prologue:
+            starts.append(i)
+            continue
+        start = starts.pop()
+        written: set[RegKey] = set()
+        for inst in code[start:i]:
+            if isinstance(inst, Inst):
+                written |= writes(inst, env)
+            if isinstance(inst, (BrLnk, JmpLnk)):
+                target = branch_target(inst)
+                callee = cfg.block_of.get(target) if target is not None else None
+                written |= effective[callee] if callee is not None and callee in effective else all_regs
+        after = next((inst for inst in code[i:] if isinstance(inst, Inst)), None)
+        live = live_at(after) if after is not None else host_regs
+        results = {reg_key(reg, env) for reg in item.sub.results}
+        saves = sorted((written & live) - results - fixed, key=_key_order)
+        prologue, epilogue = _frame([key if isinstance(key, VReg) else Reg(key // 4) for key in saves], True)
+        inline_frames[id(code[start])] = prologue
+        inline_frames[id(item)] = epilogue
+
+    out: list[Inst | Label | Directive] = []
+    for item in code:
+        if id(item) in skip:
+            continue
+        if isinstance(item, _InlineFrame):
+            out.extend(it for it in flat_code(inline_frames[id(item)]) if it is not None)  # type: ignore[misc]
+        elif isinstance(item, _TailCall):
+            out.extend(it for it in flat_code(tails.get(item, [])) if it is not None)  # type: ignore[misc]
+        elif isinstance(item, _AutoFrame):
+            prologue, epilogue = frames[item.sub]
+            out.extend(it for it in flat_code(prologue if item.is_prologue else epilogue) if it is not None)  # type: ignore[misc]
+        else:
+            out.append(item)
+    return out
 
 
 def pack(code: Code):
@@ -0,0 +1,910 @@
+"""Optimization passes over the flattened code.
+
+The pass is a callable (code, env) -> code. Passes are opt-in, e.g.
+`Script(code, passes=[peephole])`.
+"""
+
+from __future__ import annotations
+
+import copy
+from array import array
+from typing import Any, Callable, Iterable, Sequence
+
+from .asm import Directive, Label, MemAddr, NamedReg, Reg, VReg
+from .cfg import (
+    CFG,
+    BasicBlock,
+    RegKey,
+    branch_target,
+    falls_through,
+    host_registers,
+    liveness,
+    reg_key,
+    refs_of,
+    uses_defs,
+    via_pointer,
+    writes,
+)
+from .core import (
+    _IMM_RANGE,
+    _S32_MIN,
+    _U32_MAX,
+    Abs,
+    Add,
+    And,
+    And2,
+    BitAnd,
+    BitOr,
+    BitXor,
+    Bool,
+    Br,
+    BrEq,
+    BrGe,
+    BrGeU,
+    BrGt,
+    BrGtU,
+    BrLnk,
+    BrNe,
+    CmpKind,
+    Comparison,
+    Div,
+    DivU,
+    IMem,
+    Imm,
+    ImmExpr,
+    ImmOffset,
+    Inst,
+    Inv,
+    JmpLnk,
+    LdB,
+    LdBU,
+    LdH,
+    LdHU,
+    LongMul,
+    LongMulU,
+    LShift,
+    Max,
+    Min,
+    Mov,
+    MovEq,
+    MovGe,
+    MovGeU,
+    MovGt,
+    MovGtU,
+    Mul,
+    Neg,
+    Nop,
+    Not,
+    Op,
+    Or,
+    Or2,
+    Rem,
+    RemU,
+    RShift,
+    RShiftU,
+    StB,
+    StH,
+    Sub,
+    TstEq,
+    TstGe,
+    TstGeU,
+    TstGt,
+    TstGtU,
+    TstNe,
+    _BranchIf,
+    _Fused,
+    cast_s32,
+)
+from .env import Env
+from .exc import BuildError
+from .ir import MEM, OBJ, Block
+from .profile import Profile
+
+Item = Inst | Label | Directive
+
+
+def referenced(code: Iterable[Item]) -> set[Inst]:
+    """Instructions referenced by the operands of other instructions.
+    These can't be removed or replaced since the identity matters
+    """
+    out: set[Inst] = set()
+    for inst in code:
+        if isinstance(inst, Inst):
+            out.update(ref for ref in refs_of(inst) if isinstance(ref, Inst))
+    return out
+
+
+def static_addr(opd: Any, env: Env) -> int | None:
+    """Address of the register or memory, if it's known before the build"""
+    if isinstance(opd, MemAddr):
+        return opd._addr
+    if isinstance(opd, NamedReg):
+        n = env.named_registers.get(opd.name)
+        return None if n is None else n * 4
+    return None
+
+
+def _same(a: Any, b: Any, env: Env) -> bool:
+    addr = static_addr(a, env)
+    return addr is not None and addr == static_addr(b, env)
+
+
+def _log2(v: int) -> int | None:
+    v &= _U32_MAX
+    if v and not v & (v - 1):
+        return v.bit_length() - 1
+    return None
+
+
+def _imm(v: int) -> int | None:
+    v = cast_s32(v & _U32_MAX)
+    if _IMM_RANGE[0] <= v < _IMM_RANGE[1]:
+        return v
+    return None
+
+
+def _addend(op: Inst) -> int | None:
+    """Immediate of Add/Sub of the form t = t +- imm"""
+    if type(op) is Add or type(op) is Sub:
+        b = op.srcs[1]
+        if isinstance(b, Imm) and not isinstance(op.srcs[0], Imm):
+            return b if type(op) is Add else -b
+    return None
+
+
+def _reduce(op: Op) -> Op | None:
+    """Strength reduction of the multiplications and divisions by power of 2"""
+    cls = type(op)
+    if cls not in (Mul, DivU, RemU):
+        return None
+    t = op.tgts[0]
+    a, b = op.srcs
+    if cls is Mul and isinstance(a, Imm) and not isinstance(b, Imm):
+        a, b = b, a
+    if not isinstance(b, Imm) or isinstance(a, Imm):
+        return None
+    k = _log2(b)
+    if k is None:
+        return None
+    if k == 0 and cls is not RemU:
+        return Mov(t, a)
+    if cls is Mul:
+        return LShift(t, a, k)
+    if cls is DivU:
+        return RShiftU(t, a, k)
+    return BitAnd(t, a, (1 << k) - 1)
+
+
+def _next_inst(code: Sequence[Item], i: int) -> tuple[int, list[Item]]:
+    """Index of the next instruction after i and the labels/directives in between"""
+    between: list[Item] = []
+    i += 1
+    while i < len(code) and not isinstance(code[i], Inst):
+        between.append(code[i])
+        i += 1
+    return i, between
+
+
+def _peephole_once(code: list[Item], env: Env) -> list[Item] | None:
+    fixed = referenced(code)
+    out: list[Item] = []
+    changed = False
+    i = 0
+    while i < len(code):
+        item = code[i]
+        if not isinstance(item, Op) or item in fixed:
+            out.append(item)
+            i += 1
+            continue
+
+        cls = type(item)
+        j, between = _next_inst(code, i)
+        # labels can't be left detached
+        is_removable = j < len(code)
+
+        # t = t
+        if cls is Mov and is_removable and _same(item.tgts[0], item.srcs[0], env):
+            changed = True
+            i += 1
+            continue
+
+        # branch to the next instruction
+        if cls is Br and is_removable:
+            offset = item.srcs[0]
+            if isinstance(offset, ImmOffset) and (any(x is offset.tgt for x in between) or offset.tgt is code[j]):
+                changed = True
+                i += 1
+                continue
+
+        # t = a + imm1; t = t + imm2
+        addend = _addend(item)
+        nxt = code[j] if j < len(code) else None
+        if (
+            addend is not None
+            and not between
+            and nxt is not None
+            and nxt not in fixed
+            and static_addr(item.tgts[0], env) is not None
+            and (addend2 := _addend(nxt)) is not None
+            and _same(item.tgts[0], nxt.tgts[0], env)  # type: ignore[union-attr]
+            and _same(item.tgts[0], nxt.srcs[0], env)  # type: ignore[union-attr]
+        ):
+            total = _imm(addend + addend2)
+            if total is not None:
+                if total == 0 and _same(item.tgts[0], item.srcs[0], env):
+                    pass
+                elif total == 0:
+                    out.append(Mov(item.tgts[0], item.srcs[0]))
+                else:
+                    out.append(Add(item.tgts[0], item.srcs[0], total))
+                changed = True
+                i = j + 1
+                continue
+
+        reduced = _reduce(item)
+        if reduced is not None:
+            out.append(reduced)
+            changed = True
+            i += 1
+            continue
+
+        out.append(item)
+        i += 1
+
+    return out if changed else None
+
+
+def peephole(code: Sequence[Item], env: Env) -> list[Item]:
+    """Local rewrites of the instruction sequences:
+
+    - `Mov` to itself is removed
+    - `Br` to the next instruction is removed
+    - consecutive `Add`/`Sub` of the immediates to the same target are merged
+    - `Mul`, `DivU`, `RemU` by the power of 2 are replaced by the shifts and masks
+
+    Instructions referenced by the operands are never touched.
+    """
+    out = list(code)
+    while (res := _peephole_once(out, env)) is not None:
+        out = res
+    return out
+
+
+_BRANCH_TESTS: dict[type[Op], Callable[[int, int], bool]] = {
+    BrEq: lambda a, b: a == b,
+    BrNe: lambda a, b: a != b,
+    BrGt: lambda a, b: cast_s32(a) > cast_s32(b),
+    BrGe: lambda a, b: cast_s32(a) >= cast_s32(b),
+    BrGtU: lambda a, b: a > b,
+    BrGeU: lambda a, b: a >= b,
+}
+
+
+def fold_branches(code: Sequence[Item], env: Env) -> list[Item]:
+    """Conditional branches comparing the immediates are replaced by the `Br` or removed"""
+    fixed = referenced(code)
+    last = max((i for i, item in enumerate(code) if isinstance(item, Inst)), default=-1)
+    out: list[Item] = []
+    for i, item in enumerate(code):
+        test = _BRANCH_TESTS.get(type(item))
+        if test and item not in fixed:
+            assert isinstance(item, _BranchIf)
+            a, b, offset = item.srcs
+            if isinstance(a, Imm) and isinstance(b, Imm) and isinstance(offset, ImmOffset):
+                if test(a & _U32_MAX, b & _U32_MAX):
+                    out.append(Br(offset.tgt))
+                    continue
+                # labels can't be left detached
+                if i < last:
+                    continue
+        out.append(item)
+    return out
+
+
+def thread_branches(code: Sequence[Item], env: Env) -> list[Item]:
+    """Branches to the unconditional `Br` are redirected to its target"""
+    cfg = CFG(code)
+    fixed = referenced(code)
+
+    def final_target(target: Inst | Label) -> Inst | Label:
+        seen: set[Inst] = set()
+        while (block := cfg.block_of.get(target)) is not None:
+            first = block.first
+            if type(first) is not Br or first in seen:
+                break
+            # the target must be the start of the block
+            if isinstance(target, Inst) and target is not first:
+                break
+            seen.add(first)
+            nxt = branch_target(first)
+            if nxt is None:
+                break
+            target = nxt
+        return target
+
+    out: list[Item] = []
+    for item in code:
+        if isinstance(item, (_BranchIf, Br, BrLnk)) and item not in fixed:
+            target = branch_target(item)
+            if target is not None:
+                new_target = final_target(target)
+                if new_target is not target:
+                    item = item.copy_with(srcs=[*item.srcs[:-1], ImmOffset(item, new_target)])
+        out.append(item)
+    return out
+
+
+def remove_unreachable(code: Sequence[Item], env: Env) -> list[Item]:
+    """Blocks not reachable from the entry points are removed.
+
+    The entry points are the first instruction, the named labels (e.g. `Label("main")`)
+    and the instructions/labels which address is used as a value (e.g. `D(label)`).
+    """
+    cfg = CFG(code)
+    live = cfg.reachable()
+    return cfg.code(block for block in cfg if block in live)
+
+
+def _u32(v: int) -> int:
+    return v & _U32_MAX
+
+
+def _div(a: int, b: int) -> int:
+    """C division: truncated toward zero"""
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+# Ops computing the target from the sources as the vm does.
+# Sources are s32. None is for the runtime error (or undefined behavior), these are not folded
+_FOLD: dict[type[Op], Callable[..., int | None]] = {
+    Mov: lambda a: a,
+    Add: lambda a, b: a + b,
+    Sub: lambda a, b: a - b,
+    Mul: lambda a, b: a * b,
+    Div: lambda a, b: None if b == 0 or (a == _S32_MIN and b == -1) else _div(a, b),
+    DivU: lambda a, b: _u32(a) // _u32(b) if b else None,
+    Rem: lambda a, b: None if b == 0 else 0 if b == -1 else a - b * _div(a, b),
+    RemU: lambda a, b: _u32(a) % _u32(b) if b else None,
+    And: lambda *s: next((v for v in s if not v), s[-1]),
+    Or: lambda *s: next((v for v in s if v), s[-1]),
+    And2: lambda a, b: b if a else a,
+    Or2: lambda a, b: a if a else b,
+    BitAnd: lambda a, b: a & b,
+    BitOr: lambda a, b: a | b,
+    BitXor: lambda a, b: a ^ b,
+    Inv: lambda a: ~a,
+    LShift: lambda a, b: 0 if _u32(b) >= 32 else a << b,
+    RShift: lambda a, b: a >> 31 if _u32(b) >= 32 else a >> b,
+    RShiftU: lambda a, b: 0 if _u32(b) >= 32 else _u32(a) >> b,
+    TstEq: lambda a, b: int(a == b),
+    TstNe: lambda a, b: int(a != b),
+    TstGt: lambda a, b: int(a > b),
+    TstGe: lambda a, b: int(a >= b),
+    TstGtU: lambda a, b: int(_u32(a) > _u32(b)),
+    TstGeU: lambda a, b: int(_u32(a) >= _u32(b)),
+    MovEq: lambda a, b, x, y: x if a == b else y,
+    MovGt: lambda a, b, x, y: x if a > b else y,
+    MovGe: lambda a, b, x, y: x if a >= b else y,
+    MovGtU: lambda a, b, x, y: x if _u32(a) > _u32(b) else y,
+    MovGeU: lambda a, b, x, y: x if _u32(a) >= _u32(b) else y,
+    Neg: lambda a: -a,
+    Abs: lambda a: abs(a),
+    Max: lambda *s: max(s),
+    Min: lambda *s: min(s),
+    Not: lambda a: int(not a),
+    Bool: lambda a: int(bool(a)),
+}
+
+# Ops writing nothing but the targets
+_LOCAL = {*_FOLD, LongMul, LongMulU, LdB, LdH, LdBU, LdHU, StB, StH, Nop, BrLnk, JmpLnk}
+
+# Operands are not the full words
+_SIZED = (LdB, LdH, LdBU, LdHU, StB, StH)
+
+
+def fold(op: Op) -> int | None:
+    """Result of the op if all sources are the immediates and it's computable at the build time"""
+    func = _FOLD.get(type(op))
+    if func is None or not all(isinstance(src, Imm) for src in op.srcs):
+        return None
+    res = func(*(cast_s32(_u32(src)) for src in op.srcs))
+    return None if res is None else cast_s32(_u32(res))
+
+
+def _forget(known: dict[RegKey, int], op: Op, env: Env):
+    """Drop the registers possibly written by the op"""
+    if type(op) not in _LOCAL:
+        known.clear()
+        return
+    for tgt in op.tgts:
+        key = reg_key(tgt, env)
+        if key is not None:
+            known.pop(key, None)
+            continue
+        addr = static_addr(tgt, env)
+        if addr is None:
+            # indirect store may hit anything
+            known.clear()
+            return
+        for key in [key for key in known if isinstance(key, int) and abs(key - addr) < 4]:
+            del known[key]
+
+
+def propagate_constants(code: Sequence[Item], env: Env) -> list[Item]:
+    """Registers holding the known constants are replaced by the immediates within the basic blocks.
+    Ops with all sources known are folded to the `Mov` of the result.
+
+    Run `fold_branches` after it to fold the branches on the known values and
+    `remove_dead_stores` to drop the assignments no longer used.
+    """
+    cfg = CFG(code)
+    fixed = referenced(code)
+    out: list[Item] = []
+    for block in cfg:
+        known: dict[RegKey, int] = {}
+        for item in block.items:
+            if not isinstance(item, Op):
+                out.append(item)
+                continue
+            op = item
+            if op not in fixed and not isinstance(op, _SIZED):
+                srcs = [Imm(known[key]) if (key := reg_key(src, env)) in known else src for src in op.srcs]
+                if any(new is not old for new, old in zip(srcs, op.srcs, strict=True)):
+                    op = op.copy_with(srcs=srcs)
+                res = fold(op)
+                if res is not None and type(op) is not Mov:
+                    op = Mov(op.tgts[0], res)
+            _forget(known, op, env)
+            if type(op) is Mov and (res := fold(op)) is not None and (key := reg_key(op.tgts[0], env)) is not None:
+                known[key] = res
+            out.append(op)
+    return out
+
+
+def _is_pure(op: Op) -> bool:
+    """Op has no effect besides writing the targets and never fails"""
+    cls = type(op)
+    if cls in (Div, DivU, Rem, RemU):
+        b = op.srcs[1]
+        return isinstance(b, Imm) and cast_s32(_u32(b)) not in (0, -1)
+    return cls in _FOLD or cls is LongMul or cls is LongMulU
+
+
+def remove_dead_stores(code: Sequence[Item], env: Env) -> list[Item]:
+    """Ops writing the registers not read afterwards are removed.
+
+    All registers are assumed to be live at the `Exit` and at the end of code (the host may inspect them).
+    The memory read via the pointer may be any of the registers but the virtual ones.
+    """
+    cfg = CFG(code)
+    _, live_out = liveness(cfg, env)
+    host_regs = host_registers(cfg, env)
+    fixed = referenced(code)
+    insts = [item for item in code if isinstance(item, Inst)]
+    # labels can't be left detached
+    last = insts[-1] if insts else None
+    dead: set[int] = set()
+    for block in cfg:
+        live = set(live_out[block])
+        for inst in reversed(block.insts):
+            uses, defs = uses_defs(inst, env, host_regs)
+            if (
+                isinstance(inst, Op)
+                and inst is not last
+                and inst not in fixed
+                and _is_pure(inst)
+                and len(defs) == len(inst.tgts)
+                and not defs & live
+            ):
+                dead.add(id(inst))
+                continue
+            live -= defs
+            live |= uses
+    return [item for item in code if id(item) not in dead]
+
+
+def natural_loops(cfg: CFG) -> list[tuple[BasicBlock, set[BasicBlock]]]:
+    """Loops as the (header, body blocks), the smaller (inner) first.
+    The back-edge is the branch to the same or the earlier block
+    """
+    bodies: dict[BasicBlock, set[BasicBlock]] = {}
+    for block in cfg:
+        last = block.last
+        target = branch_target(last) if last is not None else None
+        header = cfg.block_of.get(target) if target is not None else None
+        if header is None or header.index > block.index:
+            continue
+        body = bodies.setdefault(header, {header})
+        stack = [block]
+        while stack:
+            b = stack.pop()
+            if b not in body:
+                body.add(b)
+                stack.extend(b.preds)
+    return sorted(bodies.items(), key=lambda item: (len(item[1]), item[0].index))
+
+
+def _dominators(header: BasicBlock, body: set[BasicBlock]) -> dict[BasicBlock, set[BasicBlock]]:
+    """Dominators of the loop blocks within the loop"""
+    order = sorted(body, key=lambda b: b.index)
+    dom = {block: set(body) for block in body}
+    dom[header] = {header}
+    changed = True
+    while changed:
+        changed = False
+        for block in order:
+            if block is header:
+                continue
+            preds = [dom[pred] for pred in block.preds if pred in body]
+            new = set.intersection(*preds) | {block} if preds else {block}
+            if new != dom[block]:
+                dom[block] = new
+                changed = True
+    return dom
+
+
+def _hoist_once(code: Sequence[Item], env: Env) -> list[Item] | None:
+    """Code with the invariants of the first suitable loop hoisted, None if there are none"""
+    cfg = CFG(code)
+    live_in, live_out = liveness(cfg, env)
+    fixed = referenced(code)
+    entries = {*cfg.entries, *cfg.address_taken, *cfg.return_points}
+    for header, body in natural_loops(cfg):
+        # preheader is the end of the previous block, the only way into the loop
+        if header.index == 0 or header in entries:
+            continue
+        pre = cfg.blocks[header.index - 1]
+        last = pre.last
+        if [pred for pred in header.preds if pred not in body] != [pre] or last is None or not falls_through(last):
+            continue
+        target = branch_target(last)
+        if target is not None and cfg.block_of.get(target) is header:
+            continue
+        if any(block in entries or any(pred not in body for pred in block.preds) for block in body - {header}):
+            continue
+        insts = [inst for block in body for inst in block.insts]
+        # calls may write anything
+        if any(block.is_indirect for block in body) or any(isinstance(inst, (BrLnk, JmpLnk)) for inst in insts):
+            continue
+
+        defs: dict[RegKey, int] = {}
+        host_regs = host_registers(cfg, env)
+        for inst in insts:
+            # store via the pointer may hit any register
+            for key in [*writes(inst, env), *(host_regs if via_pointer(inst, env)[1] else ())]:
+                defs[key] = defs.get(key, 0) + 1
+        dom = _dominators(header, body)
+        # registers seen after leaving the loop from the exiting blocks
+        exits: dict[BasicBlock, set[RegKey]] = {}
+        for block in body:
+            if not block.succs:
+                exits[block] = live_out[block]
+            elif any(succ not in body for succ in block.succs):
+                exits[block] = set().union(*(live_in[succ] for succ in block.succs if succ not in body))
+
+        hoisted: list[Op] = []
+        moved: set[RegKey] = set()
+        for block in sorted(body, key=lambda b: b.index):
+            for inst in block.insts:
+                if not isinstance(inst, Op) or inst in fixed or not _is_pure(inst):
+                    continue
+                keys = [reg_key(tgt, env) for tgt in inst.tgts]
+                srcs = [reg_key(src, env) for src in inst.srcs if not isinstance(src, (Imm, ImmExpr))]
+                if None in keys or None in srcs:
+                    continue
+                if any(key in defs and key not in moved for key in srcs):
+                    continue
+                # value may be seen after the loop before the op is executed
+                seen = set().union(*(regs for x, regs in exits.items() if block not in dom[x]))
+                if any(defs[key] != 1 or key in live_in[header] or key in seen for key in keys):
+                    continue
+                hoisted.append(inst)
+                moved.update(keys)
+        if hoisted:
+            ids = {id(op) for op in hoisted}
+            first = header.items[0]
+            out: list[Item] = []
+            for item in code:
+                if item is first:
+                    out.extend(hoisted)
+                if id(item) not in ids:
+                    out.append(item)
+            return out
+    return None
+
+
+def hoist_invariants(code: Sequence[Item], env: Env) -> list[Item]:
+    """Loop-invariant ops are moved to the preheader, before the loop.
+
+    The op is invariant if its sources are the immediates or the registers not written in the loop.
+    It's moved if it's the only op writing the target in the loop, the target is not read before it
+    and is not seen after the loop unless the op is surely executed.
+    Only the pure ops (never failing, writing nothing but the registers) are moved. The loops with the calls
+    or the indirect jumps are skipped. The store via the pointer is assumed to write any register
+    but the virtual ones. The loop must be entered by falling through to its first block.
+    """
+    out = list(code)
+    while (hoisted := _hoist_once(out, env)) is not None:
+        out = hoisted
+    return out
+
+
+def leaves(opd: Any) -> Iterable[Any]:
+    """Direct memory and register operands, including the ones inside the indirect"""
+    if isinstance(opd, IMem):
+        yield from leaves(opd.ref)
+        yield from leaves(opd.offset)
+    elif isinstance(opd, (MemAddr, VReg)):
+        yield opd
+
+
+def map_registers(code: Sequence[Item], func: Callable[[Any], Any]) -> list[Item]:
+    """Code with the direct memory and register operands replaced by `func(opd)`.
+    The `func` returns the operand itself to keep it. The changed instructions are copied
+    """
+    fixed = referenced(code)
+
+    def rename(opd: Any) -> Any:
+        if isinstance(opd, IMem):
+            ref = rename(opd.ref)
+            offset = rename(opd.offset)
+            if ref is opd.ref and offset is opd.offset:
+                return opd
+            new = copy.copy(opd)
+            new.ref = ref
+            new.offset = offset
+            return new
+        if isinstance(opd, (MemAddr, VReg)):
+            return func(opd)
+        return opd
+
+    out: list[Item] = []
+    for item in code:
+        if isinstance(item, Op):
+            tgts = [rename(opd) for opd in item.tgts]
+            srcs = [rename(opd) for opd in item.srcs]
+            if any(a is not b for a, b in zip([*tgts, *srcs], [*item.tgts, *item.srcs], strict=True)):
+                if item in fixed:
+                    raise BuildError("Referenced instruction can't be changed", item)
+                item = item.copy_with(tgts=tgts, srcs=srcs)
+        elif isinstance(item, Block):
+            values = array("q", item.values)
+            for i, kind in enumerate(item.kinds):
+                if kind == MEM:
+                    opd = MemAddr(values[i])
+                    new = func(opd)
+                    if new is not opd:
+                        values[i] = new._addr
+            refs = [rename(ref) for ref in item.refs]
+            if values != item.values or any(a is not b for a, b in zip(refs, item.refs, strict=True)):
+                if item in fixed:
+                    raise BuildError("Referenced instruction can't be changed", item)
+                item = copy.copy(item)
+                item.values = values
+                item.refs = refs
+        out.append(item)
+    return out
+
+
+def _operands(inst: Inst, profile: Profile | None) -> Iterable[tuple[Any, int]]:
+    """Operands of the instruction with the weights"""
+    if isinstance(inst, Op):
+        weight = 1 if profile is None else profile.count(inst)
+        for opd in (*inst.tgts, *inst.srcs):
+            yield opd, weight
+    elif isinstance(inst, Block):
+        for row in range(len(inst)):
+            weight = 1 if profile is None else profile.count(inst, row)
+            for i in range(inst.starts[row], inst.starts[row + 1]):
+                kind = inst.kinds[i]
+                if kind == MEM:
+                    yield MemAddr(inst.values[i]), weight
+                elif kind == OBJ:
+                    yield inst.refs[inst.values[i]], weight
+
+
+def renumber_registers(
+    relocatable: Iterable[Reg],
+    *,
+    spare: Iterable[Reg] = (),
+    profile: Profile | None = None,
+) -> Callable[[Sequence[Item], Env], list[Item]]:
+    """Pass assigning the new numbers to the `relocatable` registers.
+
+    The most used registers get the lowest numbers from the pool of `relocatable` and `spare`
+    register numbers. The small numbers are encoded shorter (registers 0-15 as sources are 1 byte).
+    The use counts are static or taken from the execution `profile`.
+    All other registers, including the named ones, are kept.
+
+    The relocatable registers must be accessed by the code only directly: not via the
+    indirect memory operands and not by the host.
+    """
+    moved = {reg.n for reg in relocatable}
+    free = {reg.n for reg in spare}
+
+    def renumber(code: Sequence[Item], env: Env) -> list[Item]:
+        named = set(env.named_registers.values())
+        if (moved | free) & named:
+            raise BuildError("Named registers can't be renumbered", sorted((moved | free) & named))
+
+        execs: dict[int, int] = {}
+        uses: dict[int, int] = {}
+        pinned: set[int] = set()
+        for inst in code:
+            if not isinstance(inst, Inst):
+                continue
+            for opd, weight in _operands(inst, profile):
+                for leaf in leaves(opd):
+                    if not isinstance(leaf, MemAddr):
+                        continue
+                    addr = leaf._addr
+                    n = addr // 4
+                    if n in moved or (addr % 4 and n + 1 in moved):
+                        if addr % 4:
+                            raise BuildError("Unaligned access to the relocatable register", inst)
+                        execs[n] = execs.get(n, 0) + weight
+                        uses[n] = uses.get(n, 0) + 1
+                    else:
+                        pinned.add(n)
+                        if addr % 4:
+                            pinned.add(n + 1)
+        if free & pinned:
+            raise BuildError("Spare registers are used by the code", sorted(free & pinned))
+
+        pool = sorted(moved | free)
+        order = sorted(execs, key=lambda n: (-execs[n], -uses[n], n))
+        mapping = dict(zip(order, pool, strict=False))
+        if all(n == new for n, new in mapping.items()):
+            return list(code)
+
+        def rename(opd: Any) -> Any:
+            if isinstance(opd, MemAddr) and opd._addr // 4 in mapping:
+                n = mapping[opd._addr // 4]
+                return Reg(n) if isinstance(opd, Reg) else MemAddr(n * 4)
+            return opd
+
+        return map_registers(code, rename)
+
+    return renumber
+
+
+_CMP_KINDS: dict[type[Op], CmpKind] = {BrEq: "==", BrNe: "!=", BrGt: ">", BrGe: ">="}
+# inverted with the operands swapped
+_UNSIGNED_INVERSE: dict[type[Op], type[_BranchIf]] = {BrGtU: BrGeU, BrGeU: BrGtU}
+
+
+def _inverted(op: _BranchIf, addr: Label) -> _BranchIf:
+    """Branch taken if the `op` is not"""
+    a, b, _ = op.srcs
+    kind = _CMP_KINDS.get(type(op))
+    if kind is not None:
+        return Comparison(kind, a, b).as_else_branch_to(addr)
+    return _UNSIGNED_INVERSE[type(op)](b, a, addr)
+
+
+def reorder_blocks(profile: Profile) -> Callable[[Sequence[Item], Env], list[Item]]:
+    """Pass placing the basic blocks to fall through along the most executed edges of the `profile`.
+
+    The chains of blocks are linked greedily, the hottest edges first. The conditional branch to
+    the following block is inverted, the `Br` to it is removed, the broken fall-throughs get the `Br`.
+    The first block stays first, the calls are kept followed by their return points.
+    """
+
+    def reorder(code: Sequence[Item], env: Env) -> list[Item]:
+        cfg = CFG(code)
+        blocks = cfg.blocks
+        if len(blocks) < 2:
+            return list(code)
+        fixed = referenced(code)
+
+        def is_data(block: BasicBlock) -> bool:
+            first = block.first
+            return first is not None and not isinstance(first, (Op, Block))
+
+        def is_glued(block: BasicBlock) -> bool:
+            """Block must be followed by the next one"""
+            if block.index + 1 == len(blocks):
+                return False
+            last = block.last
+            # calls are returning to the next block. The data and ir.Block are kept in place
+            if last is None or not isinstance(last, Op) or isinstance(last, (BrLnk, JmpLnk, _Fused)):
+                return True
+            return is_data(blocks[block.index + 1])
+
+        # runs of the glued blocks
+        segments: list[list[BasicBlock]] = [[blocks[0]]]
+        for block in blocks[1:]:
+            if is_glued(blocks[block.index - 1]):
+                segments[-1].append(block)
+            else:
+                segments.append([block])
+        head_of = {segment[0]: i for i, segment in enumerate(segments)}
+        # labels at the end of code are kept there
+        items = blocks[-1].items
+        last = blocks[-1].last
+        is_end = not isinstance(last, Op) or falls_through(last) or not isinstance(items[-1], Inst)
+        pinned = len(segments) - 1 if is_end else None
+
+        edges: list[tuple[int, int, int]] = []
+        for i, segment in enumerate(segments):
+            tail = segment[-1]
+            last = tail.last
+            if not isinstance(last, Op) or i == pinned:
+                continue
+            succs: list[BasicBlock] = []
+            target = branch_target(last)
+            if isinstance(last, (_BranchIf, Br)) and target is not None and target in cfg.block_of:
+                succs.append(cfg.block_of[target])
+            if falls_through(last) and tail.index + 1 < len(blocks):
+                succs.append(blocks[tail.index + 1])
+            for succ in succs:
+                j = head_of.get(succ)
+                if j is None or j == 0 or j == pinned or succ.first is None:
+                    continue
+                weight = profile.pairs.get((last, succ.first), 0)
+                if weight:
+                    edges.append((weight, i, j))
+
+        # chains of segments
+        nxt: dict[int, int] = {}
+        prv: dict[int, int] = {}
+        for _, i, j in sorted(edges, key=lambda edge: -edge[0]):
+            if i in nxt or j in prv:
+                continue
+            # no cycles
+            k = i
+            while k in prv:
+                k = prv[k]
+            if k == j:
+                continue
+            nxt[i] = j
+            prv[j] = i
+        if not nxt:
+            return list(code)
+
+        order: list[BasicBlock] = []
+        for i in range(len(segments)):
+            if i in prv:
+                continue
+            k: int | None = i
+            while k is not None:
+                order.extend(segments[k])
+                k = nxt.get(k)
+
+        items_of = {block: list(block.items) for block in blocks}
+
+        def label_of(block: BasicBlock) -> Label:
+            items = items_of[block]
+            for item in items:
+                if isinstance(item, Label):
+                    return item
+                if isinstance(item, Inst):
+                    break
+            label = Label()
+            items.insert(0, label)
+            return label
+
+        for pos, block in enumerate(order):
+            following = order[pos + 1] if pos + 1 < len(order) else None
+            orig = blocks[block.index + 1] if block.index + 1 < len(blocks) else None
+            last = block.last
+            if orig is following or not isinstance(last, Op):
+                continue
+            items = items_of[block]
+            target = branch_target(last)
+            is_next = target is not None and following is not None and cfg.block_of.get(target) is following
+            if isinstance(last, _BranchIf) and orig is not None:
+                if is_next and last not in fixed:
+                    items[items.index(last)] = _inverted(last, label_of(orig))
+                else:
+                    items.append(Br(label_of(orig)))
+            elif isinstance(last, Br):
+                if is_next and last not in fixed:
+                    items.remove(last)
+            elif falls_through(last) and orig is not None:
+                items.append(Br(label_of(orig)))
+
+        return [item for block in order for item in items_of[block]]
+
+    return reorder
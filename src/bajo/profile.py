@@ -0,0 +1,73 @@
+"""Execution profile of the script.
+
+The profile is collected by running the built script and recording the executed pcs
+(e.g. by single-stepping the vm). The counts are keyed by the instruction objects, so the
+profile of one build applies to the next build of the same code. The superinstructions are
+counted as the pairs they replaced.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterable, Mapping, Sequence
+
+from .core import Inst, _Fused
+from .ir import Block
+
+if TYPE_CHECKING:
+    from .script import Script
+
+
+class Profile:
+    """Execution counts of the instructions. The `rows` are the per-row counts of `ir.Block`s,
+    the `pairs` are the counts of instructions executed one after another
+    """
+
+    def __init__(
+        self,
+        counts: Mapping[Inst, int],
+        rows: Mapping[Block, Sequence[int]] | None = None,
+        pairs: Mapping[tuple[Inst, Inst], int] | None = None,
+    ):
+        self.counts = dict(counts)
+        self.rows = dict(rows or {})
+        self.pairs = dict(pairs or {})
+
+    @classmethod
+    def from_trace(cls, script: Script, trace: Iterable[int]) -> Profile:
+        """Profile from the executed pcs of the script build"""
+        lay = script.layout
+        at: dict[int, tuple[Inst, int]] = {}
+        for inst in lay.insts:
+            base = lay.addrof(inst)
+            offsets = lay.offsets.get(inst)
+            if offsets is None:
+                at[base] = (inst, 0)
+            else:
+                for row in range(len(offsets) - 1):
+                    at[base + offsets[row]] = (inst, row)
+
+        counts: dict[Inst, int] = {}
+        rows: dict[Block, list[int]] = {}
+        pairs: dict[tuple[Inst, Inst], int] = {}
+        prev: Inst | None = None
+        for pc in trace:
+            found = at.get(pc)
+            if found is None:
+                prev = None
+                continue
+            inst, row = found
+            if isinstance(inst, Block):
+                per_row = rows.setdefault(inst, [0] * len(inst))
+                per_row[row] += 1
+            for part in inst.origin if isinstance(inst, _Fused) and inst.origin else (inst,):
+                counts[part] = counts.get(part, 0) + 1
+                if prev is not None:
+                    pairs[(prev, part)] = pairs.get((prev, part), 0) + 1
+                prev = part
+        return cls(counts, rows, pairs)
+
+    def count(self, inst: Inst, row: int | None = None) -> int:
+        """Times the instruction (or the row of `ir.Block`) was executed"""
+        if row is not None and inst in self.rows:
+            return self.rows[inst][row]  # type: ignore[index]
+        return self.counts.get(inst, 0)
@@ -0,0 +1,89 @@
+"""Allocation of the virtual registers.
+
+Two virtual registers interfere if one is written while the other is live (see `cfg.liveness`).
+The registers are colored greedily, the most used first, with the lowest number of
+`Env.scratch_registers` not taken by the interfering ones. The numbers of registers referenced by
+the code directly and the named registers are never used. The default env has the r16-r31 pool,
+the custom env has none unless configured.
+
+Script is allocating the registers after the optimization passes.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Sequence
+
+from .asm import MemAddr, Reg, VReg
+from .cfg import CFG, liveness, uses_defs, writes
+from .core import Inst
+from .env import Env
+from .exc import BuildError
+from .opt import Item, _operands, leaves, map_registers
+
+
+def interference(code: Sequence[Item], env: Env) -> dict[VReg, set[VReg]]:
+    """Virtual registers which can't share the physical one"""
+    out: dict[VReg, set[VReg]] = {}
+    for item in code:
+        if isinstance(item, Inst):
+            for opd, _ in _operands(item, None):
+                for leaf in leaves(opd):
+                    if isinstance(leaf, VReg):
+                        out.setdefault(leaf, set())
+    if not out:
+        return out
+
+    cfg = CFG(code)
+    _, live_out = liveness(cfg, env)
+    for block in cfg:
+        live = {key for key in live_out[block] if isinstance(key, VReg)}
+        for inst in reversed(block.insts):
+            uses, defs = uses_defs(inst, env)
+            for key in defs | writes(inst, env):
+                if isinstance(key, VReg):
+                    out[key] |= live - {key}
+                    for other in live:
+                        if other is not key:
+                            out[other].add(key)
+            live -= defs
+            live |= {key for key in uses if isinstance(key, VReg)}
+    return out
+
+
+def allocate_registers(code: Sequence[Item], env: Env) -> list[Item]:
+    """Code with the virtual registers replaced by the physical ones"""
+    graph = interference(code, env)
+    if not graph:
+        return list(code)
+
+    uses: dict[VReg, int] = dict.fromkeys(graph, 0)
+    taken = set(env.named_registers.values())
+    for item in code:
+        if not isinstance(item, Inst):
+            continue
+        for opd, _ in _operands(item, None):
+            for leaf in leaves(opd):
+                if isinstance(leaf, VReg):
+                    uses[leaf] += 1
+                elif isinstance(leaf, MemAddr):
+                    taken.add(leaf._addr // 4)
+                    if leaf._addr % 4:
+                        taken.add(leaf._addr // 4 + 1)
+    if not env.scratch_registers:
+        raise BuildError("No Env.scratch_registers for the virtual registers", next(iter(graph)))
+    pool = [n for n in env.scratch_registers if n not in taken]
+
+    numbers: dict[VReg, int] = {}
+    for vreg in sorted(graph, key=lambda v: (-uses[v], v.serial)):
+        busy = {numbers[other] for other in graph[vreg] if other in numbers}
+        n = next((n for n in pool if n not in busy), None)
+        if n is None:
+            raise BuildError("Out of scratch registers", vreg)
+        numbers[vreg] = n
+
+    def assign(opd: Any) -> Any:
+        if isinstance(opd, VReg):
+            return Reg(numbers[opd])
+        return opd
+
+    return map_registers(code, assign)
@@ -1,30 +1,35 @@
+import mmap
 from functools import cached_property
-from typing import Iterator, Sequence
+from typing import Callable, Iterator, Sequence
 
-from . import builder
-from .asm import Code, Directive, Label
-from .core import Exit, Inst
+from . import builder, fuse, macro, regalloc
+from .asm import Code, Directive, Label, flat_code
+from .core import Exit, Inst, ProvidesLayout
 from .env import Env
+from .ir import Block
+
+WritableBuffer = bytearray | memoryview | mmap.mmap
+
+# (code, env) -> code
+Pass = Callable[[list[Inst | Label | Directive], Env], list[Inst | Label | Directive]]
 
 DEF_ENV = Env(
     ram_region=(0, 0x1_00_00),
     code_region=(0x1_00_00, 0x1_00_00_00_00),
     named_registers={"sp": 13, "lr": 14},
+    scratch_registers=range(16, 32),
 )
 
 
-def flat_code(code: Code) -> Iterator[Inst | Label | Directive | None | bool]:
-    if code is None or code is False or code is True or isinstance(code, (Inst, Label, Directive)):
-        yield code
-    else:
-        for item in code:
-            yield from flat_code(item)
+def _listing_line(inst: Inst, lay: ProvidesLayout):
+    return f"{ inst.addr_from(lay) :>8x}:\t{ inst.encode_for(lay).hex(' ') :24}" + inst.repr_for(lay)
 
 
 class Script:
-    def __init__(self, code: Code, *, env: Env | None = None, add_exit=True):
+    def __init__(self, code: Code, *, env: Env | None = None, add_exit=True, passes: Sequence[Pass] = ()):
         self.env = env or DEF_ENV
         self.add_exit = add_exit
+        self.passes = passes
         self.code = code
         self._layout: builder.BuildCtx | None = None
 
@@ -42,10 +47,14 @@ class Script:
             labels = all_labels.get(inst)
             if labels:
                 lines.extend(f".{ label }" for label in labels)
-            line = f"{ inst.addr_from(lay) :>8x}:\t{ inst.encode_for(lay).hex(' ') :24}"
-            if isinstance(inst, Inst):
-                line += inst.repr_for(lay)
-            lines.append(line)
+            if isinstance(inst, Block):
+                # ops are materialized here only
+                for row, (op, row_lay) in enumerate(inst.ops_for(lay)):
+                    lines.extend(f".{ label }" for label in inst.labels_at(row))
+                    lines.append(_listing_line(op, row_lay))
+                lines.extend(f".{ label }" for label in inst.labels_at(len(inst)))
+            else:
+                lines.append(_listing_line(inst, lay))
         return "\n".join(lines)
 
     @property
@@ -66,8 +75,14 @@ class Script:
 
     @cached_property
     def layout(self) -> builder.BuildCtx:
-        code = self._code_as_list()
+        code = macro.lower_frames(self._code_as_list(), self.env)
         builder.check(code)
+        for pass_ in self.passes:
+            code = pass_(code, self.env)
+            builder.check(code)
+        code = regalloc.allocate_registers(code, self.env)
+        if self.env.superinstructions:
+            code = fuse.fuse_superinstructions(code, self.env)
         return builder.build(code, self.env)
 
     @property
@@ -75,13 +90,47 @@ class Script:
         return self.layout.insts
 
     def encode(self) -> bytes:
+        """Bytecode as the new bytes, joined from the instructions at once. See `encode_into` for the caller's buffer"""
         if not self.result:
             return b""
-        bytecodes = [inst.encode_for(self.layout) for inst in self.result]
-        res = b"".join(bytecodes)
+        lay = self.layout
+        res = b"".join([inst.encode_for(lay) for inst in self.result])
         # Doublechecking result len to by safe
-        end = self.result[-1].addr_from(self.layout) + len(bytecodes[-1])
-        start = self.env.code_region[0]
-        if start + len(res) != end:
-            raise AssertionError("Bytecode size mismatch", len(res), end - start)
+        if len(res) != lay.size:
+            raise AssertionError("Bytecode size mismatch", len(res), lay.size)
         return res
+
+    def encode_into(self, buf: WritableBuffer, offset: int = 0) -> int:
+        """Write the bytecode directly into the `buf` (bytearray, memoryview, mmap etc.) at `offset`.
+        Returns the number of bytes written
+        """
+        if not self.result:
+            return 0
+        lay = self.layout
+        size = lay.size
+        with memoryview(buf) as mv, mv.cast("B") as out:
+            if offset < 0 or offset + size > len(out):
+                raise ValueError("Buffer is too small", len(out), offset + size)
+            p = offset
+            for inst in self.result:
+                bytecode = inst.encode_for(lay)
+                out[p : p + len(bytecode)] = bytecode
+                p += len(bytecode)
+        # Doublechecking result len to by safe
+        if p - offset != size:
+            raise AssertionError("Bytecode size mismatch", p - offset, size)
+        return size
+
+    def iter_chunks(self, chunk_size: int = 4096) -> Iterator[bytes]:
+        """Yield the bytecode in chunks of at least `chunk_size` bytes (the last one may be shorter).
+        Useful for streaming to a file or socket.
+        """
+        lay = self.layout
+        chunk = bytearray()
+        for inst in self.result:
+            chunk += inst.encode_for(lay)
+            if len(chunk) >= chunk_size:
+                yield bytes(chunk)
+                chunk.clear()
+        if chunk:
+            yield bytes(chunk)
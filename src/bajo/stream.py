@@ -0,0 +1,439 @@
+"""Streaming build for the scripts too large to be kept in memory.
+
+The code is consumed from the (lazy) iterable just once. Each instruction is spilled into
+the temporary memory-mapped file as a compact record:
+
+- fixed bytes for instructions not depending on the layout (the most of the code)
+- pickled instruction for the rest. Labels are pickled as ids, so the objects are not duplicated
+- label definitions and aligns
+
+The layout is relaxed over the records. Unlike the main builder, it starts optimistic and the
+varints of instructions are never shrunk: the shorter value is encoded with the non-minimal
+width instead. The sizes are growing monotonically and the relaxation always converges.
+
+Limitations:
+- instructions may refer to labels only, not to the other instructions
+- instructions are not checked for duplicates
+- fixed instructions are checked against the whole code region
+"""
+
+from __future__ import annotations
+
+import io
+import mmap
+import pickle
+import struct
+import tempfile
+from array import array
+from typing import Any, BinaryIO, Iterator
+
+from .asm import Align, Code, Directive, Label, Pad, flat_code
+from .core import _MAX_VARINT_SIZE, Exit, Inst, Op
+from .env import Env
+from .exc import AddrError, BuildError, DetachedLabelError, DuplicateDefError, MissingDefError
+from .ir import Block
+from .macro import _AutoFrame
+from . import script
+
+# record kinds
+_FIXED = 0  # size, bytes
+_INST = 1  # size, nvarints, widths[nvarints], pickled inst
+_LABEL = 2  # label id
+_ALIGN = 3  # n
+
+_HEADER = struct.Struct("<BI")
+
+
+class _Unresolved(Exception):
+    pass
+
+
+def _varints(encoding: bytes) -> Iterator[tuple[int, int]]:
+    """Split the op encoding (sans mopcode) to the (value, width) of prefix varints"""
+    p = 1
+    while p < len(encoding):
+        width = (encoding[p] & -encoding[p]).bit_length()
+        yield int.from_bytes(encoding[p : p + width], "little") >> width, width
+        p += width
+
+
+def _encode_varint(val: int, width: int) -> bytes:
+    """Prefix varint of the exact width, possibly non-minimal"""
+    return ((val << width) | (1 << (width - 1))).to_bytes(width, "little")
+
+
+class _Layout:
+    """Layout of the single pass. Labels defined later in the pass resolve to the previous pass addresses"""
+
+    def __init__(self, env: Env, label_ids: dict[Label, int], label_addrs: array[int]):
+        self.env = env
+        self.named_registers = env.named_registers
+        self.label_ids = label_ids
+        self.label_addrs = label_addrs
+        # set to the last known code range after the first pass
+        self.code_range: tuple[int, int] | None = None
+        # instruction being encoded
+        self.inst: Inst | None = None
+        self.inst_addr = 0
+        self.inst_size = 0
+
+    def addrof(self, obj: Any, /) -> int:
+        if isinstance(obj, Label):
+            try:
+                return self.label_addrs[self.label_ids[obj]]
+            except KeyError as e:
+                raise _Unresolved() from e
+        if isinstance(obj, int):
+            if self.is_code(obj) or self.is_ram(obj):
+                return obj
+            raise AddrError("Address outside of any region", obj)
+        if obj is not None and obj is self.inst:
+            return self.inst_addr
+        raise _Unresolved()
+
+    def sizeof(self, obj: Inst, /) -> int:
+        if obj is not None and obj is self.inst:
+            return self.inst_size
+        raise _Unresolved()
+
+    def is_code(self, addr: int) -> bool:
+        region = self.code_range or self.env.code_region
+        return region[0] <= addr < region[1]
+
+    def is_ram(self, addr: int) -> bool:
+        region = self.env.ram_region
+        return region[0] <= addr < region[1]
+
+
+class _AnyLayout(_Layout):
+    """Resolves everything to the code start. Used to learn the encoding structure"""
+
+    def addrof(self, obj: Any, /) -> int:
+        if isinstance(obj, int):
+            return obj
+        return self.env.code_region[0]
+
+    def sizeof(self, obj: Inst, /) -> int:
+        return 0
+
+
+def _nvarints(opd: Any, lay: _Layout) -> int:
+    return len(list(_varints(b"\0" + opd.encode_for(lay, as_src=True))))
+
+
+class StreamLayout:
+    """Result of the streaming build"""
+
+    def __init__(self, code_range: tuple[int, int], label_ids: dict[Label, int], label_addrs: array[int]):
+        self.code_range = code_range
+        self._label_ids = label_ids
+        self._label_addrs = label_addrs
+
+    @property
+    def size(self):
+        return self.code_range[1] - self.code_range[0]
+
+    def addrof(self, obj: Label | str, /) -> int:
+        if isinstance(obj, str):
+            for lab in self._label_ids:
+                if lab.name == obj:
+                    return self.addrof(lab)
+            raise MissingDefError("No label", obj)
+        try:
+            return self._label_addrs[self._label_ids[obj]]
+        except KeyError as e:
+            raise MissingDefError("No label", obj) from e
+
+    def __getitem__(self, obj: Label | str, /) -> int:
+        return self.addrof(obj)
+
+
+class _Recorder:
+    def __init__(self, file: BinaryIO, env: Env):
+        self.file = file
+        self.labels: list[Label] = []
+        self.label_ids: dict[Label, int] = {}
+        self.defined = bytearray()
+        # estimated (optimistic) addresses of labels for the first pass
+        self.addrs = array("L")
+        self._p = env.code_region[0]
+        self._align = 1
+        self._pending: list[int] = []
+        self.lay = _Layout(env, {}, array("L"))
+        self.any_lay = _AnyLayout(env, {}, array("L"))
+        self._root: Inst | None = None
+
+    def label_id(self, lab: Label) -> int:
+        id_ = self.label_ids.get(lab)
+        if id_ is None:
+            id_ = len(self.labels)
+            self.label_ids[lab] = id_
+            self.labels.append(lab)
+            self.defined.append(0)
+            self.addrs.append(0)
+        return id_
+
+    def _persistent_id(self, obj: Any):
+        if isinstance(obj, Label):
+            return self.label_id(obj)
+        if isinstance(obj, Inst) and obj is not self._root:
+            raise BuildError("Only the labels may be referenced in the streaming build", obj)
+        return None
+
+    def label(self, lab: Label):
+        id_ = self.label_id(lab)
+        if self.defined[id_]:
+            raise DuplicateDefError("Object is placed twice", lab)
+        self.defined[id_] = 1
+        self._pending.append(id_)
+        self.file.write(_HEADER.pack(_LABEL, id_))
+
+    def align(self, n: int):
+        self._align = n
+        self.file.write(_HEADER.pack(_ALIGN, n))
+
+    def _place(self, size: int):
+        self._p += -self._p % self._align
+        self._align = 1
+        for id_ in self._pending:
+            self.addrs[id_] = self._p
+        self._pending.clear()
+        self._p += size
+
+    def inst(self, inst: Inst):
+        if isinstance(inst, Op):
+            inst.validate()
+        try:
+            inst.check_against(self.lay)
+            bytecode = inst.encode_for(self.lay)
+        except _Unresolved:
+            pass
+        else:
+            self._place(len(bytecode))
+            self.file.write(_HEADER.pack(_FIXED, len(bytecode)))
+            self.file.write(bytecode)
+            return
+
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id  # type: ignore[method-assign]
+        self._root = inst
+        try:
+            pickler.dump(inst)
+        finally:
+            self._root = None
+        pickled = buf.getbuffer()
+
+        if isinstance(inst, Op):
+            # the varints are starting at the minimal width
+            nvarints = inst.is_vartgt + inst.is_varsrc
+            nvarints += sum(_nvarints(opd, self.any_lay) for opd in [*inst.tgts, *inst.srcs])
+            widths = bytes([1] * nvarints)
+            size = 1 + nvarints
+        else:
+            # sizes of non-ops can't be adjusted. Must be fixed
+            nvarints = 0
+            widths = b""
+            size = inst.max_size()
+        self._place(size)
+        self.file.write(_HEADER.pack(_INST, size))
+        self.file.write(bytes([nvarints]))
+        self.file.write(widths)
+        self.file.write(len(pickled).to_bytes(4, "little"))
+        self.file.write(pickled)
+
+
+def _items(code: Code, add_exit: bool) -> Iterator[Inst | Label | Directive]:
+    last = None
+    for item in flat_code(code):
+        if item is None or item is False or item is True:
+            continue
+        if isinstance(item, Block):
+            # rows are materialized one by one
+            labels_at: dict[int, list[Label]] = {}
+            for lab, row in item.labels.items():
+                labels_at.setdefault(row, []).append(lab)
+            for row in range(len(item)):
+                yield from labels_at.get(row, ())
+                last = item.materialize(row)
+                yield last
+            yield from labels_at.get(len(item), ())
+            continue
+        if isinstance(item, Inst):
+            last = item
+        yield item
+    if add_exit and not isinstance(last, Exit):
+        yield Exit()
+
+
+def _record(code: Code, file: BinaryIO, env: Env, add_exit: bool) -> _Recorder:
+    rec = _Recorder(file, env)
+    pending_label: Label | None = None
+    for item in _items(code, add_exit):
+        if isinstance(item, Label):
+            rec.label(item)
+            pending_label = item
+        elif isinstance(item, Align):
+            rec.align(item.n)
+        elif isinstance(item, _AutoFrame):
+            raise BuildError("Automatic save_regs are not supported in the streaming build", item)
+        elif isinstance(item, Directive):
+            pass
+        else:
+            rec.inst(item)
+            pending_label = None
+    if pending_label is not None:
+        raise DetachedLabelError("Label must be followed by instruction", pending_label)
+    for id_, is_defined in enumerate(rec.defined):
+        if not is_defined:
+            raise MissingDefError("No label", rec.labels[id_])
+    return rec
+
+
+class _Pass:
+    """Walks over the records, encoding the instructions"""
+
+    def __init__(self, records: mmap.mmap, rec: _Recorder, lay: _Layout):
+        self.records = records
+        self.rec = rec
+        self.lay = lay
+
+    def _load(self, pickled: bytes) -> Inst:
+        unpickler = pickle.Unpickler(io.BytesIO(pickled))
+        unpickler.persistent_load = self.rec.labels.__getitem__  # type: ignore[method-assign]
+        return unpickler.load()
+
+    def run(self, out: BinaryIO | None) -> bool:
+        """Single pass. Returns True if anything is changed"""
+        records = self.records
+        lay = self.lay
+        label_addrs = lay.label_addrs
+        changed = False
+        start = p = lay.env.code_region[0]
+        pending_align = 1
+        pending_labels: list[int] = []
+        pos = 0
+        end = len(records)
+        while pos < end:
+            kind, val = _HEADER.unpack_from(records, pos)
+            pos += _HEADER.size
+            if kind == _LABEL:
+                # labels are attached to the next instruction
+                pending_labels.append(val)
+                continue
+            if kind == _ALIGN:
+                pending_align = val
+                continue
+
+            pad = -p % pending_align
+            if out and pad:
+                out.write(Pad(pad).encode_for(lay))
+            p += pad
+            pending_align = 1
+            for id_ in pending_labels:
+                if label_addrs[id_] != p:
+                    label_addrs[id_] = p
+                    changed = True
+            pending_labels.clear()
+
+            if kind == _FIXED:
+                if out:
+                    out.write(records[pos : pos + val])
+                pos += val
+                p += val
+                continue
+
+            size = val
+            size_pos = pos - 4
+            nvarints = records[pos]
+            widths_pos = pos + 1
+            pos = widths_pos + nvarints
+            plen = int.from_bytes(records[pos : pos + 4], "little")
+            pos += 4
+            inst = self._load(records[pos : pos + plen])
+            pos += plen
+
+            lay.inst = inst
+            lay.inst_addr = p
+            lay.inst_size = size
+            try:
+                bytecode = inst.encode_for(lay)
+                if out:
+                    inst.check_against(lay)
+            except _Unresolved as e:
+                raise BuildError("Unresolved reference in the streaming build", inst) from e
+            finally:
+                lay.inst = None
+
+            if nvarints:
+                varints = list(_varints(bytecode))
+                if len(varints) > nvarints:
+                    raise BuildError("Unexpected encoding", inst)
+                parts = [bytecode[:1]]
+                for i, (v, width) in enumerate(varints):
+                    recorded = records[widths_pos + i]
+                    if width > recorded:
+                        # never shrink
+                        records[widths_pos + i] = width
+                        changed = True
+                    parts.append(_encode_varint(v, max(width, recorded)))
+                bytecode = b"".join(parts)
+                if len(bytecode) != size:
+                    records[size_pos : size_pos + 4] = len(bytecode).to_bytes(4, "little")
+                    changed = True
+            elif len(bytecode) != size:
+                raise BuildError("Variable-size instruction is not supported in the streaming build", inst)
+
+            if out:
+                out.write(bytecode)
+            p += len(bytecode)
+
+        if lay.code_range != (start, p):
+            lay.code_range = (start, p)
+            changed = True
+        return changed
+
+
+def build_stream(
+    code: Code,
+    out: BinaryIO,
+    *,
+    env: Env | None = None,
+    add_exit=True,
+    tmpdir: str | None = None,
+) -> StreamLayout:
+    """Build the code consumed from the iterable (e.g. the generator), writing the bytecode to the `out` file.
+
+    The intermediate records are kept in the temporary file in `tmpdir`.
+    The memory usage is proportional to the number of labels, not the instructions.
+    """
+    env = env or script.DEF_ENV
+    with tempfile.TemporaryFile(dir=tmpdir) as file:
+        rec = _record(code, file, env, add_exit)
+        file.flush()
+        if not file.tell():
+            raise BuildError("No code")
+
+        label_addrs = rec.addrs
+        lay = _Layout(env, rec.label_ids, label_addrs)
+
+        with mmap.mmap(file.fileno(), 0) as records:
+            pass_ = _Pass(records, rec, lay)
+            npasses = 0
+            while pass_.run(None):
+                npasses += 1
+                # the sizes are growing monotonically, so it never oscillates.
+                # The limit is for the pathological cases only
+                if npasses > env.max_passes * _MAX_VARINT_SIZE:
+                    raise BuildError("Failed to converge", npasses)
+
+            assert lay.code_range
+            used = lay.code_range
+            avail = env.code_region
+            if not (avail[0] <= used[1] - 1 < avail[1]):
+                raise BuildError("Available code range overflow", used, avail)
+
+            changed = pass_.run(out)
+            assert not changed
+
+    return StreamLayout(lay.code_range, rec.label_ids, label_addrs)
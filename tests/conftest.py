@@ -13,6 +13,7 @@ def script_env():
         ram_region=(0, 1024),
         code_region=(0x10_00_00, 0xFF_FF_FF_FF + 1),
         named_registers={"sp": 13, "lr": 14},
+        scratch_registers=range(16, 32),
     )
     yield
     bajo.script.DEF_ENV = was
@@ -5,6 +5,7 @@ import bajo
 import bajo.builder
 from bajo import Code, Script
 from bajo.core import _S32_MAX, _S32_MIN, _U32_MAX
+from bajo.env import Env
 
 from .vm import Vm
 
@@ -29,6 +30,23 @@ def randu32():
     return randint(0, _U32_MAX)
 
 
+def make_env(base: Env | None = None, **fields) -> Env:
+    """Copy of the env (the default one if not given) with the fields replaced"""
+    env = base or bajo.script.DEF_ENV
+    return Env(
+        **{
+            "ram_region": env.ram_region,
+            "code_region": env.code_region,
+            "named_registers": env.named_registers,
+            "max_passes": env.max_passes,
+            "scratch_registers": env.scratch_registers,
+            "superinstructions": env.superinstructions,
+            "optimize_layout": env.optimize_layout,
+            **fields,
+        }
+    )
+
+
 def makevm(obj: Code | Script):
     if not isinstance(obj, Script):
         script = Script(obj)
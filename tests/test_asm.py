@@ -1,9 +1,12 @@
 import pytest
 
-from bajo import Label, M, Nop, R, Reg, Script
+from bajo import Align, BrGt, Label, M, Nop, R, Reg, Script
+from bajo.asm import Pad
 from bajo.core import Add, Comparison, ImmOffset, ImmSizeof, RhAB, Sub
 from bajo.exc import DetachedLabelError, DuplicateDefError
 
+from .vm import Vm
+
 r0 = Reg(0)
 r1 = Reg(0)
 
@@ -91,3 +94,20 @@ def test_bool():
     assert M[ImmSizeof(a)] == M[ImmSizeof(a)]
     assert M[ImmSizeof(a)] != M[ImmSizeof(b)]
     assert M[ImmOffset(a, b)] == M[ImmOffset(a, b)]
+
+
+def test_pad():
+    for n in range(40):
+        assert len(Pad(n).encode_for(None)) == n  # type: ignore[arg-type]
+
+    top = Label()
+    code = [R[0].set(0), top, R[0].set(R[0] + 1), Align(16), R[1].set(R[1] + 2), BrGt(10, R[0], top)]
+    s = Script(code)
+    pads = [inst for inst in s.layout.insts if isinstance(inst, Pad)]
+    assert pads and pads[0].size > 1
+    vm = Vm.from_script(s)
+    trace = vm.run_traced()
+    assert vm[R[0]] == 10 and vm[R[1]] == 20
+    # the gap is skipped in one step
+    assert trace.count(s.layout.addrof(pads[0])) == 10
+    assert len(trace) == 1 + 10 * 4 + 1
@@ -58,3 +58,8 @@ def test_shift():
     assert run(RShift(R[0], 12, -1)).ru[0] == 0
     assert run(RShift(R[0], -12345, -1)).r[0] == -1
     assert run(RShiftU(R[0], 10, -1)).ru[0] == 0
+
+    # operators
+    for a, s in [(5, 3), (-7, 2), (0x4000_0001, 1)]:
+        vm = run([R[1].set(a), R[2].set(s), R[0].set(R[1] << R[2]), R[3].set(R[1] >> 1)])
+        assert vm.ru[0] == (a << s) & 0xFFFFFFFF and vm.r[3] == a >> 1
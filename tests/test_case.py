@@ -0,0 +1,59 @@
+from bajo import BrEq, BrGe, BrGeU, Jmp, R, Script
+from bajo.macro import case
+
+from .vm import Vm
+
+
+def _dispatch(values, x, **kwargs):
+    code = [
+        R[0].set(x),
+        case({R[0] == v: R[1].set(i + 1) for i, v in enumerate(values)}, default=R[1].set(-1), **kwargs),
+    ]
+    s = Script(code)
+    vm = Vm.from_script(s)
+    vm.run()
+    return vm[R[1]], s
+
+
+def _types(s: Script):
+    return [type(inst) for inst in s.layout.insts]
+
+
+def test_linear():
+    values = [5, 1, 9]
+    for x in [0, 1, 5, 9, 10]:
+        res, s = _dispatch(values, x)
+        assert res == (values.index(x) + 1 if x in values else -1)
+    assert _types(s).count(BrEq) == 3 and BrGe not in _types(s)
+
+
+def test_search_tree():
+    values = [100, -7, 3, 0x7FFF_FFFF, -0x8000_0000, 42, 8, 9, 1000, 55]
+    for x in [*values, -8, 4, 43, 999, 1001]:
+        res, s = _dispatch(values, x)
+        assert res == (values.index(x) + 1 if x in values else -1)
+    assert BrGe in _types(s)
+    # at most ~log2(n) compares on the path
+    assert _types(s).count(BrGe) < len(values)
+
+    # first match wins
+    res, _ = _dispatch([1, 2, 3, 2, 5], 2)
+    assert res == 2
+
+
+def test_jump_table():
+    values = [10, 11, 13, 14, 12, 17, 16]
+    for x in [*values, 9, 15, 18, -1, 0x7FFF_FFFF]:
+        res, s = _dispatch(values, x, tmp=R[2])
+        assert res == (values.index(x) + 1 if x in values else -1)
+    types = _types(s)
+    assert types.count(BrGeU) == 1 and types.count(Jmp) == 1 and BrEq not in types
+    # virtual index by default
+    for x in [*values, 9, 18]:
+        res, s = _dispatch(values, x)
+        assert res == (values.index(x) + 1 if x in values else -1)
+        assert Jmp in _types(s)
+
+    # sparse values are not tabulated
+    _, s = _dispatch([0, 100, 200, 300], 0, tmp=R[2])
+    assert Jmp not in _types(s)
@@ -0,0 +1,55 @@
+import mmap
+
+import pytest
+
+from bajo import Align, D, Exit, Label, M, R, Script
+
+
+def _script():
+    lab = Label()
+    return Script(
+        [
+            [R[i].set(i * 1000) for i in range(64)],
+            R[0].set(M[lab]),
+            Exit(),
+            Align(16),
+            lab,
+            D(lab),
+        ]
+    )
+
+
+def test_encode_into():
+    s = _script()
+    ref = s.encode()
+
+    buf = bytearray(b"\xff" * (len(ref) + 20))
+    n = s.encode_into(buf, 12)
+    assert n == len(ref)
+    assert buf[:12] == b"\xff" * 12
+    assert buf[12 : 12 + n] == ref
+    assert buf[12 + n :] == b"\xff" * 8
+
+    mv = memoryview(bytearray(len(ref)))
+    s.encode_into(mv)
+    assert mv == ref
+
+    with mmap.mmap(-1, len(ref) + 4) as mm:
+        s.encode_into(mm, 4)
+        assert mm[4:] == ref
+
+    with pytest.raises(ValueError):
+        s.encode_into(bytearray(len(ref) - 1))
+    with pytest.raises(ValueError):
+        s.encode_into(bytearray(len(ref)), 1)
+
+
+def test_iter_chunks():
+    s = _script()
+    ref = s.encode()
+
+    chunks = list(s.iter_chunks(16))
+    assert b"".join(chunks) == ref
+    assert all(len(chunk) >= 16 for chunk in chunks[:-1])
+
+    assert list(s.iter_chunks(len(ref) * 2)) == [ref]
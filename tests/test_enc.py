@@ -1,9 +1,13 @@
 import random
+import threading
 
-from bajo import Add, M, Mov, R, Script
+import pytest
+
+from bajo import Add, M, Max, Min, Mov, Mul, Or2, R, Script, Sub, TstEq, deferred_checks
 from bajo.core import encode_varint
+from bajo.ir import Block
 
-from .helpers import no_addr_verify, u32_ok
+from .helpers import no_addr_verify, run, u32_ok
 
 
 def test_max_imm():
@@ -60,3 +64,59 @@ def test_rmw():
     assert len(a) < len(b)
     assert a[0] & 0x80
     assert not (b[0] & 0x80)
+
+
+def test_rmw_commutative():
+    # sources are swapped to read the target first
+    assert Script(Add(R[0], 10, R[0])).encode() == Script(Add(R[0], R[0], 10)).encode()
+    assert Script(R[0].set(R[1] + R[0])).encode() == Script(Add(R[0], R[0], R[1])).encode()
+    assert Script(Max(R[0], 1, 2, R[0])).encode() == Script(Max(R[0], R[0], 1, 2)).encode()
+    # same in the ir block
+    blk = Block()
+    blk.op(TstEq, [R[0]], [5, R[0]])
+    assert Script(blk).encode() == Script(TstEq(R[0], R[0], 5)).encode()
+    # order matters
+    assert not Script(Sub(R[0], 10, R[0])).encode()[0] & 0x80
+    assert not Script(Or2(R[0], 10, R[0])).encode()[0] & 0x80
+    for a in [0, 7, -3]:
+        assert run([R[0].set(a), Sub(R[0], 10, R[0])])[R[0]] == 10 - a
+        assert run([R[0].set(a), Add(R[0], 10, R[0]), Mul(R[0], 3, R[0])])[R[0]] == (a + 10) * 3
+        assert run([R[0].set(a), Min(R[0], 1, R[0], 5)])[R[0]] == min(a, 1)
+
+
+def test_deferred_checks():
+    with deferred_checks():
+        code = [Mov(R[i % 10], i) for i in range(1000)]
+        assert code[0].srcs == [0]
+    assert Script(code).encode() == Script([Mov(R[i % 10], i) for i in range(1000)]).encode()
+
+    with deferred_checks():
+        bad = Add(R[0], R[0], True)
+        big = Mov(R[0], 0xFFFFFFFF)
+    with pytest.raises(TypeError):
+        Script(bad).encode()
+    with pytest.raises(ValueError):
+        Script(big).encode()
+    with pytest.raises(TypeError):
+        Add(R[0], R[0], True)
+
+    # nested context keeps deferring
+    with deferred_checks():
+        with deferred_checks():
+            pass
+        assert Mov(R[0], 5).is_raw
+
+    # other threads are still checked
+    errors = []
+
+    def other():
+        try:
+            Add(R[0], R[0], True)
+        except TypeError as e:
+            errors.append(e)
+
+    with deferred_checks():
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+    assert len(errors) == 1
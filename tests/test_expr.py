@@ -0,0 +1,139 @@
+import operator
+from random import choice, randint
+
+import pytest
+
+import bajo.script
+from bajo import Add, Div, M, Mov, Mul, Neg, R, Script, Sub
+from bajo.core import IMem, RhA, RhAB
+from bajo.exc import BuildError
+from bajo.expr import compile_expr
+
+from .helpers import make_env, rands32, run, s32, u32
+from .vm import Vm
+
+
+def _run(code, scratch=range(8, 12)):
+    vm = Vm.from_script(Script(code, env=make_env(scratch_registers=scratch)))
+    vm.run()
+    return vm
+
+
+def test_nested():
+    code = R[0].set((R[1] + R[2]) * R[3])
+    # target holds the intermediate, no temporaries
+    assert [type(op) for op in code] == [Add, Mul]
+    assert all(op.tgts[0] == R[0] for op in code)
+    assert run([R[1].set(2), R[2].set(3), R[3].set(4), code])[R[0]] == 20
+
+    # both subtrees need the register, one temporary
+    code = R[0].set((R[1] + R[2]) * (R[3] - R[4]))
+    assert len(code) == 3 and sum(isinstance(op.tgts[0], bajo.VReg) for op in code) == 1
+    vm = _run([R[1].set(2), R[2].set(3), R[3].set(10), R[4].set(3), code])
+    assert vm[R[0]] == 35
+    # the default env has the scratch registers for it
+    assert run([R[1].set(2), R[2].set(3), R[3].set(10), R[4].set(3), code])[R[0]] == 35
+
+    # deeper subtree is evaluated first
+    code = R[0].set(R[1] * 3 - ((R[2] + 1) * (R[3] + 2) + 5) // R[4])
+    vm = _run([R[1].set(7), R[2].set(3), R[3].set(4), R[4].set(2), code])
+    assert vm[R[0]] == 7 * 3 - (4 * 6 + 5) // 2
+    vm = run([R[1].set(2), R[0].set(7 - (R[1] + 1) * 2)])
+    assert vm[R[0]] == 1
+    # operands share the operators of the right-hands
+    vm = run([R[1].set(2), R[0].set(7 - R[1]), R[2].set(3 * (10 - R[1]))])
+    assert vm[R[0]] == 5 and vm[R[2]] == 24
+
+
+def test_target_is_read():
+    # target can't hold the intermediate since it's read later
+    code = R[0].set(R[0] - R[1] * 2)
+    assert code[0].tgts[0] != R[0]
+    assert _run([R[0].set(30), R[1].set(10), code])[R[0]] == 10
+    # read by the subtree only
+    code = R[0].set(R[1] - R[0] * 2)
+    assert code[0].tgts[0] == R[0]
+    assert run([R[0].set(3), R[1].set(10), code])[R[0]] == 4
+    vm = _run([R[0].set(3), R[1].set(10), R[0].set((R[1] + 1) * (R[0] - 1))])
+    assert vm[R[0]] == 22
+    vm = _run([R[0].set(3), R[1].set(10), R[0].set((R[0] + 1) * (R[1] - 1))])
+    assert vm[R[0]] == 36
+
+
+def test_fold():
+    code = compile_expr(R[0], RhAB(Mul, R[1], RhAB(Add, 2, RhA(Neg, 3))) + 1)
+    assert [type(op) for op in code] == [Mul, Add] and code[0].srcs[1] == -1
+    assert run([R[1].set(5), code])[R[0]] == -4
+    # whole tree is constant
+    code = compile_expr(R[0], RhAB(Mul, RhAB(Add, 2, 3), 4))
+    assert [type(op) for op in code] == [Mov] and code[0].srcs[0] == 20
+    # division by zero is left for the runtime
+    assert [type(op) for op in compile_expr(R[0], RhAB(Div, 1, 0) + R[1])] == [Div, Add]
+
+
+def test_load():
+    code = [
+        [M[400 + i * 4].set(100 + i * 10) for i in range(10)],
+        R[1].set(400),
+        R[2].set(3),
+        # indexed load reads via the indirect operand
+        R[0].set(M[R[1] + R[2] * 4] + M[R[1] + 8] * 2),
+        R[3].set(M[R[1] + R[2] * 4 - 4]),
+        R[4].set(M[(R[2] + 1) * 4 + R[1]]),
+    ]
+    vm = _run(code)
+    assert vm[R[0]] == 130 + 120 * 2
+    assert vm[R[3]] == 120
+    assert vm[R[4]] == 140
+    ops = R[0].set(M[R[1] + R[2] * 4])
+    assert [type(op) for op in ops] == [Mul, Mov] and isinstance(ops[1].srcs[0], IMem)
+
+    # store to the computed address
+    code = [R[1].set(400), R[2].set(2), M[R[1] + R[2] * 4].set((R[2] + 1) * 3), R[0].set(M[408])]
+    assert _run(code)[R[0]] == 9
+
+
+def test_tmps():
+    expr = (R[1] + R[2]) * (R[3] + R[4]) - (R[5] + R[6]) * (R[7] + R[8])
+    code = compile_expr(R[0], expr, tmps=[R[10], R[11]])
+    vm = run([*(R[i].set(i) for i in range(1, 9)), code])
+    assert vm[R[0]] == 3 * 7 - 11 * 15
+    with pytest.raises(BuildError):
+        compile_expr(R[0], expr, tmps=[R[10]])
+
+    # virtual temporaries are allocated from the scratch registers
+    vm = _run([*(R[i].set(i) for i in range(1, 9)), R[0].set(expr)], scratch=[10, 11])
+    assert vm[R[0]] == 3 * 7 - 11 * 15
+
+
+def _tree(depth, vals):
+    """Random tree and its value"""
+    if depth == 0 or randint(0, 3) == 0:
+        if randint(0, 2):
+            i = randint(0, len(vals) - 1)
+            return R[i], vals[i]
+        v = randint(-100, 100)
+        return v, v
+    cls, func = choice([(Add, operator.add), (Sub, operator.sub), (Mul, operator.mul)])
+    a, va = _tree(depth - 1, vals)
+    b, vb = _tree(depth - 1, vals)
+    node = RhAB(cls, a, b) if isinstance(a, int) else func(a, b)
+    return node, s32(u32(func(va, vb)))
+
+
+def test_random():
+    # the temporary holding the result of one subtree is kept while the other is evaluated
+    expr = R[1] + (R[1] * 5 - R[2] * R[3]) * ((R[2] - 1) + R[1] * R[0])
+    init = [R[0].set(0), R[1].set(-9), R[2].set(-12), R[3].set(12)]
+    assert _run([init, R[1].set(expr)])[R[1]] == -1296
+    assert run([init, compile_expr(R[1], expr, tmps=[R[10], R[11], R[12]])])[R[1]] == -1296
+
+    for _ in range(400):
+        vals = [rands32() for _ in range(4)]
+        tree, expected = _tree(4, vals)
+        if isinstance(tree, int):
+            continue
+        t = R[randint(0, 4)]
+        init = [R[i].set(v) for i, v in enumerate(vals)]
+        assert _run([init, compile_expr(t, tree)])[t] == expected, tree
+        assert run([init, compile_expr(t, tree, tmps=[R[i] for i in range(10, 16)])])[t] == expected, tree
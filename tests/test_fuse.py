@@ -0,0 +1,90 @@
+from bajo import Add, AddBrLt, BrGe, BrGt, BrNe, Label, M, R, Script, Sub, SubBrNe, TstEq, TstEqBrNe
+from bajo.fuse import propose_superinstructions
+from bajo.macro import for_range, repeat
+from bajo.profile import Profile
+
+from .helpers import make_env
+from .vm import Vm
+
+
+def _fused(code):
+    return Script(code, env=make_env(superinstructions=True))
+
+
+def _run(code, superinstructions=True):
+    s = Script(code, env=make_env(superinstructions=superinstructions))
+    vm = Vm.from_script(s)
+    trace = vm.run_traced()
+    return vm, s, trace
+
+
+def _types(s: Script):
+    return [type(inst) for inst in s.layout.insts]
+
+
+def test_fuse():
+    top = Label()
+    code = [
+        for_range(R[0], 0, 10, 1, R[1].set(R[1] + R[0])),
+        repeat(5, R[2].set(R[2] + 3), counter=R[3]),
+        R[4].set(7),
+        top,
+        R[4].set(R[4] - 1),
+        R[6].set(R[6] + 1),
+        TstEq(R[5], R[4], 3),
+        # the result may be any operand of symmetric branch
+        BrNe(1, R[5], top),
+    ]
+    vm, s, trace = _run(code)
+    ref, _, ref_trace = _run(code, superinstructions=False)
+    for i in range(7):
+        assert vm[R[i]] == ref[R[i]]
+    assert [vm[R[i]] for i in [1, 2, 6]] == [45, 15, 4]
+    assert len(trace) < len(ref_trace)
+    types = _types(s)
+    assert AddBrLt in types and SubBrNe in types and TstEqBrNe in types
+    # off by default, the vm may be built without them
+    assert not {AddBrLt, SubBrNe, TstEqBrNe} & set(_types(Script(code)))
+
+
+def test_no_fuse():
+    top = Label()
+    # the branch reads the result twice
+    code = [top, R[0].set(R[0] + 1), BrGt(R[0], R[0], top)]
+    assert AddBrLt not in _types(_fused(code))
+    # indirect operand reads the result
+    code = [top, R[0].set(R[0] + 1), BrGt(M[R[0] + 100], R[0], top)]
+    assert BrGt in _types(_fused(code))
+    # branch is the target
+    code = [R[0].set(R[0] + 1), top, BrGt(10, R[0], top)]
+    assert BrGt in _types(_fused(code))
+    # no superinstruction
+    code = [top, Sub(R[0], R[0], 1), BrGe(R[0], 0, top)]
+    assert BrGe in _types(_fused(code))
+    # plain memory reads the result
+    for mem in [M[4], M[5]]:
+        lab = Label()
+        code = [R[1].set(5), Add(R[1], R[1], 1), BrGt(R[1], mem, lab), R[0].set(1), lab, R[0].set(R[0] + 1)]
+        vm, s, _ = _run(code)
+        ref, _, _ = _run(code, superinstructions=False)
+        assert BrGt in _types(s) and vm[R[0]] == ref[R[0]]
+
+
+def test_propose():
+    top = Label()
+    code = [
+        R[0].set(10),
+        top,
+        R[1].set(R[1] + 2),
+        Sub(R[0], R[0], 1),
+        BrGt(R[0], 0, top),
+        for_range(R[2], 0, 3, 1, R[3].set(R[3] + 1)),
+    ]
+    s = _fused(code)
+    vm = Vm.from_script(s)
+    profile = Profile.from_trace(s, vm.run_traced())
+    proposed = propose_superinstructions(profile, s.env)
+    assert proposed[0] == ((Sub, BrGt, 0), 10)
+    # the fused pairs are counted as the replaced ones
+    inc = s.layout.insts[-2].origin[0]
+    assert profile.count(inc) == 3
@@ -0,0 +1,80 @@
+import gc
+import mmap
+
+import pytest
+
+from bajo import D, Exit, Label, M, R, Script
+from bajo.exc import ImageError
+from bajo.image import DEBUG_LISTING, ImageView, build_image
+
+from .vm import Vm
+
+
+def _script():
+    data = Label("data")
+    return Script(
+        [
+            Label("aux"),
+            R[1].set(2),
+            Exit(2),
+            Label("main"),
+            R[0].set(M[data]),
+            Exit(1),
+            [(Label(f"sym{i}"), R[i].set(i)) for i in range(20)],
+            data,
+            D(1234),
+        ]
+    )
+
+
+def test_roundtrip():
+    s = _script()
+    image = build_image(s, sections={b"USER": b"hello"}, align=64)
+    view = ImageView(image)
+
+    assert view.code_range == s.layout.code_range
+    assert view.ram_region == s.env.ram_region
+    assert view.code == bytes(s)
+    assert (image.index(bytes(s))) % 64 == 0
+
+    names = [name for name, _ in view.symbols]
+    assert names == sorted(names)
+    assert len(names) == len(s.layout.labels)
+    for name, addr in view.symbols:
+        assert view[name] == addr == s.layout[name]
+    assert "main" in view
+    assert "nope" not in view
+    with pytest.raises(KeyError):
+        view.lookup("nope")
+
+    assert view.section(b"USER") == b"hello"
+    assert view.section(DEBUG_LISTING) is None
+    assert bytes(ImageView(build_image(s, debug=True)).sections[DEBUG_LISTING]).decode() == s.listing()
+
+
+def test_bad():
+    image = build_image(_script())
+    with pytest.raises(ImageError):
+        ImageView(b"JUNK" + image[4:])
+    with pytest.raises(ImageError):
+        ImageView(image[:-1])
+
+
+def test_vm(tmp_path):
+    path = tmp_path / "image.bin"
+    path.write_bytes(build_image(_script()))
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = ImageView(mm)
+        vm = Vm.from_image(view, entry="main")
+        assert vm.run() == 1
+        assert vm[R[0]] == 1234
+
+        vm = Vm.from_image(view)
+        assert vm.run() == 2
+        assert vm[R[1]] == 2
+
+        # vm is self-referencing via ctypes callbacks
+        del vm
+        gc.collect()
+        view.release()
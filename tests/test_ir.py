@@ -0,0 +1,90 @@
+import pytest
+
+from bajo import Add, BrGt, BrLnk, Exit, Jmp, Label, M, Mov, R, Script, Sys02
+from bajo.ir import Block
+from bajo.macro import when
+
+from .helpers import run
+
+
+def test_same_as_ops():
+    top = Label()
+    ops = [
+        Mov(R[0], 0),
+        Mov(R[1], 100),
+        top,
+        Add(R[0], R[0], 3),
+        Add(M[R[2] + 4], R[1], R[0]),
+        BrGt(R[1], R[0], top),
+        Sys02(1, R[0], R[1]),
+        Exit(),
+    ]
+
+    blk = Block()
+    top = Label()
+    blk.op(Mov, [R[0]], [0])
+    blk.op(Mov, [R[1]], [100])
+    blk.label(top)
+    blk.op(Add, [R[0]], [R[0], 3])
+    blk.op(Add, [M[R[2] + 4]], [R[1], R[0]])
+    blk.op(BrGt, [], [R[1], R[0], top])
+    blk.op(Sys02, [], [1, R[0], R[1]])
+    blk.op(Exit, [], [0])
+
+    assert len(blk) == 7
+    assert Script(blk, add_exit=False).encode() == Script(ops, add_exit=False).encode()
+
+
+def test_mixed():
+    sub = Label()
+    end = Label()
+
+    blk = Block()
+    for i in range(200):
+        blk.op(Mov, [R[i % 10]], [i])
+    blk.op(BrLnk, [R["lr"]], [sub])
+    blk.op(Jmp, [], [end])
+    blk.label(inner := Label())
+    blk.op(Add, [R[0]], [R[0], 1])
+    blk.op(Jmp, [], [R["lr"]])
+
+    vm = run(
+        [
+            R[0].set(10),
+            blk,
+            Exit(1),
+            end,
+            when(R[0] > 10, R[5].set(R[0])),
+            Exit(),
+            sub,
+            R[0].set(R[0] + 1000),
+            BrGt(R[0], 0, inner),
+        ]
+    )
+
+    assert vm.exit_rc == 0
+    assert vm[R[0]] == 190 + 1000 + 1
+    assert vm[R[5]] == vm[R[0]]
+
+
+def test_listing():
+    blk = Block()
+    blk.label(Label("start"))
+    blk.op(Mov, [R[0]], [1])
+    blk.op(Add, [R[0]], [R[0], R["sp"]])
+    blk.label(Label("end"))
+    s = Script([blk])
+    lines = s.listing().splitlines()
+    assert lines[0] == ".start"
+    assert "Mov r0, #1" in lines[1]
+    assert "Add r0, r0, r13" in lines[2]
+    assert lines[3] == ".end"
+    assert "Exit" in lines[4]
+    assert s.layout["end"] == s.layout.code_range[1] - 2
+
+
+def test_bad():
+    with pytest.raises(TypeError):
+        Block().op(Mov, [R[0]], [True])
+    with pytest.raises(ValueError):
+        Block().op(Mov, [R[0]], [0xFFFFFFFF])
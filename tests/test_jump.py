@@ -1,6 +1,7 @@
-from bajo import Add, Exit, Jmp, JmpLnk, Label, Mov, R, Script
+import bajo.script
+from bajo import Add, Br, BrLnk, Call, Exit, Goto, Jmp, JmpLnk, Label, Mov, Nop, R, Script
 
-from .helpers import run
+from .helpers import make_env, run
 from .vm import Vm
 
 
@@ -45,3 +46,33 @@ def test_call():
     assert vm[R[2]] == 0
     assert vm[R[1]] == 5678
     assert vm.ru[31] == expected_lr
+
+
+def test_goto_call():
+    def opcode(inst, s: Script):
+        return inst.encode_for(s.layout)[0] & 0x7F
+
+    main, sub, top = Label(), Label(), Label()
+    code = [
+        Mov(R[0], 0),
+        near := Goto(main),
+        sub,
+        Add(R[1], R[1], 5),
+        Jmp(R["lr"]),
+        top,
+        Add(R[0], R[0], 1),
+        Exit(),
+        main,
+        [Nop() for _ in range(4200)],
+        call := Call(sub),
+        far := Goto(top),
+    ]
+    env = bajo.script.DEF_ENV
+    # absolute addresses are short at the low code region
+    low = make_env(code_region=(1024, 0x10000))
+    for e, expected in [(env, [Br, BrLnk, Br]), (low, [Br, JmpLnk, Jmp])]:
+        s = Script(code, env=e)
+        vm = Vm.from_script(s)
+        vm.run()
+        assert vm[R[0]] == 1 and vm[R[1]] == 5
+        assert [opcode(inst, s) for inst in [near, call, far]] == [cls.opcode for cls in expected]
@@ -0,0 +1,72 @@
+from bajo.core import _S32_MAX, _S32_MIN
+from bajo import Add, AddBrLt, BrGe, R, Script
+from bajo.macro import for_range, loop_while, repeat
+
+from .helpers import make_env, run
+
+
+def _types(code, env=None):
+    return [type(inst) for inst in Script(code, env=env).layout.insts]
+
+
+def test_loop_while():
+    for x, expected in [(0, 12), (11, 14), (20, 20)]:
+        code = [R[0].set(x), loop_while(R[0] < 12, R[0].set(R[0] + 3))]
+        assert run(code)[R[0]] == expected
+    # guard and the back edge (fused with the increment)
+    types = _types(loop_while(R[0] < 12, R[0].set(R[0] + 3)), make_env(superinstructions=True))
+    assert types.count(BrGe) == 1 and types.count(AddBrLt) == 1
+
+
+def test_repeat():
+    for n in [0, 1, 2, 5, 6, 7, 8]:
+        for unroll in [1, 3]:
+            code = [R[1].set(0), repeat(n, R[1].set(R[1] + 1), counter=R[0], unroll=unroll)]
+            assert run(code)[R[1]] == n
+    # one copy before the loop of three
+    assert _types(repeat(7, R[1].set(R[1] + 1), counter=R[0], unroll=3)).count(Add) == 1 + 3
+
+    # virtual counter
+    s = Script([R[1].set(0), repeat(10, R[1].set(R[1] + 2))], env=make_env(scratch_registers=[5]))
+    assert run(s)[R[1]] == 20
+    # the default env has the scratch registers for it
+    assert run([R[1].set(0), repeat(5, R[1].set(R[1] + 2), unroll=2)])[R[1]] == 10
+
+
+def test_for_range():
+    for start, stop, step in [(0, 10, 1), (3, 3, 1), (5, 0, 1), (-7, 20, 3), (10, -5, -2), (0, 1, 1), (10, 0, -1)]:
+        expected = list(range(start, stop, step))
+        for unroll in [1, 2, 4]:
+            for limit in [stop, R[3]]:
+                code = [
+                    R[1].set(0),
+                    R[2].set(0),
+                    R[3].set(stop),
+                    for_range(
+                        R[0], start, limit, step, [R[1].set(R[1] + R[0]), R[2].set(R[2] + 1)], unroll=unroll, tmp=R[4]
+                    ),
+                ]
+                vm = run(code)
+                assert vm[R[1]] == sum(expected)
+                assert vm[R[2]] == len(expected)
+
+    # the limit of the unrolled loop is not wrapped near the ends of the range
+    for start, stop, step in [
+        (_S32_MIN, _S32_MIN + 2, 1),
+        (_S32_MIN + 1, _S32_MIN + 8, 3),
+        (_S32_MAX, _S32_MAX - 2, -1),
+    ]:
+        expected = list(range(start, stop, step))
+        for unroll in [2, 4]:
+            code = [
+                R[2].set(0),
+                R[3].set(stop),
+                for_range(R[0], start, R[3], step, [R[1].set(R[0]), R[2].set(R[2] + 1)], unroll=unroll, tmp=R[4]),
+            ]
+            vm = run(code)
+            assert vm[R[1]] == expected[-1]
+            assert vm[R[2]] == len(expected)
+
+    # virtual limit of the default env
+    code = [R[1].set(0), R[3].set(10), for_range(R[0], 0, R[3], 1, R[1].set(R[1] + R[0]), unroll=2)]
+    assert run(code)[R[1]] == sum(range(10))
@@ -0,0 +1,434 @@
+from random import choice
+
+import pytest
+
+from bajo import (
+    Add,
+    Br,
+    BrEq,
+    BrGe,
+    BrGt,
+    BrLnk,
+    BrLt,
+    BrNe,
+    D,
+    DivU,
+    Exit,
+    Jmp,
+    Label,
+    M,
+    Mov,
+    Mul,
+    R,
+    RemU,
+    Script,
+    Sub,
+)
+from bajo.cfg import CFG
+from bajo.core import _S32_MAX, _S32_MIN, BitAnd, IMem, LShift, RShiftU, Sys02
+from bajo.exc import BuildError
+from bajo.macro import Subroutine, loop_while, when
+from bajo.opt import (
+    _FOLD,
+    fold,
+    fold_branches,
+    hoist_invariants,
+    peephole,
+    propagate_constants,
+    remove_dead_stores,
+    remove_unreachable,
+    renumber_registers,
+    reorder_blocks,
+    thread_branches,
+)
+from bajo.profile import Profile
+from bajo.script import flat_code
+
+from .helpers import rands32, randu32, s32
+from .vm import Vm
+
+
+def _insts(s: Script):
+    return [type(inst) for inst in s.layout.insts]
+
+
+def _check_same(code):
+    ref = Vm.from_script(Script(code))
+    ref.run()
+    s = Script(code, passes=[peephole])
+    vm = Vm.from_script(s)
+    vm.run()
+    for i in range(8):
+        assert vm[R[i]] == ref[R[i]]
+    assert len(bytes(s)) <= len(bytes(Script(code)))
+    return s
+
+
+def test_mov():
+    s = _check_same([Mov(R[0], 1), Mov(R[0], R[0]), Mov(R["sp"], R[13]), Mov(M[8], R[2])])
+    assert _insts(s) == [Mov, Exit]
+
+
+def test_br():
+    lab = Label()
+    s = _check_same([R[0].set(1), Br(lab), lab, R[1].set(2)])
+    assert Br not in _insts(s)
+
+    lab = Label()
+    br = Br(lab)
+    s = _check_same([R[0].set(1), br, lab, R[1].set(2), Exit(), D(br)])
+    # referenced instruction is never removed
+    assert _insts(s).count(Br) == 1
+
+
+def test_add():
+    for a, b in [(1, 2), (5, -5), (0x7FFF_FFFF, 1), (-3, 0x7FFF_FFFF)]:
+        s = _check_same([Mov(R[0], 100), Add(R[1], R[0], a), Add(R[1], R[1], b), Sub(R[1], R[1], 3)])
+        assert _insts(s).count(Add) + _insts(s).count(Sub) <= 1
+
+    lab = Label()
+    s = _check_same([Mov(R[0], 100), Add(R[0], R[0], 1), lab, Add(R[0], R[0], 1)])
+    # label in between
+    assert _insts(s).count(Add) == 2
+
+
+def test_strength():
+    for _ in range(20):
+        v = randu32() >> 1
+        for k in [0, 1, 5, 31]:
+            pow2 = s32(1 << k)
+            code = [
+                Mov(R[0], v),
+                Mul(R[1], R[0], pow2),
+                Mul(R[2], pow2, R[0]),
+                DivU(R[3], R[0], pow2),
+                RemU(R[4], R[0], pow2),
+                Mul(R[5], R[0], 3),
+            ]
+            s = _check_same(code)
+            insts = _insts(s)
+            assert DivU not in insts and RemU not in insts
+            assert insts.count(Mul) == 1
+            if k:
+                assert LShift in insts and RShiftU in insts
+            assert BitAnd in insts
+
+
+def _cfg_code():
+    sub = Label()
+    end = Label()
+    jt = Label()
+    return [
+        R[0].set(1),
+        when(R[0] == 1, R[1].set(R[0] + 1), R[1].set(2)),
+        BrLnk(R["lr"], sub),
+        Jmp(M[R[5] + jt]),
+        Br(end),
+        sub,
+        R[2].set(3),
+        Jmp(R["lr"]),
+        Label("entry"),
+        Exit(5),
+        Exit(6),
+        jt,
+        D(end),
+        D(end),
+        end,
+        Exit(),
+    ]
+
+
+def test_cfg():
+    cfg = CFG(list(flat_code(_cfg_code())))
+    b = cfg.blocks
+    assert len(b) == 11
+    assert [len(block.insts) for block in b] == [2, 2, 1, 1, 1, 1, 2, 1, 1, 2, 1]
+    assert b[0].succs == [b[2], b[1]]
+    assert b[1].succs == [b[3]]
+    assert b[3].succs == [b[6], b[4]]
+    # indirect jumps may reach the address-taken blocks and the return points
+    assert b[4].is_indirect and b[4].succs == [b[4], b[9], b[10]]
+    assert b[6].succs == [b[4], b[9], b[10]]
+    assert cfg.address_taken == {b[9], b[10]}
+    assert cfg.return_points == {b[4]}
+    assert cfg.reachable() == set(b) - {b[5], b[8]}
+
+
+def test_remove_unreachable():
+    code = _cfg_code()
+    s = Script(code, passes=[remove_unreachable])
+    insts = s.layout.insts
+    assert len(insts) == len(Script(code).layout.insts) - 2
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[2]] == 3
+
+    # unused subroutine is dropped
+    sub = Subroutine().define(R[0].set(1))
+    s = Script([R[1].set(2), Exit(), sub], passes=[remove_unreachable])
+    assert len(s.layout.insts) == 2
+
+
+def test_thread_and_fold():
+    skip0 = Label()
+    skip1 = Label()
+    code = [
+        R[0].set(1),
+        when(R[0] == 1, [R[1].set(1), when(R[0] == 2, R[2].set(R[0] + 5))], R[1].set(2)),
+        # never taken
+        BrGe(2, 3, skip0),
+        R[3].set(4),
+        skip0,
+        # always taken
+        BrGt(3, 2, skip1),
+        R[4].set(4),
+        skip1,
+    ]
+    s = _check_same(code)
+    s = Script(code, passes=[fold_branches, thread_branches, remove_unreachable, peephole])
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[1]] == 1 and vm[R[3]] == 4 and vm[R[4]] == 0
+    insts = _insts(s)
+    assert insts.count(BrNe) == 2
+    # the jump over the else arm only
+    assert insts.count(Br) == 1
+
+    # chain of branches
+    a, b, c = Label(), Label(), Label()
+    code = [BrEq(R[0], 0, a), Exit(1), a, Br(b), b, Br(c), Exit(2), c, Exit(3)]
+    s = Script(code, passes=[thread_branches])
+    assert s.layout[s.layout.insts[0].srcs[-1].tgt] == s.layout[c]
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm.exit_rc == 3
+
+
+def test_fold():
+    edge = [0, 1, -1, 2, 31, 32, 33, -32, _S32_MIN, _S32_MAX, 0x55AA]
+    for cls, func in _FOLD.items():
+        nsrcs = func.__code__.co_argcount or 3
+        for _ in range(50):
+            srcs = [choice(edge) if randu32() & 1 else rands32() for _ in range(nsrcs)]
+            op = cls(R[0], *[R[i + 1] for i in range(nsrcs)])
+            res = fold(cls(R[0], *srcs))
+            if res is None:
+                continue
+            vm = Vm.from_script(Script([Mov(R[i + 1], v) for i, v in enumerate(srcs)] + [op]))
+            vm.run()
+            assert vm[R[0]] == res, (cls, srcs)
+
+
+def test_propagate_constants():
+    a, b, c = R[0], R[1], R[2]
+    code = [
+        a.set(10),
+        b.set(a + 20),
+        R[3].set(1),
+        R[3].set(R[3] + a),
+        c.set(b * 30),
+        when(c < 1000, Sys02(42, a, b)),
+        # unknown
+        R[4].set(M[R[5] + 0x100]),
+        R[5].set(R[4] + 1),
+    ]
+    passes = [propagate_constants, fold_branches, remove_dead_stores]
+    s = Script(code, passes=passes)
+    insts = s.layout.insts
+    assert [type(inst) for inst in insts] == [Mov, Mov, Mov, Mov, Sys02, Mov, Add, Exit]
+    # branch is gone, the blocks are merged
+    s = Script(code, passes=[propagate_constants, fold_branches, *passes])
+    insts = s.layout.insts
+    # the first R[3] assignment is dead
+    assert [type(inst) for inst in insts] == [Mov, Mov, Mov, Mov, Sys02, Mov, Add, Exit]
+    assert list(insts[2].srcs) == [11]
+    assert list(insts[4].srcs) == [42, 10, 30]
+
+    calls = []
+    vm = Vm.from_script(s)
+    vm.funcs = {42: lambda argv: calls.append(tuple(argv))}
+    vm.run()
+    assert calls == [(10, 30)]
+    assert [vm[R[i]] for i in range(6)] == [10, 30, 900, 11, 0, 1]
+
+    # indirect store may hit the register
+    code = [R[0].set(4), R[1].set(5), Mov(M[R[0]], 7), R[2].set(R[1])]
+    s = Script(code, passes=passes)
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[1]] == 7 and vm[R[2]] == 7
+
+    # known values are not carried across the labels
+    lab = Label()
+    code = [R[0].set(1), lab, R[1].set(R[0] + 1), R[0].set(R[0] + 1), BrNe(R[0], 5, lab)]
+    s = Script(code, passes=passes)
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[0]] == 5 and vm[R[1]] == 5
+
+    # plain ram words are the registers too, the unaligned one is a part of two
+    for code in [
+        [R[2].set(5), R[3].set(M[8]), R[2].set(6)],
+        [R[2].set(0x11223344), R[3].set(0), Mov(R[4], M[9]), R[2].set(6), R[3].set(7)],
+        [Mov(M[10], 0x7FFF), R[4].set(R[3]), R[2].set(6), R[3].set(7)],
+        # read via the pointer may be of any of them
+        [R[2].set(400), M[400].set(5), R[1].set(M[R[2]]), M[400].set(6)],
+        [R[2].set(16), R[4].set(5), R[1].set(M[R[2]]), R[4].set(6)],
+    ]:
+        ref = Vm.from_script(Script(code))
+        ref.run()
+        for passes in [[remove_dead_stores], [propagate_constants, remove_dead_stores]]:
+            vm = Vm.from_script(Script(code, passes=passes))
+            vm.run()
+            assert [vm[R[i]] for i in range(5)] == [ref[R[i]] for i in range(5)]
+
+
+def _loop_code():
+    top = Label()
+    return [
+        # r40 is used more often, r41 is executed more often
+        R[40].set(1),
+        R[40].set(R[40] + 1),
+        R[40].set(R[40] * 3),
+        R[40].set(R[40] - 2),
+        R[41].set(0),
+        R[42].set(0x100),
+        top,
+        R[41].set(R[41] + 1),
+        Mov(M[R[42] + 4], R[41]),
+        BrNe(R[41], 100, top),
+        # results to the pinned registers
+        R[1].set(R[40]),
+        R[2].set(R[41]),
+        R[3].set(M[0x104]),
+    ]
+
+
+def test_renumber_registers():
+    code = _loop_code()
+    ref = Vm.from_script(Script(code))
+    ref.run()
+    relocatable = [R[40], R[41], R[42]]
+
+    s = Script(code, passes=[renumber_registers(relocatable, spare=[R[4], R[5]])])
+    vm = Vm.from_script(s)
+    vm.run()
+    assert [vm[R[i]] for i in range(1, 4)] == [ref[R[i]] for i in range(1, 4)] == [4, 100, 100]
+    assert len(bytes(s)) < len(bytes(Script(code)))
+    # by the static counts
+    assert s.layout.insts[0].tgts[0] == R[4]
+    assert s.layout.insts[4].tgts[0] == R[5]
+    # indirect operand is renamed too
+    assert isinstance(s.layout.insts[7].tgts[0], IMem)
+    assert s.layout.insts[7].tgts[0].ref == R[40]
+
+    # by the profile
+    trace = Vm.from_script(Script(code)).run_traced()
+    profile = Profile.from_trace(Script(code), trace)
+    s = Script(code, passes=[renumber_registers(relocatable, spare=[R[4], R[5]], profile=profile)])
+    vm = Vm.from_script(s)
+    vm.run()
+    assert [vm[R[i]] for i in range(1, 4)] == [4, 100, 100]
+    assert s.layout.insts[4].tgts[0] == R[4]
+
+    with pytest.raises(BuildError):
+        Script(code, passes=[renumber_registers(relocatable, spare=[R[1]])]).build()
+    with pytest.raises(BuildError):
+        Script(code, passes=[renumber_registers([R[13]])]).build()
+
+
+def _taken(s: Script, trace: list[int]) -> int:
+    """Number of the executed jumps"""
+    sizes = {s.layout.addrof(inst): s.layout.sizeof(inst) for inst in s.layout.insts}
+    return sum(1 for pc, nxt in zip(trace, trace[1:], strict=False) if nxt != pc + sizes[pc])
+
+
+def test_reorder_blocks():
+    top = Label()
+    code = [
+        R[0].set(0),
+        top,
+        R[0].set(R[0] + 1),
+        # rarely taken
+        when(R[0] == 50, [R[2].set(R[2] + 1), R[3].set(7)]),
+        R[1].set(R[1] + R[0]),
+        BrGt(100, R[0], top),
+        R[4].set(1),
+    ]
+    s = Script(code)
+    profile = Profile.from_trace(s, Vm.from_script(s).run_traced())
+    reordered = Script(code, passes=[reorder_blocks(profile)])
+    ref, vm = Vm.from_script(s), Vm.from_script(reordered)
+    ref.run()
+    trace = vm.run_traced()
+    assert [vm[R[i]] for i in range(5)] == [ref[R[i]] for i in range(5)] == [100, 5050, 1, 7, 1]
+    # hot path falls through
+    assert _taken(reordered, trace) < _taken(s, Vm.from_script(s).run_traced())
+
+
+def test_hoist_invariants():
+    def scan(n):
+        return [
+            [M[0x10C + i * 4].set(i) for i in range(10)],
+            R[5].set(3),
+            R[0].set(0x100),
+            R[1].set(0),
+            R[2].set(0),
+            R[9].set(n),
+            loop_while(
+                R[1] < R[9],
+                [
+                    # invariant, the second one is using the first
+                    R[3].set(R[5] * 4),
+                    R[6].set(R[0] + R[3]),
+                    R[2].set(R[2] + M[R[6] + R[1]]),
+                    # changes in the loop
+                    R[7].set(R[1] * 2),
+                    # may be skipped but seen at the Exit
+                    when(R[1] == 3, R[8].set(R[5] + 1)),
+                    R[1].set(R[1] + 4),
+                ],
+            ),
+        ]
+
+    for n in [0, 4, 40]:
+        code = scan(n)
+        ref = Vm.from_script(Script(code))
+        ref_trace = ref.run_traced()
+        s = Script(code, passes=[hoist_invariants])
+        vm = Vm.from_script(s)
+        trace = vm.run_traced()
+        assert [vm[R[i]] for i in range(10)] == [ref[R[i]] for i in range(10)]
+        assert vm[R[2]] == sum(range(n // 4)) and vm[R[8]] == 0
+        # two ops are executed once
+        assert len(ref_trace) - len(trace) == max(n // 4 - 1, 0) * 2
+
+    # calls may write anything
+    top = Label()
+    sub = Subroutine().define([R[5].set(R[5] + 1)])
+    code = [R[1].set(0), top, R[3].set(R[5] * 4), sub(), R[1].set(R[1] + 1), BrNe(R[1], 3, top), Exit(), sub]
+    assert _insts(Script(code, passes=[hoist_invariants])) == _insts(Script(code))
+
+    # source is written in the loop via the plain memory
+    top = Label()
+    code = [R[1].set(0), R[2].set(0), top, R[3].set(R[2] + 1), M[8].set(R[1]), R[1].set(R[1] + 1), BrLt(R[1], 3, top)]
+    vm = Vm.from_script(Script(code, passes=[hoist_invariants]))
+    vm.run()
+    assert vm[R[3]] == 2
+
+    # source is written in the loop via the pointer
+    top = Label()
+    code = [
+        R[1].set(0),
+        R[2].set(400),
+        R[3].set(0),
+        top,
+        R[4].set(M[400]),
+        R[3].set(R[3] + R[4]),
+        M[R[2]].set(R[1] * 2),
+        R[1].set(R[1] + 1),
+        BrLt(R[1], 5, top),
+    ]
+    vm = Vm.from_script(Script(code, passes=[hoist_invariants]))
+    vm.run()
+    assert vm[R[3]] == 0 + 0 + 2 + 4 + 6
@@ -7,6 +7,9 @@ from bajo import Align, Bytes, Exit, Label, M, Mov, Nop, R, Script
 from bajo.env import Env
 from bajo.exc import BuildError
 
+from .helpers import make_env
+from .vm import Vm
+
 
 @contextmanager
 def fix_oscillations(fix: bool):
@@ -82,3 +85,33 @@ def test_noconverge_reproducible_random():
     a = _noconverge_case().encode()
     b = _noconverge_case().encode()
     assert a == b
+
+
+def test_optimize_layout():
+    def script(start: int, optimize: bool):
+        env = Env(
+            ram_region=(0, 1024),
+            named_registers={},
+            code_region=(start, 0xFFFFFFFF + 1),
+            optimize_layout=optimize,
+        )
+        lab = Label()
+        return Script([R[0].set(lab), lab, Exit()], env=env)
+
+    # the address fits the short immediate only if the instruction is short too.
+    # Default build starts from the long one and stays there
+    s = script(4091, True)
+    assert s.layout.size == script(4091, False).layout.size - 1
+    assert s.layout.size_savings == 1
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[0]] == s.layout.addrof(s.layout.insts[1])
+
+    for start in range(4080, 4100):
+        assert script(start, True).layout.size <= script(start, False).layout.size
+
+    # oscillating case is solved too
+    case = _noconverge_case()
+    s = Script(case.code, env=make_env(case.env, optimize_layout=True))
+    assert s.layout.size <= case.layout.size
+    assert s.layout.size_savings == case.layout.size - s.layout.size
@@ -0,0 +1,80 @@
+import pytest
+
+import bajo.script
+from bajo import BrNe, Exit, Label, M, Mov, R, Script, V
+from bajo.exc import BuildError
+from bajo.macro import Subroutine
+from bajo.regalloc import interference
+
+from .helpers import make_env, run
+from .vm import Vm
+
+
+def _regs(s: Script):
+    return {opd.n for inst in s.layout.insts for opd in [*inst.tgts, *inst.srcs] if isinstance(opd, bajo.Reg)}
+
+
+def test_reuse():
+    a, b, c, d = V(), V(), V(), V()
+    code = [
+        a.set(3),
+        b.set(a * 5),
+        # a is dead here
+        c.set(b + 1),
+        d.set(c - b),
+        R[10].set(d),
+        R[11].set(b),
+    ]
+    s = Script(code, env=make_env(scratch_registers=range(8)))
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[10]] == 1 and vm[R[11]] == 15
+    # b is live with c and d only. a-b and c-d pairs are sharing the registers
+    assert _regs(s) == {0, 1, 10, 11}
+    graph = interference(list(bajo.script.flat_code(code)), s.env)
+    assert graph[b] == {c, d}
+    assert graph[a] == set()
+
+
+def test_loop():
+    i, acc = V("i"), V("acc")
+    top = Label()
+    code = [
+        i.set(10),
+        acc.set(0),
+        top,
+        acc.set(acc + i),
+        Mov(M[R[0] + 0x100], acc),
+        i.set(i - 1),
+        BrNe(i, 0, top),
+        R[2].set(acc),
+    ]
+    s = Script(code, env=make_env(scratch_registers=range(4)))
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[2]] == 55
+    # registers used directly (r0 as the indirect base, r2) are skipped
+    assert _regs(s) == {1, 2, 3}
+
+
+def test_call():
+    x = V()
+    t = V()
+    sub = Subroutine().define([t.set(7), R[5].set(t)], save_regs="auto", results=[R[5]])
+    code = [R["sp"].set(1000), x.set(1), sub(), R[6].set(x + R[5]), Exit(), sub]
+    s = Script(code, env=make_env(scratch_registers=range(8)))
+    vm = Vm.from_script(s)
+    vm.run()
+    assert vm[R[6]] == 8
+
+
+def test_errors():
+    a, b = V(), V()
+    code = [a.set(1), b.set(2), R[3].set(a + b)]
+    with pytest.raises(BuildError):
+        Script(code, env=make_env(scratch_registers=[0])).build()
+    with pytest.raises(BuildError, match="Env.scratch_registers"):
+        Script(code, env=make_env(scratch_registers=())).build()
+    Script(code, env=make_env(scratch_registers=[0, 1])).build()
+    # the default env has a pool
+    assert run(code)[R[3]] == 3
@@ -0,0 +1,100 @@
+import pytest
+
+from bajo import Add, Align, BrGt, BrLnk, D, Exit, Jmp, Label, M, Mov, R, Script
+from bajo.exc import BuildError, DetachedLabelError, DuplicateDefError, MissingDefError
+from bajo.ir import Block
+from bajo.macro import when
+from bajo.stream import build_stream
+
+from .vm import Vm
+
+
+def _build(code, tmp_path, **kwargs):
+    path = tmp_path / "code.bin"
+    with open(path, "wb") as f:
+        lay = build_stream(code, f, **kwargs)
+    data = path.read_bytes()
+    assert len(data) == lay.size
+    return data, lay
+
+
+def _run(code, tmp_path):
+    data, lay = _build(code, tmp_path)
+    vm = Vm(data, codebase=lay.code_range[0], initial_pc=lay.code_range[0], ramsize=1024)
+    vm.run()
+    return vm
+
+
+def _program(n: int):
+    sub = Label("sub")
+    top = Label()
+    end = Label("end")
+    data = Label("data")
+
+    def gen():
+        yield R[0].set(0)
+        yield R[1].set(0)
+        yield top
+        for i in range(n):
+            yield Add(R[1], R[1], i)
+        yield Add(R[0], R[0], 1)
+        yield BrGt(3, R[0], top)
+        yield BrLnk(R["lr"], sub)
+        yield Jmp(end)
+        yield sub
+        yield R[2].set(M[data])
+        yield Jmp(R["lr"])
+        yield Align(16)
+        yield data
+        yield D(1234)
+        yield D(sub)
+        yield end
+        yield when(R[0] == 3, R[3].set(1))
+
+    return gen()
+
+
+def test_same_as_script(tmp_path):
+    n = 300
+    vm = _run(_program(n), tmp_path)
+    ref = Script(list(_program(n)))
+    ref_vm = Vm.from_script(ref)
+    ref_vm.run()
+    assert vm.exit_rc == ref_vm.exit_rc == 0
+    for i in range(4):
+        assert vm[R[i]] == ref_vm[R[i]]
+    assert vm[R[1]] == 3 * sum(range(n))
+    assert vm[R[2]] == 1234
+
+    _, lay = _build(_program(n), tmp_path)
+    assert lay["data"] % 16 == 0
+    # there is no shrinking, but the result is still compact
+    assert lay.size <= ref.layout.size + 8
+
+
+def test_static(tmp_path):
+    code = [Mov(R[i % 10], i) for i in range(1000)]
+    data, _ = _build(iter(code), tmp_path)
+    assert data == Script(code).encode()
+
+
+def test_block(tmp_path):
+    blk = Block()
+    top = blk.label()
+    blk.op(Add, [R[0]], [R[0], 1])
+    blk.op(BrGt, [], [100, R[0], top])
+    vm = _run([blk, Exit()], tmp_path)
+    assert vm[R[0]] == 100
+
+
+def test_bad(tmp_path):
+    lab = Label()
+    with pytest.raises(MissingDefError):
+        _build([Jmp(lab)], tmp_path)
+    with pytest.raises(DuplicateDefError):
+        _build([lab, Exit(), lab, Exit()], tmp_path)
+    with pytest.raises(DetachedLabelError):
+        _build([Exit(), Label()], tmp_path, add_exit=False)
+    data = D(1)
+    with pytest.raises(BuildError):
+        _build([R[0].set(M[data]), data], tmp_path)
@@ -1,5 +1,5 @@
-from bajo import Exit, Label, R, Script
-from bajo.macro import Subroutine, when
+from bajo import Br, BrLnk, BrNe, Exit, Label, LdM, M, R, Reg, Script, StM
+from bajo.macro import INLINE_MAX_SIZE, Subroutine, when
 
 from .helpers import run
 
@@ -89,6 +89,21 @@ def test_leaf():
     assert vm[R[13]] == 1000
 
 
+def test_block_frame():
+    sp = R["sp"]
+    regs = [R[i] for i in range(1, 11)]
+    sub = Subroutine().define([reg.set(-1) for reg in regs], save_regs=regs)
+    code = [sp.set(1000), [reg.set(reg.n * 10) for reg in regs], sub(), Exit(), sub]
+    vm = run(code)
+    assert [vm[reg] for reg in regs] == [reg.n * 10 for reg in regs]
+    assert vm[R[13]] == 1000
+    # 10 registers and lr are pushed and popped by the two blocks
+    s = Script(code)
+    types = [type(inst) for inst in s.layout.insts]
+    assert types.count(StM) == 2 and types.count(LdM) == 2
+    assert _saved(s, sub) == list(range(1, 11))
+
+
 def test_leaf2():
     s0 = Subroutine("sub1").define(R[0].set(1234), is_leaf=True)
     # a lot of duplicate saves with ram overlow. Subroutine should dedup.
@@ -115,3 +130,225 @@ def test_leaf2():
     assert vm[R[0]] == 1234
     assert vm[R[1]] == 1239
     assert vm[R[13]] == 1000
+
+
+def _saved(s: Script, sub: Subroutine):
+    # stores to the stack in the prologue
+    insts = list(s.layout.insts)
+    p = insts.index(s.layout.labels_by_inst[sub.label])
+    saved = []
+    while isinstance(insts[p], StM):
+        saved = [*insts[p].srcs[1:], *saved]
+        p += 1
+    return [reg.n for reg in saved if isinstance(reg, Reg)]
+
+
+def test_auto():
+    sp = R["sp"]
+    inner = Subroutine().define(
+        [R[4].set(44), R[5].set(55)],
+        save_regs="auto",
+        is_leaf=True,
+        results=[R[5]],
+    )
+    outer = Subroutine().define(
+        [R[1].set(11), R[2].set(22), R[3].set(33), inner(), R[3].set(R[5] + 1)],
+        save_regs="auto",
+        results=[R[3]],
+    )
+    s = Script(
+        [
+            sp.set(1000),
+            R[1].set(1),
+            R[2].set(2),
+            R[4].set(4),
+            outer(),
+            # r1 and r4 are live after the call, r2 is not
+            R[0].set(R[1] + R[4]),
+            R[2].set(0),
+            Exit(),
+            outer,
+            inner,
+        ]
+    )
+    vm = run(s)
+    assert vm[R[0]] == 5
+    assert vm[R[3]] == 56
+    assert vm[R[13]] == 1000
+    # r4 is live after the inner call too, so the inner saves it
+    assert _saved(s, inner) == [4]
+    # r5 is not overwritten before the Exit (registers are visible to host)
+    assert _saved(s, outer) == [1, 5]
+
+
+def test_generator_body():
+    sub = Subroutine().define(R[i].set(R[i] + 1) for i in (1, 2))
+    vm = run([R["sp"].set(1000), sub(), sub(), Exit(), sub])
+    assert vm[R[1]] == 2 and vm[R[2]] == 2
+
+    # each inlined call gets the copy
+    sub = Subroutine().define((R[i].set(R[i] + 1) for i in (1, 2)), is_leaf=True, inline=True)
+    s = Script([sub(), sub(), Exit(), sub])
+    vm = run(s)
+    assert vm[R[1]] == 2 and vm[R[2]] == 2
+    assert BrLnk not in _types(s)
+
+
+def test_auto_plain_memory():
+    # the register written via the plain memory is saved too
+    sub = Subroutine().define([M[8].set(99)], save_regs="auto")
+    vm = run([R["sp"].set(1000), R[2].set(5), sub(), R[4].set(R[2]), Exit(), sub])
+    assert vm[R[4]] == 5
+
+
+def test_auto_recursive():
+    sub = Subroutine()
+    sub.define(
+        [
+            R[0].set(R[0] + 1),
+            R[1].set(R[0]),
+            when(R[0] < 20, sub.call()),
+            R[2].set(R[2] + R[1]),
+        ],
+        save_regs="auto",
+        results=[R[0], R[2]],
+    )
+
+    vm = run(
+        [
+            R["sp"].set(1000),
+            sub(),
+            Exit(),
+            sub,
+        ]
+    )
+
+    assert vm[R[0]] == 20
+    # r1 is live after the recursive call, so it's saved
+    assert vm[R[2]] == sum(range(1, 21))
+    assert vm[R[13]] == 1000
+
+
+def _calls_in(s: Script, sub: Subroutine):
+    # calls in the subroutine body (up to the next subroutine label)
+    insts = list(s.layout.insts)
+    p = insts.index(s.layout.labels_by_inst[sub.label])
+    body = []
+    for inst in insts[p:]:
+        if body and s.layout.labels_by_insts[inst]:
+            break
+        body.append(inst)
+    return [type(inst) for inst in body if isinstance(inst, (Br, BrLnk))]
+
+
+def test_tail_call():
+    # chain of handlers passing the control to the next one
+    d = Subroutine().define(R[2].set(R["sp"]), is_leaf=True)
+    c = Subroutine().define([R[1].set(R[1] + 100), d()])
+    b = Subroutine().define([R[1].set(R[1] + 10), c()])
+    a = Subroutine().define([R[1].set(R[1] + 1), b()])
+    s = Script([R["sp"].set(1000), a(), Exit(), a, b, c, d])
+    vm = run(s)
+    assert vm[R[1]] == 111
+    # no frames are on the stack at the end of chain
+    assert vm[R[2]] == 1000
+    assert vm[R[13]] == 1000
+    assert _calls_in(s, a) == _calls_in(s, b) == _calls_in(s, c) == [Br]
+
+    # saved registers are restored before the jump, so these can't be tail calls
+    sub = Subroutine().define([R[1].set(5), d()], save_regs=[R[1]])
+    s = Script([R["sp"].set(1000), sub(), Exit(), sub, d])
+    assert _calls_in(s, sub) == [BrLnk]
+    assert run(s)[R[2]] == 1000 - 8
+
+
+def _tail_call_script(arg: Reg):
+    inner = Subroutine().define([R[4].set(44), R[5].set(R[4] + arg)], save_regs="auto", results=[R[5]])
+    outer = Subroutine().define([R[6].set(30), arg.set(R[6] + 3), inner()], save_regs="auto", results=[R[5]])
+    s = Script(
+        [
+            R["sp"].set(1000),
+            R[3].set(3),
+            R[4].set(4),
+            R[6].set(6),
+            outer(),
+            R[0].set(R[3] + R[4]),
+            R[0].set(R[0] + R[6]),
+            R[7].set(0),
+            Exit(),
+            outer,
+            inner,
+        ]
+    )
+    return s, outer, inner
+
+
+def test_tail_call_auto():
+    # r6 restored by the outer epilogue is not touched by the inner
+    s, outer, inner = _tail_call_script(R[7])
+    vm = run(s)
+    assert vm[R[5]] == 77
+    assert vm[R[0]] == 13
+    assert vm[R[13]] == 1000
+    assert _calls_in(s, outer) == [Br]
+    # r4 is kept by the inner for the outer caller
+    assert _saved(s, inner) == [4]
+    assert _saved(s, outer) == [6]
+
+    # the argument in r3 would be restored by the outer before the jump
+    s, outer, inner = _tail_call_script(R[3])
+    vm = run(s)
+    assert vm[R[5]] == 77
+    assert vm[R[0]] == 13
+    assert _calls_in(s, outer) == [BrLnk]
+
+
+def _types(s: Script):
+    return [type(inst) for inst in s.layout.insts]
+
+
+def test_inline():
+    inc = Subroutine().define(R[1].set(R[1] + 1), is_leaf=True, inline="auto")
+    # labels are fresh in each copy
+    top = Label()
+    count = Subroutine().define(
+        [R[2].set(3), top, R[1].set(R[1] + 10), R[2].set(R[2] - 1), BrNe(R[2], 0, top)],
+        is_leaf=True,
+        inline=True,
+    )
+    big = Subroutine().define(
+        [R[3].set(R[3] + i) for i in range(INLINE_MAX_SIZE + 1)],
+        is_leaf=True,
+        inline="auto",
+    )
+    s = Script([R["sp"].set(1000), inc(), inc(), count(), count(), big(), Exit(), inc, count, big])
+    vm = run(s)
+    assert vm[R[1]] == 62
+    assert vm[R[3]] == sum(range(INLINE_MAX_SIZE + 1))
+    assert vm[R[13]] == 1000
+    # only the big one is called
+    assert _types(s).count(BrLnk) == 1
+
+    # recursive subroutine is called as usual
+    sub = Subroutine()
+    sub.define([R[0].set(R[0] + 1), when(R[0] < 5, sub())], inline=True)
+    s = Script([R["sp"].set(1000), sub(), Exit(), sub])
+    assert run(s)[R[0]] == 5
+    assert _types(s).count(BrLnk) == 2
+
+
+def test_inline_auto():
+    sub = Subroutine().define(
+        [R[3].set(7), R[4].set(8), R[5].set(R[3] + R[4])],
+        save_regs="auto",
+        results=[R[5]],
+        inline=True,
+    )
+    s = Script([R["sp"].set(1000), R[3].set(3), sub(), R[4].set(0), R[0].set(R[3] + R[5]), Exit(), sub])
+    vm = run(s)
+    assert vm[R[0]] == 18
+    assert vm[R[13]] == 1000
+    # only r3 is live after the body, it's pushed alone. No link register
+    assert vm.read_s32(996) == 3
+    assert vm.read_s32(992) == 0
+    assert BrLnk not in _types(s)
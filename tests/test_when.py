@@ -0,0 +1,50 @@
+from bajo import BrNe, M, MovEq, MovGe, MovGt, R, Script
+from bajo.macro import when
+
+from .helpers import run
+
+
+def _types(code):
+    return [type(inst) for inst in Script(code).layout.insts]
+
+
+def test_cmov():
+    for a in [-5, 0, 3, 7]:
+        for cond, expected in [
+            (R[0] == 3, a == 3),
+            (R[0] != 3, a != 3),
+            (R[0] < 3, a < 3),
+            (R[0] <= 3, a <= 3),
+            (R[0] > 3, a > 3),
+            (R[0] >= 3, a >= 3),
+        ]:
+            code = [R[0].set(a), R[2].set(20), when(cond, R[1].set(10), R[1].set(R[2]))]
+            assert run(code)[R[1]] == (10 if expected else 20)
+            # no otherwise: target is kept
+            code = [R[0].set(a), R[1].set(20), when(cond, R[1].set(10))]
+            assert run(code)[R[1]] == (10 if expected else 20)
+
+    assert _types(when(R[0] == 1, R[1].set(1), R[1].set(2)))[0] is MovEq
+    assert _types(when(R[0] > 1, R[1].set(1)))[0] is MovGt
+    assert _types(when(R[0] <= 1, M[8].set(1), M[8].set(R[3])))[0] is MovGe
+
+
+def test_no_cmov():
+    # different targets
+    assert BrNe in _types(when(R[0] == 1, R[1].set(1), R[2].set(2)))
+    # not a single move
+    assert BrNe in _types(when(R[0] == 1, [R[1].set(1), R[2].set(1)], R[1].set(2)))
+    assert BrNe in _types(when(R[0] == 1, R[1].set(R[2] + 1), R[1].set(2)))
+    # pointer is read only if the condition holds
+    code = [R[0].set(2000), when(R[0] == 0, R[1].set(M[R[0]]), R[1].set(5))]
+    assert BrNe in _types(code)
+    assert run(code)[R[1]] == 5
+
+
+def test_generator_arms():
+    # generator is consumed by the cmov check, the same items are emitted
+    code = [R[0].set(1), when(R[0] == 1, (R[i].set(7) for i in (1, 2)), (R[i].set(8) for i in (1, 2)))]
+    vm = run(code)
+    assert vm[R[1]] == 7 and vm[R[2]] == 7
+    assert run([R[0].set(0), when(R[0] == 1, (R[1].set(7) for _ in "x"))])[R[1]] == 0
+    assert run([R[0].set(0), when(R[0] == 1, [], (R[1].set(8) for _ in "x"))])[R[1]] == 8
@@ -15,6 +15,7 @@ from pathlib import Path
 from typing import ClassVar, Generic, Mapping, Protocol, Sequence, TypeVar
 
 from bajo import Reg, Script
+from bajo.image import ImageView
 
 if sys.platform == "win32":
     LIBNAME = "bajo.dll"
@@ -125,7 +126,7 @@ class SysFunc(Protocol):
 class Vm:
     funcs: Mapping[int, SysFunc] = {}
 
-    def __init__(self, code: bytes, *, ramsize=1024, codebase=1024, initial_pc=1024):
+    def __init__(self, code: bytes | memoryview, *, ramsize=1024, codebase=1024, initial_pc=1024):
         self.code = code
         self.codebase = codebase
         self.ram = bytearray([0] * ramsize)
@@ -202,6 +203,14 @@ class Vm:
             raise EXC_BY_CODE[rc](self.pc)
         return self.exit_rc
 
+    def run_traced(self) -> list[int]:
+        """Run step by step. Returns the pcs of executed instructions"""
+        trace: list[int] = []
+        while True:
+            trace.append(self.pc)
+            if self.step() == 1:
+                return trace
+
     def reset(self):
         self.ram[0 : self.ramsize] = [0] * self.ramsize
         DLL.bajo_init(self.ctx, self.initial_pc)
@@ -270,3 +279,15 @@ class Vm:
             initial_pc=script.code_start,
             ramsize=script.env.ram_region[1],
         )
+
+    @classmethod
+    def from_image(cls, image: ImageView | bytes | bytearray, *, entry: str | None = None):
+        if not isinstance(image, ImageView):
+            image = ImageView(image)
+        start = image.code_range[0]
+        return cls(
+            code=image.code,
+            codebase=start,
+            initial_pc=image[entry] if entry is not None else start,
+            ramsize=image.ram_region[1],
+        )